@@ -0,0 +1,97 @@
+"""
+Packs src/catalog_chat into a versioned, content-hashed zip for the browser
+
+    python build_bundle.py [--version 0.0.3] [--output bundles]
+
+The zip holds every module as source and as unchecked-hash bytecode, zipimport
+uses the bytecode when its magic number matches the Pyodide interpreter and
+falls back to the source otherwise. Run with the same minor Python version as
+Pyodide (3.11) for the bytecode to be used.
+"""
+import argparse
+import hashlib
+import importlib.util
+import io
+import json
+import marshal
+import pathlib
+import re
+import sys
+import zipfile
+
+ROOT = pathlib.Path(__file__).parent
+SOURCE = ROOT / "src" / "catalog_chat"
+PYODIDE_PYTHON = (3, 11)
+# Fixed timestamp so the same sources always give the same hash
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def _version() -> str:
+    index = (ROOT / "index.html").read_text(encoding="utf-8")
+    return re.search(r'__version__ = "([^"]+)"', index).group(1)
+
+
+def _bytecode(source: bytes, name: str) -> bytes:
+    """Unchecked hash .pyc, valid without source timestamps inside a zip"""
+    code = compile(source, name, "exec", dont_inherit=True, optimize=0)
+    flags = 0b01
+    return (
+        importlib.util.MAGIC_NUMBER
+        + flags.to_bytes(4, "little")
+        + importlib.util.source_hash(source)
+        + marshal.dumps(code)
+    )
+
+
+def _add(archive: zipfile.ZipFile, name: str, data: bytes):
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    archive.writestr(info, data)
+
+
+def build(version: str, output: pathlib.Path, bytecode=True) -> dict:
+    modules = sorted(
+        path for path in SOURCE.glob("*.py") if path.name not in ["loader.py"]
+    )
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for path in modules:
+            source = path.read_bytes()
+            _add(archive, path.name, source)
+            if bytecode:
+                _add(archive, f"{path.stem}.pyc", _bytecode(source, path.name))
+    data = buffer.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    bundle_name = f"catalog_chat-{version}-{digest[:12]}.zip"
+    output.mkdir(parents=True, exist_ok=True)
+    for old_bundle in output.glob("catalog_chat-*.zip"):
+        old_bundle.unlink()
+    (output / bundle_name).write_bytes(data)
+    manifest = {
+        "version": version,
+        "bundle": bundle_name,
+        "sha256": digest,
+        "python": ".".join(str(row) for row in sys.version_info[:2]),
+        "modules": [path.name for path in modules],
+    }
+    (output / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--version", default=None)
+    parser.add_argument("--output", default=str(ROOT / "bundles"))
+    parser.add_argument("--no-bytecode", action="store_true")
+    args = parser.parse_args()
+    if sys.version_info[:2] != PYODIDE_PYTHON and not args.no_bytecode:
+        print(
+            f"Warning: Python {sys.version_info[0]}.{sys.version_info[1]} bytecode will not match Pyodide, the browser will compile the sources"
+        )
+    manifest = build(args.version or _version(), pathlib.Path(args.output), not args.no_bytecode)
+    print(f"Built {manifest['bundle']} with {len(manifest['modules'])} modules")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+ReAct agent loop that runs Action lines and function calls through async tools
+"""
+import asyncio
+import json
+import re
+import time
+
+from typing import Optional
+
+from pydantic import BaseModel
+
+from js import console
+
+from chat import action_re, function_calls, prompt_base
+from context import estimate_tokens
+
+answer_re = re.compile(r"^Answer:\s*(.*)", re.MULTILINE | re.DOTALL)
+
+
+class AgentCall(BaseModel):
+    # Tool call id, None for Action lines and legacy function calls
+    id: Optional[str] = None
+    tool: str
+    argument: str = ""
+    observation: str = ""
+    seconds: float = 0.0
+
+
+class AgentStep(BaseModel):
+    turn: int
+    calls: list = []
+    model_seconds: float = 0.0
+    # Wall clock for all of the turn's calls, which run concurrently
+    tool_seconds: float = 0.0
+    tokens: int = 0
+    # Thought and action text of the model's turn
+    content: str = ""
+
+
+class AgentResult(BaseModel):
+    answer: str = ""
+    # answer, max_turns, time_budget, token_budget, or error
+    stop: str = "answer"
+    steps: list = []
+    tokens: int = 0
+    seconds: float = 0.0
+
+
+class AgentLoop(object):
+    def __init__(
+        self, max_turns=5, max_seconds=120.0, max_tokens=12000, tool_timeout=30.0, on_step=None
+    ):
+        self.max_turns = max_turns
+        self.tool_timeout = tool_timeout
+        # Wall clock and token budgets for a whole run
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        # Called with each AgentStep, e.g. to add it to the chat history
+        self.on_step = on_step
+        self.tools = {}
+
+    def tool(self, name: str, function, description: str, example: str):
+        """Registers an async function called with an Action's text or a
+        function call's arguments as keywords"""
+        self.tools[name] = {
+            "function": function,
+            "description": description,
+            "example": example,
+        }
+
+    def prompt(self) -> str:
+        """prompt_base followed by the registered actions"""
+        actions = "\n\n".join(
+            f"{name}:\ne.g. {name}: {row['example']}\n{row['description']}"
+            for name, row in self.tools.items()
+        )
+        return f"{prompt_base}{actions}\n\nWhen you are done output Answer: followed by the answer\n"
+
+    def parse(self, message: dict) -> list:
+        """AgentCalls for every tool call, function call, or Action line in a message"""
+        calls = [
+            AgentCall(id=row["id"], tool=row["name"], argument=row["arguments"] or "{}")
+            for row in function_calls(message)
+        ]
+        if len(calls) > 0:
+            return calls
+        for line in (message.get("content") or "").splitlines():
+            action = action_re.match(line.strip())
+            if action is not None:
+                calls.append(AgentCall(tool=action.group(1), argument=action.group(2).strip()))
+        return calls
+
+    async def _dispatch(self, call: AgentCall, is_function: bool, timeout: float):
+        started = time.monotonic()
+        call.observation = await self._observe(call, is_function, min(timeout, self.tool_timeout))
+        call.seconds = time.monotonic() - started
+
+    async def _observe(self, call: AgentCall, is_function: bool, timeout: float) -> str:
+        if call.tool not in self.tools:
+            return f"Unknown action {call.tool}, available actions are {', '.join(self.tools)}"
+        function = self.tools[call.tool]["function"]
+        try:
+            if is_function:
+                arguments = json.loads(call.argument, strict=False)
+                output = await asyncio.wait_for(function(**arguments), timeout)
+            else:
+                output = await asyncio.wait_for(function(call.argument), timeout)
+        except asyncio.TimeoutError:
+            return f"Action {call.tool} ran out of time"
+        except Exception as error:
+            return f"Action {call.tool} failed: {error}"
+        if not isinstance(output, str):
+            output = json.dumps(output)
+        return output
+
+    def _tokens(self, chat_instance, completion: dict) -> int:
+        """Tokens of this completion, the shared metrics may already hold calls
+        from other conversations"""
+        usage = completion.get("usage") or {}
+        if "prompt_tokens" in usage:
+            return usage["prompt_tokens"] + usage.get("completion_tokens", 0)
+        # Streamed responses without usage
+        return sum(estimate_tokens(message) for message in chat_instance.messages)
+
+    def _results(self, pending: list) -> tuple:
+        """(calls, outputs) for ChatGPT.send_tool_results from AgentCalls"""
+        calls = [{"id": call.id, "name": call.tool} for call in pending]
+        return calls, [call.observation for call in pending]
+
+    def _request(self, chat_instance, pending):
+        if isinstance(pending, str):
+            return chat_instance(pending)
+        return chat_instance.send_tool_results(*self._results(pending))
+
+    def _settle(self, chat_instance, before: int, pending):
+        """Leaves the messages valid after a request that failed or ran out of
+        time, an unanswered prompt is dropped and tool results are kept"""
+        del chat_instance.messages[before:]
+        if not isinstance(pending, str):
+            chat_instance.add_tool_results(*self._results(pending))
+
+    def _answer(self, content: str) -> str:
+        answer = answer_re.search(content)
+        return answer.group(1).strip() if answer else content.strip()
+
+    async def run(self, chat_instance, prompt: str) -> AgentResult:
+        """Loops model turn, action, observation until the model answers or a
+        budget runs out"""
+        result = AgentResult(stop="max_turns")
+        started = time.monotonic()
+        deadline = started + self.max_seconds
+        # The next user message, or the AgentCalls whose results are sent back
+        pending = prompt
+        # Function calls of the last turn that have not been answered yet
+        unanswered = None
+        for turn in range(1, self.max_turns + 1):
+            step = AgentStep(turn=turn)
+            model_started = time.monotonic()
+            before = len(chat_instance.messages)
+            unanswered = None
+            try:
+                completion = await asyncio.wait_for(
+                    self._request(chat_instance, pending), max(deadline - model_started, 0)
+                )
+            except asyncio.TimeoutError:
+                result.stop = "time_budget"
+                self._settle(chat_instance, before, pending)
+                break
+            step.model_seconds = time.monotonic() - model_started
+            if "error" in completion:
+                result.stop = "error"
+                result.answer = f"{completion['error']} {completion['message']}"
+                self._settle(chat_instance, before, pending)
+                break
+            step.tokens = self._tokens(chat_instance, completion)
+            result.tokens += step.tokens
+            result.steps.append(step)
+            message = completion["choices"][0]["message"]
+            step.content = message.get("content") or ""
+            step.calls = self.parse(message)
+            if len(step.calls) < 1:
+                result.answer = self._answer(step.content)
+                result.stop = "answer"
+                if self.on_step is not None:
+                    self.on_step(step)
+                break
+            is_function = len(function_calls(message)) > 0
+            tool_started = time.monotonic()
+            await asyncio.gather(
+                *[
+                    self._dispatch(call, is_function, max(deadline - tool_started, 0))
+                    for call in step.calls
+                ]
+            )
+            step.tool_seconds = time.monotonic() - tool_started
+            if self.on_step is not None:
+                self.on_step(step)
+            if is_function:
+                pending = unanswered = step.calls
+            else:
+                pending = "\n".join(
+                    f"Observation: {call.observation}"
+                    if len(step.calls) == 1
+                    else f"Observation from {call.tool}: {call.observation}"
+                    for call in step.calls
+                )
+            if result.tokens >= self.max_tokens:
+                result.stop = "token_budget"
+                break
+            if time.monotonic() >= deadline:
+                result.stop = "time_budget"
+                break
+        if unanswered is not None:
+            # Stopped on a budget after running the calls, the results are kept
+            # so the next request doesn't carry unanswered tool_calls
+            chat_instance.add_tool_results(*self._results(unanswered))
+        if result.stop == "max_turns" and len(result.steps) > 0:
+            result.answer = self._answer(result.steps[-1].content)
+        result.seconds = time.monotonic() - started
+        console.log(
+            f"Agent stopped on {result.stop} after {len(result.steps)} steps, {result.tokens} tokens, {result.seconds:.1f}s"
+        )
+        return result
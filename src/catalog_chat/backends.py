@@ -0,0 +1,176 @@
+"""
+OpenAI-compatible backends with latency tracking and hedged requests
+"""
+import asyncio
+import json
+import time
+
+from collections import deque
+
+from js import AbortController, console
+
+from pyodide.http import pyfetch
+
+from scheduler import RequestScheduler
+
+
+class LatencyStats(object):
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)
+        self.failures = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, percent: float):
+        if len(self.samples) < 1:
+            return None
+        ordered = sorted(self.samples)
+        index = min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)
+        return ordered[index]
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p95(self):
+        return self.percentile(95)
+
+
+class Backend(object):
+    def __init__(self, url, key="", model=None, embedding_model=None):
+        self.url = url
+        self.key = key
+        # Overrides ChatGPT.model, e.g. the model name on a local server
+        self.model = model
+        # Model for the vector stores, defaults to the OpenAI embedding model
+        self.embedding_model = embedding_model
+        self.scheduler = RequestScheduler()
+        # The embeddings endpoint has its own rate limits
+        self.embedding_scheduler = RequestScheduler()
+        self.latency = LatencyStats()
+
+    def headers(self) -> dict:
+        headers = {"Content-Type": "application/json"}
+        if self.key:
+            headers["Authorization"] = f"Bearer {self.key}"
+        return headers
+
+
+class HedgedRouter(object):
+    def __init__(self, backends: list, hedge_delay=2.0, min_samples=5, probe_interval=20):
+        self.backends = backends
+        # Seconds to wait on a backend before also sending to the next one
+        self.hedge_delay = hedge_delay
+        # Backends with fewer samples keep their configured position
+        self.min_samples = min_samples
+        # Every probe_interval requests lead with the least sampled backend so
+        # fallbacks get measured without waiting for a hedge
+        self.probe_interval = probe_interval
+        self.sent = 0
+
+    def ranked(self) -> list:
+        """Measured backends sorted by p95 within the positions they hold in the
+        configured order, unmeasured backends stay where they were configured"""
+        measured = [
+            row for row in self.backends if len(row.latency.samples) >= self.min_samples
+        ]
+        fastest = iter(sorted(measured, key=lambda row: row.latency.p95))
+        output = [next(fastest) if row in measured else row for row in self.backends]
+        self.sent += 1
+        unmeasured = [row for row in output if row not in measured]
+        if len(unmeasured) > 0 and len(output) > 1 and self.sent % self.probe_interval == 0:
+            probe = min(unmeasured, key=lambda row: len(row.latency.samples))
+            output.remove(probe)
+            output.insert(0, probe)
+        return output
+
+    async def _attempt(self, backend: Backend, body: dict, tokens: int, timing: dict):
+        if backend.model:
+            body = dict(body, model=backend.model)
+        controller = AbortController.new()
+        kwargs = {
+            "method": "POST",
+            "headers": backend.headers(),
+            "body": json.dumps(body),
+            "signal": controller.signal,
+        }
+
+        async def send():
+            return await pyfetch(backend.url, **kwargs)
+
+        try:
+            return await backend.scheduler.submit(send, tokens=tokens, timing=timing)
+        except asyncio.CancelledError:
+            controller.abort()
+            raise
+
+    async def send(self, body: dict, tokens=0, timing=None):
+        """Sends to the fastest backend, hedging to the next one after hedge_delay
+        or on failure, and returns (backend, response) for the first OK response"""
+        if timing is None:
+            timing = {}
+        ranked = self.ranked()
+        pending = {}
+        started = {}
+        timings = {}
+        last_backend, last_response, last_error = None, None, None
+
+        def launch(backend):
+            attempt_timing = {}
+            task = asyncio.ensure_future(
+                self._attempt(backend, body, tokens, attempt_timing)
+            )
+            pending[task] = backend
+            started[task] = time.monotonic()
+            timings[task] = attempt_timing
+
+        launch(ranked.pop(0))
+        while len(pending) > 0:
+            timeout = self.hedge_delay if len(ranked) > 0 else None
+            done, _ = await asyncio.wait(
+                list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if len(done) < 1:
+                backend = ranked.pop(0)
+                console.log(f"Hedging request to {backend.url}")
+                launch(backend)
+                continue
+            for task in done:
+                backend = pending.pop(task)
+                elapsed = time.monotonic() - started.pop(task)
+                backend.latency.record(elapsed)
+                try:
+                    response = task.result()
+                except OSError as error:
+                    backend.latency.failures += 1
+                    last_backend, last_error = backend, error
+                    continue
+                if response.ok:
+                    for loser, loser_backend in pending.items():
+                        # A cancelled backend took at least this long
+                        loser_backend.latency.record(time.monotonic() - started[loser])
+                        loser.cancel()
+                    timing.update(timings[task])
+                    timing["backend"] = backend.url
+                    return backend, response
+                backend.latency.failures += 1
+                last_backend, last_response = backend, response
+            if len(pending) < 1 and len(ranked) > 0:
+                launch(ranked.pop(0))
+        if last_response is None:
+            raise last_error
+        return last_backend, last_response
+
+    def stats(self) -> list:
+        return [
+            {
+                "url": row.url,
+                "p50": row.latency.p50,
+                "p95": row.latency.p95,
+                "samples": len(row.latency.samples),
+                "failures": row.latency.failures,
+            }
+            for row in self.backends
+        ]
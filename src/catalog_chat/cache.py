@@ -0,0 +1,136 @@
+"""
+Content-addressed, LRU-bounded cache of chat completions
+"""
+import hashlib
+import json
+
+from collections import OrderedDict
+from typing import Optional
+
+from js import console, sessionStorage
+
+
+class SessionStorageBackend(object):
+    """Persists cache entries across page reloads in the browser's sessionStorage"""
+
+    def __init__(self, prefix="chat_cache:"):
+        self.prefix = prefix
+
+    def keys(self) -> list:
+        output = []
+        for i in range(sessionStorage.length):
+            key = sessionStorage.key(i)
+            if key.startswith(self.prefix):
+                output.append(key[len(self.prefix):])
+        return output
+
+    def get(self, key) -> Optional[str]:
+        return sessionStorage.getItem(f"{self.prefix}{key}")
+
+    def set(self, key, value: str):
+        sessionStorage.setItem(f"{self.prefix}{key}", value)
+
+    def remove(self, key):
+        sessionStorage.removeItem(f"{self.prefix}{key}")
+
+
+class MemoryBackend(object):
+    def __init__(self):
+        self.store = {}
+
+    def keys(self) -> list:
+        return list(self.store.keys())
+
+    def get(self, key) -> Optional[str]:
+        return self.store.get(key)
+
+    def set(self, key, value: str):
+        self.store[key] = value
+
+    def remove(self, key):
+        self.store.pop(key, None)
+
+
+def cache_key(endpoint, model, temperature, messages, functions=None) -> str:
+    payload = json.dumps(
+        [endpoint, model, temperature, messages, functions],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache(object):
+    index_key = "index"
+
+    def __init__(self, max_entries=64, max_bytes=2_000_000, backend=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend if backend is not None else SessionStorageBackend()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        """Restores entries from the backend in least to most recently used order"""
+        index = json.loads(self.backend.get(self.index_key) or "[]")
+        for key in index:
+            value = self.backend.get(key)
+            if value is not None:
+                self.entries[key] = value
+                self.bytes += len(value)
+        self._evict()
+
+    def _save_index(self):
+        self.backend.set(self.index_key, json.dumps(list(self.entries.keys())))
+
+    def _evict(self):
+        while len(self.entries) > 0 and (
+            len(self.entries) > self.max_entries or self.bytes > self.max_bytes
+        ):
+            key, value = self.entries.popitem(last=False)
+            self.bytes -= len(value)
+            self.backend.remove(key)
+
+    def get(self, key) -> Optional[dict]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self._save_index()
+        return json.loads(value)
+
+    def put(self, key, result: dict):
+        value = json.dumps(result)
+        if len(value) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += len(value)
+        self._evict()
+        try:
+            self.backend.set(key, value)
+            self._save_index()
+        except Exception as error:
+            # Storage quota exceeded, keep the entry in memory only
+            console.log(f"Completion cache could not persist {key}: {error}")
+
+    def clear(self):
+        for key in self.entries:
+            self.backend.remove(key)
+        self.entries.clear()
+        self.bytes = 0
+        self._save_index()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
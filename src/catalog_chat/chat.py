@@ -4,55 +4,46 @@ ChatGPT React-Action
 Inspired by this blog post https://til.simonwillison.net/llms/python-react-pattern
 """
 import asyncio
+import codecs
+import copy
 import datetime
 import json
 import re
+import time
 import uuid
 
 from typing import Optional
 from js import console, document, sessionStorage, window
 
-from pyodide.http import pyfetch
+from backends import Backend, HedgedRouter
+from cache import CompletionCache, cache_key
+from context import ContextWindow, estimate_tokens
+from history import history_view
+from metrics import CallMetric, Metrics
 
 
 def _add_prompt_to_history(text):
     ident = uuid.uuid4()
     time_stamp = datetime.datetime.utcnow()
-    card = document.createElement("div")
-    card.setAttribute("id", ident)
-    for css_class in ["card", "border-dark", "mb-3"]:
-        card.classList.add(css_class)
-    card_header = document.createElement("div")
-    card_header.classList.add("card-header")
-    card_header.innerHTML = f"Prompt at {time_stamp}"
-    card.appendChild(card_header)
-    card_body = document.createElement("div")
-    card_body.classList.add("card-body")
-    card_body.innerHTML = text
-    card.appendChild(card_body)
-    card_footer = document.createElement("div")
-    card_footer.classList.add("card-footer")
-    footer_text = document.createElement("small")
-    footer_text.innerHTML = f"ID {ident}"
-    card_footer.appendChild(footer_text)
-    card.appendChild(card_footer)
-    row_div = document.createElement("div")
-    row_div.classList.add("row")
-    div_wrapper = document.createElement("div")
-    div_wrapper.classList.add("col-md-10")
-    div_wrapper.appendChild(card)
-    row_div.appendChild(div_wrapper)
-    prompt_history = document.getElementById("chat-history")
-    if prompt_history.hasChildNodes():
-        prompt_history.insertBefore(row_div, prompt_history.firstChild)
-    else:
-        prompt_history.appendChild(row_div)
+    html_string = f"""<div class="row">
+      <div class="col-md-10">
+        <div id="{ident}" class="card border-dark mb-3">
+          <div class="card-header">Prompt at {time_stamp}</div>
+          <div class="card-body">{text}</div>
+          <div class="card-footer"><small>ID {ident}</small></div>
+        </div>
+      </div>
+    </div>"""
+    history_view.add(ident, html_string)
     return False
 
 
 def _add_response_to_history(response):
     created_at = datetime.datetime.fromtimestamp(response["created"])
-    html_string = f"""<div id="{response['id']}" class="card border-danger mb-3">
+    usage = response.get("usage") or {}
+    html_string = f"""<div class="row">
+     <div class="col-md-10 offset-md-1">
+     <div id="{response['id']}" class="card border-danger mb-3">
       <div class="card-header">
         Response at {created_at.isoformat()} 
       </div>
@@ -60,31 +51,45 @@ def _add_response_to_history(response):
     for choice in response["choices"]:
         message = choice.get("message")
         html_string += f"<p>Role {message['role']}</p>"
-        if message.get("function_call"):
-            html_string += (
-                f"<pre>{json.dumps(message['function_call'], indent=2)}</pre>"
-            )
+        if message.get("function_call") or message.get("tool_calls"):
+            for call in function_calls(message):
+                html_string += f"<pre>{json.dumps(call, indent=2)}</pre>"
         else:
             html_string += f"<p>{message['content']}</p>"
 
     html_string += f"""</div>
       <div class="card-footer">
-        <small>ID {response['id']} Tokens: prompt: {response['usage']['prompt_tokens']} completion: {response['usage']['completion_tokens']}</small>
+        <small>ID {response['id']} Tokens: prompt: {usage.get('prompt_tokens')} completion: {usage.get('completion_tokens')}"""
+    if response.get("cached"):
+        html_string += " (cached)"
+    if response.get("context_saved_tokens"):
+        html_string += f" saved by context window: ~{response['context_saved_tokens']}"
+    html_string += f"""</small>
       </div>
     </div>
+    </div>
+    </div>
     """
-    row_div = document.createElement("div")
-    row_div.classList.add("row")
-    div_wrapper = document.createElement("div")
-    for class_ in ["col-md-10", "offset-md-1"]:
-        div_wrapper.classList.add(class_)
-    div_wrapper.innerHTML = html_string
-    row_div.appendChild(div_wrapper)
-    prompt_history = document.getElementById("chat-history")
-    if prompt_history.hasChildNodes():
-        prompt_history.insertBefore(row_div, prompt_history.firstChild)
+    # Streamed responses re-render their existing card as deltas arrive
+    if history_view.has(response["id"]):
+        history_view.update(response["id"], html_string)
     else:
-        prompt_history.appendChild(row_div)
+        history_view.add(response["id"], html_string)
+    return False
+
+
+def _add_error_to_history(error):
+    ident = uuid.uuid4()
+    time_stamp = datetime.datetime.utcnow()
+    html_string = f"""<div class="row">
+      <div class="col-md-10 offset-md-1">
+        <div id="{ident}" class="card mb-3">
+          <div class="card-header text-bg-danger">Error at {time_stamp.isoformat()}</div>
+          <div class="card-body">Status {error.get('error')} {error.get('message')}</div>
+        </div>
+      </div>
+    </div>"""
+    history_view.add(ident, html_string)
     return False
 
 
@@ -94,6 +99,8 @@ def add_history(value, type_of):
             result = _add_prompt_to_history(value)
         case "response":
             result = _add_response_to_history(value)
+        case "error":
+            result = _add_error_to_history(value)
 
     return result
 
@@ -128,9 +135,127 @@ def update_parameters(chat_gpt_instance):
     max_tokens_elem = document.getElementById("chat-max-tokens")
     if int(max_tokens_elem.value) != chat_gpt_instance.max_tokens:
         chat_gpt_instance.max_tokens = int(max_tokens_elem.value)
-    
-    
-    
+    stream_elem = document.getElementById("chat-stream")
+    chat_gpt_instance.stream = bool(stream_elem.checked)
+    budget_elem = document.getElementById("chat-context-budget")
+    token_budget = int(budget_elem.value or 0)
+    if token_budget < 1:
+        chat_gpt_instance.context_window = None
+    elif chat_gpt_instance.context_window is None:
+        chat_gpt_instance.context_window = ContextWindow(token_budget=token_budget)
+    else:
+        chat_gpt_instance.context_window.token_budget = token_budget
+    fallback_elem = document.getElementById("chat-fallback-endpoints")
+    primary = chat_gpt_instance.router.backends[0]
+    fallbacks = []
+    for line in fallback_elem.value.splitlines():
+        # url [model] [key], "-" for the default model
+        parts = line.split()
+        if len(parts) > 0:
+            model = parts[1] if len(parts) > 1 and parts[1] != "-" else None
+            key = parts[2] if len(parts) > 2 else None
+            fallbacks.append(chat_gpt_instance.backend_for(parts[0], model, key))
+    chat_gpt_instance.router.backends = [primary] + fallbacks
+    hedge_elem = document.getElementById("chat-hedge-delay")
+    try:
+        hedge_delay = float(hedge_elem.value)
+    except ValueError:
+        hedge_delay = -1.0
+    if 0 <= hedge_delay < float("inf"):
+        chat_gpt_instance.router.hedge_delay = hedge_delay
+    else:
+        console.log(
+            f"Invalid hedge delay {hedge_elem.value}, keeping {chat_gpt_instance.router.hedge_delay}"
+        )
+    cache_elem = document.getElementById("chat-cache")
+    if not cache_elem.checked:
+        chat_gpt_instance.cache = None
+    elif chat_gpt_instance.cache is None:
+        chat_gpt_instance.cache = CompletionCache()
+
+
+def _merge_chunk(response: dict, chunk: dict) -> dict:
+    """Folds a streamed chat.completion.chunk into the assembled response"""
+    for key in ["id", "created", "model"]:
+        if key in chunk:
+            response[key] = chunk[key]
+    if chunk.get("usage"):
+        response["usage"] = chunk["usage"]
+    for choice in chunk.get("choices", []):
+        index = choice.get("index", 0)
+        while len(response["choices"]) <= index:
+            response["choices"].append(
+                {
+                    "index": len(response["choices"]),
+                    "message": {"role": "assistant", "content": None},
+                    "finish_reason": None,
+                }
+            )
+        assembled = response["choices"][index]
+        message = assembled["message"]
+        delta = choice.get("delta", {})
+        if delta.get("role"):
+            message["role"] = delta["role"]
+        if delta.get("content"):
+            message["content"] = (message.get("content") or "") + delta["content"]
+        if delta.get("function_call"):
+            function_call = message.setdefault(
+                "function_call", {"name": "", "arguments": ""}
+            )
+            function_call["name"] += delta["function_call"].get("name") or ""
+            function_call["arguments"] += delta["function_call"].get("arguments") or ""
+        for fragment in delta.get("tool_calls") or []:
+            tool_calls = message.setdefault("tool_calls", [])
+            position = fragment.get("index", len(tool_calls))
+            while len(tool_calls) <= position:
+                tool_calls.append(
+                    {"id": "", "type": "function", "function": {"name": "", "arguments": ""}}
+                )
+            tool_call = tool_calls[position]
+            if fragment.get("id"):
+                tool_call["id"] = fragment["id"]
+            function = fragment.get("function") or {}
+            tool_call["function"]["name"] += function.get("name") or ""
+            tool_call["function"]["arguments"] += function.get("arguments") or ""
+        if choice.get("finish_reason"):
+            assembled["finish_reason"] = choice["finish_reason"]
+    return response
+
+
+def function_calls(message: dict) -> list:
+    """The tool calls, or the single legacy function call, of an assistant
+    message as dicts with id, name, and arguments"""
+    calls = [
+        {
+            "id": row["id"],
+            "name": row["function"]["name"],
+            "arguments": row["function"]["arguments"],
+        }
+        for row in message.get("tool_calls") or []
+    ]
+    if len(calls) < 1 and message.get("function_call"):
+        function_call = message["function_call"]
+        calls.append(
+            {
+                "id": None,
+                "name": function_call.get("name"),
+                "arguments": function_call.get("arguments"),
+            }
+        )
+    return calls
+
+
+def _parse_sse(buffer: str):
+    """Splits complete server-sent events off the buffer, returns (data, remainder)"""
+    events = []
+    while "\n\n" in buffer:
+        event, buffer = buffer.split("\n\n", 1)
+        for line in event.splitlines():
+            if line.startswith("data:"):
+                events.append(line[5:].strip())
+    return events, buffer
+
+
 
 class ChatGPT(object):
     def __init__(
@@ -140,28 +265,103 @@ class ChatGPT(object):
         model="gpt-3.5-turbo",
         temperature=0.9,
         max_tokens=1050,
+        backends=None,
     ):
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {key}",
-        }
-        self.openai_url = endpoint_url
+        # Ordered OpenAI-compatible backends, the first one is the primary
+        if backends is None:
+            backends = [Backend(endpoint_url, key=key)]
+        self.router = HedgedRouter(backends)
         self.system = None
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.messages = []
         self.functions = None
+        # Send functions as parallel tools, off for servers that only accept functions
+        self.parallel_tools = True
+        self.stream = False
+        # Optional ContextWindow that bounds the prompt sent on each request
+        self.context_window = None
+        # Optional CompletionCache, replays identical requests without a round trip
+        self.cache = None
+        # Minimum seconds between re-renders of a streaming response card
+        self.render_interval = 0.05
+        self.metrics = Metrics()
+        # Name of the workflow making the calls, set by controls.run_prompt
+        self.workflow_name = ""
         sessionStorage.setItem("chat_gpt_token", key)
 
-    async def __call__(self, message):
-        message = {"role": "user", "content": message}
-        self.messages.append(message)
-        result = await self.execute()
+    @property
+    def openai_url(self):
+        return self.router.backends[0].url
+
+    @openai_url.setter
+    def openai_url(self, url):
+        self.router.backends[0].url = url
+
+    def backend_for(self, url, model=None, key=None) -> Backend:
+        """Returns the existing backend for url, keeping its latency history and,
+        when no key is given, its key"""
+        for backend in self.router.backends:
+            if backend.url == url:
+                backend.model = model
+                if key is not None:
+                    backend.key = key
+                return backend
+        return Backend(url, key=key or "", model=model)
+
+    def add_backend(self, url, model=None, key=None):
+        backend = self.backend_for(url, model, key)
+        if backend not in self.router.backends:
+            self.router.backends.append(backend)
+        return backend
+
+    def fork(self):
+        """Returns a ChatGPT with its own empty message list that shares this
+        instance's backends, cache, context window, and metrics"""
+        forked = copy.copy(self)
+        forked.messages = []
+        forked.stream = False
+        return forked
+
+    async def _complete(self):
+        if self.stream:
+            result = await self.execute_stream()
+        else:
+            result = await self.execute()
+        if "error" in result:
+            return result
         # console.log(f"Adding {result} to messages")
         self.messages.append(result["choices"][0]["message"])
         return result
 
+    async def __call__(self, message):
+        message = {"role": "user", "content": message}
+        self.messages.append(message)
+        return await self._complete()
+
+    async def send_function_result(self, name, content):
+        """Answers the model's function call with the function's output"""
+        self.messages.append({"role": "function", "name": name, "content": content})
+        return await self._complete()
+
+    def add_tool_results(self, calls: list, outputs: list):
+        """Answers a turn's function_calls without requesting a completion"""
+        for call, output in zip(calls, outputs):
+            if call["id"] is None:
+                self.messages.append(
+                    {"role": "function", "name": call["name"], "content": output}
+                )
+            else:
+                self.messages.append(
+                    {"role": "tool", "tool_call_id": call["id"], "content": output}
+                )
+
+    async def send_tool_results(self, calls: list, outputs: list):
+        """Answers all of a turn's function_calls in one request"""
+        self.add_tool_results(calls, outputs)
+        return await self._complete()
+
     async def set_system(self, system):
         self.system = system
         system_message = {"role": "system", "content": self.system}
@@ -171,25 +371,181 @@ class ChatGPT(object):
                 self.messages.pop(i)
         self.messages.insert(0, system_message)
 
-    async def execute(self):
+    def _request_body(self) -> dict:
+        messages = self.messages
+        if self.context_window is not None:
+            messages = self.context_window.fit(self.messages)
         body = {
             "model": self.model,
-            "messages": self.messages,
+            "messages": messages,
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
         }
-        if self.functions:
+        if self.functions and self.parallel_tools:
+            body["tools"] = [
+                {"type": "function", "function": function} for function in self.functions
+            ]
+        elif self.functions:
             body["functions"] = self.functions
-        kwargs = {
-            "method": "POST",
-            "headers": self.headers,
-            "body": json.dumps(body),
-        }
-        completion = await pyfetch(self.openai_url, **kwargs)
+        return body
+
+    def _cached(self, body: dict):
+        """Returns (key, cached result) for the request body, both None if not caching"""
+        if self.cache is None:
+            return None, None
+        primary = self.router.backends[0]
+        key = cache_key(
+            primary.url,
+            primary.model or body["model"],
+            body["temperature"],
+            body["messages"],
+            body.get("tools", body.get("functions")),
+        )
+        result = self.cache.get(key)
+        if result is not None:
+            # Replays get their own card in the history
+            result["id"] = f"{result['id']}-cached-{uuid.uuid4().hex[:8]}"
+            result["cached"] = True
+        return key, result
+
+    def _from_primary(self, timing: dict) -> bool:
+        """Whether the primary backend answered, the cache key names its url and
+        model so a hedged response from a fallback is not stored under it"""
+        return timing.get("backend") == self.router.backends[0].url
+
+    async def _send(self, body: dict, timing: dict):
+        """Sends the request body through the hedged router and each backend's
+        scheduler, returns the first OK fetch response"""
+        tokens = (
+            sum(estimate_tokens(message) for message in body["messages"])
+            + self.max_tokens
+        )
+        backend, completion = await self.router.send(body, tokens=tokens, timing=timing)
+        timing["response"] = time.monotonic()
+        return completion
+
+    def _record(self, body: dict, result: dict, timing: dict, cache_status: str):
+        started = timing["started"]
+        usage = result.get("usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = sum(estimate_tokens(row) for row in body["messages"])
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(
+                estimate_tokens(choice["message"]) for choice in result.get("choices", [])
+            )
+        first_byte = timing.get("first_chunk", timing.get("response", time.monotonic()))
+        metric = CallMetric(
+            workflow=self.workflow_name,
+            model=body["model"],
+            backend=timing.get("backend", ""),
+            cache=cache_status,
+            stream=body.get("stream", False),
+            status="error" if "error" in result else "ok",
+            attempts=timing.get("attempts", 0),
+            queued=timing.get("queued", 0.0),
+            ttfb=first_byte - started,
+            latency=time.monotonic() - started,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+        self.metrics.record(metric)
+        return metric
+
+    async def _error(self, completion) -> dict:
+        message = completion.status_text
+        try:
+            error_body = await completion.json()
+            message = error_body.get("error", {}).get("message", message)
+        except Exception:
+            pass
+        return {"error": completion.status, "message": message}
+
+    async def execute(self):
+        timing = {"started": time.monotonic()}
+        body = self._request_body()
+        key, cached_result = self._cached(body)
+        if cached_result is not None:
+            self._record(body, cached_result, timing, "hit")
+            return cached_result
+        completion = await self._send(body, timing)
         if completion.ok:
             result = await completion.json()
+            self._add_context_savings(result)
+            if key is not None and self._from_primary(timing):
+                self.cache.put(key, result)
         else:
-            result = {"error": completion.status, "message": completion.status_text}
+            result = await self._error(completion)
+        self._record(body, result, timing, "off" if key is None else "miss")
+        return result
+
+    def _add_context_savings(self, result: dict):
+        if self.context_window is not None:
+            result["context_saved_tokens"] = self.context_window.last_saved
+
+    async def deltas(self, body=None, timing=None):
+        """Async generator of chat.completion.chunk dicts from a streamed request"""
+        if body is None:
+            body = self._request_body()
+        if timing is None:
+            timing = {"started": time.monotonic()}
+        body = dict(body)
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}
+        completion = await self._send(body, timing)
+        if not completion.ok:
+            yield await self._error(completion)
+            return
+        reader = completion.js_response.body.getReader()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        while True:
+            chunk = await reader.read()
+            if chunk.done:
+                break
+            timing.setdefault("first_chunk", time.monotonic())
+            buffer += decoder.decode(chunk.value.to_bytes()).replace("\r\n", "\n")
+            events, buffer = _parse_sse(buffer)
+            for data in events:
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+
+    async def execute_stream(self):
+        """Streams a completion, re-rendering its response card as tokens arrive,
+        and returns the assembled response in the same shape as execute"""
+        timing = {"started": time.monotonic()}
+        body = self._request_body()
+        key, cached_result = self._cached(body)
+        if cached_result is not None:
+            self._record(body, cached_result, timing, "hit")
+            add_history(cached_result, "response")
+            return cached_result
+        result = {
+            "id": f"chatcmpl-{uuid.uuid4()}",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [],
+            "usage": {"prompt_tokens": None, "completion_tokens": None},
+        }
+        last_render = 0.0
+        cache_status = "off" if key is None else "miss"
+        async for chunk in self.deltas(body, timing):
+            if "error" in chunk:
+                self._record(body, chunk, timing, cache_status)
+                return chunk
+            _merge_chunk(result, chunk)
+            self._add_context_savings(result)
+            now = time.monotonic()
+            if len(result["choices"]) > 0 and now - last_render >= self.render_interval:
+                add_history(result, "response")
+                last_render = now
+        if len(result["choices"]) > 0:
+            add_history(result, "response")
+            if key is not None and self._from_primary(timing):
+                self.cache.put(key, result)
+        self._record(dict(body, stream=True), result, timing, cache_status)
         return result
 
 
@@ -218,6 +574,29 @@ def update_chat_modal(chat_gpt_instance):
     endpoint_dd.innerHTML = f"""<input class="form-control" id="chat-endpoint"
     value="{chat_gpt_instance.openai_url}"></input>"""
     instance_dl.appendChild(endpoint_dd)
+    fallback_dt = document.createElement("dt")
+    fallback_dt.innerHTML = "Fallback Endpoints (one per line: url, optional model or -, optional key)"
+    instance_dl.appendChild(fallback_dt)
+    fallback_dd = document.createElement("dd")
+    fallback_lines, latency_rows = [], []
+    for backend in chat_gpt_instance.router.backends[1:]:
+        fallback_lines.append(f"{backend.url} {backend.model or ''}".strip())
+    for row in chat_gpt_instance.router.stats():
+        if row["samples"] > 0:
+            latency_rows.append(
+                f"{row['url']} p50: {row['p50']:.2f}s p95: {row['p95']:.2f}s failures: {row['failures']}"
+            )
+    fallback_lines = "\n".join(fallback_lines)
+    fallback_dd.innerHTML = f"""<textarea class="form-control" id="chat-fallback-endpoints" 
+      rows=2>{fallback_lines}</textarea><small>{"<br>".join(latency_rows)}</small>"""
+    instance_dl.appendChild(fallback_dd)
+    hedge_dt = document.createElement("dt")
+    hedge_dt.innerHTML = "Hedge Delay (seconds)"
+    instance_dl.appendChild(hedge_dt)
+    hedge_dd = document.createElement("dd")
+    hedge_dd.innerHTML = f"""<input class="form-control" id="chat-hedge-delay" 
+      value="{chat_gpt_instance.router.hedge_delay}"></input>"""
+    instance_dl.appendChild(hedge_dd)
     model_dt = document.createElement("dt")
     model_dt.innerHTML = "Model"
     instance_dl.appendChild(model_dt)
@@ -239,6 +618,37 @@ def update_chat_modal(chat_gpt_instance):
     max_tokens_dd.innerHTML = f"""<input class="form-control" id="chat-max-tokens" 
       value="{chat_gpt_instance.max_tokens}"></input>"""
     instance_dl.appendChild(max_tokens_dd)
+    stream_dt = document.createElement("dt")
+    stream_dt.innerHTML = "Stream Responses"
+    instance_dl.appendChild(stream_dt)
+    stream_dd = document.createElement("dd")
+    stream_checked = "checked" if chat_gpt_instance.stream else ""
+    stream_dd.innerHTML = f"""<input class="form-check-input" type="checkbox" id="chat-stream" 
+      {stream_checked}></input>"""
+    instance_dl.appendChild(stream_dd)
+    budget_dt = document.createElement("dt")
+    budget_dt.innerHTML = "Context Token Budget (0 for unlimited)"
+    instance_dl.appendChild(budget_dt)
+    budget_dd = document.createElement("dd")
+    token_budget = 0
+    if chat_gpt_instance.context_window is not None:
+        token_budget = chat_gpt_instance.context_window.token_budget
+    budget_dd.innerHTML = f"""<input class="form-control" id="chat-context-budget" 
+      value="{token_budget}"></input>"""
+    instance_dl.appendChild(budget_dd)
+    cache_dt = document.createElement("dt")
+    cache_dt.innerHTML = "Cache Completions"
+    instance_dl.appendChild(cache_dt)
+    cache_dd = document.createElement("dd")
+    cache_checked, cache_stats = "", ""
+    if chat_gpt_instance.cache is not None:
+        cache_checked = "checked"
+        stats = chat_gpt_instance.cache.stats()
+        cache_stats = f"""<small>Hits: {stats['hits']} Misses: {stats['misses']}
+          Entries: {stats['entries']} Bytes: {stats['bytes']}</small>"""
+    cache_dd.innerHTML = f"""<input class="form-check-input" type="checkbox" id="chat-cache" 
+      {cache_checked}></input> {cache_stats}"""
+    instance_dl.appendChild(cache_dd)
     buttons_div = document.createElement("div")
     buttons_div.innerHTML = """<button class="btn btn-primary" data-bs-dismiss="modal"
       py-click="update_parameters(chat_gpt_instance)">Update</button>
@@ -0,0 +1,88 @@
+"""
+Token-budgeted conversation window for ChatGPT messages
+"""
+import json
+
+from js import console
+
+# Rough heuristic for English and MARC text, no tokenizer is available in Pyodide
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(message) -> int:
+    if isinstance(message, str):
+        return len(message) // CHARS_PER_TOKEN + 1
+    content = message.get("content") or ""
+    size = len(content)
+    for key in ["function_call", "tool_calls"]:
+        if message.get(key):
+            size += len(json.dumps(message[key]))
+    return size // CHARS_PER_TOKEN + MESSAGE_OVERHEAD
+
+
+def _turns(messages: list) -> list:
+    """Groups messages into turns, each starting at a user message so that
+    assistant function calls stay with their results"""
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or len(turns) < 1:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+class ContextWindow(object):
+    def __init__(self, token_budget=3000, keep_last=2, summary_chars=160, summary_lines=8):
+        self.token_budget = token_budget
+        # Most recent turns are always sent, even if over budget
+        self.keep_last = keep_last
+        # Summary only lists the latest evicted messages so its size stays bounded
+        self.summary_chars = summary_chars
+        self.summary_lines = summary_lines
+        self.last_saved = 0
+        self.total_saved = 0
+        self.requests = 0
+
+    def _summarize(self, evicted: list) -> dict:
+        lines = [
+            f"Summary of {len(evicted)} earlier messages omitted to save tokens:"
+        ]
+        for message in evicted[-self.summary_lines:]:
+            content = message.get("content") or ""
+            if message.get("function_call"):
+                content = f"called {message['function_call'].get('name')}"
+            content = " ".join(content.split())
+            if len(content) > self.summary_chars:
+                content = f"{content[:self.summary_chars]}..."
+            lines.append(f"- {message['role']}: {content}")
+        return {"role": "system", "content": "\n".join(lines)}
+
+    def fit(self, messages: list) -> list:
+        """Returns the messages to send, always keeping the system message and the
+        latest turns and summarizing older turns that don't fit in the budget"""
+        system = [row for row in messages if row["role"] == "system"]
+        turns = _turns([row for row in messages if row["role"] != "system"])
+        used = sum(estimate_tokens(row) for row in system)
+        kept = []
+        for i, turn in enumerate(reversed(turns)):
+            turn_tokens = sum(estimate_tokens(row) for row in turn)
+            if i >= self.keep_last and used + turn_tokens > self.token_budget:
+                break
+            kept.insert(0, turn)
+            used += turn_tokens
+        evicted = [row for turn in turns[: len(turns) - len(kept)] for row in turn]
+        window = list(system)
+        if len(evicted) > 0:
+            window.append(self._summarize(evicted))
+        for turn in kept:
+            window.extend(turn)
+        original = sum(estimate_tokens(row) for row in messages)
+        self.last_saved = max(original - sum(estimate_tokens(row) for row in window), 0)
+        self.total_saved += self.last_saved
+        self.requests += 1
+        if self.last_saved > 0:
+            console.log(
+                f"Context window evicted {len(evicted)} messages, saved ~{self.last_saved} tokens"
+            )
+        return window
@@ -3,12 +3,20 @@ import datetime
 import io
 import json
 
-import pymarc
-
 from js import Blob, console, document, alert, JSON, URL
 
 from chat import add_history
-from workflows import AssignLCSH, NewResource, MARC21toFOLIO, SinopiaToFOLIO
+from history import history_view
+from lcsh import load_index as load_lcsh_index
+from loader import require, require_workflow
+from vectors import checked_stores, with_context
+from workflows import (
+    AssignLCSH,
+    BatchCheckpoint,
+    NewResource,
+    MARC21toFOLIO,
+    SinopiaToFOLIO,
+)
 
 
 def clear_chat_prompt(chat_gpt_instance):
@@ -20,8 +28,9 @@ def clear_chat_prompt(chat_gpt_instance):
     main_chat_textarea.value = ""
     mrc_upload_btn = document.getElementById("marc-upload-btn")
     mrc_upload_btn.classList.add("d-none")
-    prompt_history = document.getElementById("chat-history")
-    prompt_history.innerHTML = ""
+    batch_btn = document.getElementById("marc-batch-btn")
+    batch_btn.classList.add("d-none")
+    history_view.clear()
     if chat_gpt_instance != None:
         chat_gpt_instance.messages = []
     loading_spinner = document.getElementById("chat-loading")
@@ -39,6 +48,10 @@ def download(chat_instance, workflow):
            "messages": chat_instance.messages,
            "functions": chat_instance.functions
         },
+        "metrics": {
+           "calls": chat_instance.metrics.export(),
+           "summary": chat_instance.metrics.summary()
+        },
         "workflow": {
            "name": workflow.name
         }
@@ -96,11 +109,19 @@ async def init_workflow(workflow_slug):
     _clear_vector_db()
     mrc_upload_btn = document.getElementById("marc-upload-btn")
     mrc_upload_btn.classList.add("d-none")
-
+    batch_btn = document.getElementById("marc-batch-btn")
+    batch_btn.classList.add("d-none")
+    loading_spinner.classList.remove("d-none")
+    try:
+        await require_workflow(workflow_slug)
+    finally:
+        loading_spinner.classList.add("d-none")
 
     match workflow_slug:
         case "add-lcsh":
             lcsh_vector_chkbox.checked = True
+            # Downloads and indexes the LCSH export in the background
+            load_lcsh_index()
             workflow = AssignLCSH(zero_shot=True)
             msg = workflow.name
 
@@ -112,6 +133,7 @@ async def init_workflow(workflow_slug):
 
         case "marc-to-folio":
             mrc_upload_btn.classList.remove("d-none")
+            batch_btn.classList.remove("d-none")
             workflow = MARC21toFOLIO(zero_shot=True)
             msg = workflow.name
 
@@ -149,14 +171,46 @@ async def init_workflow(workflow_slug):
 
 
 async def load_marc_record(marc_file):
-    if marc_file.element.files.length > 0:
-        marc_file_item = marc_file.element.files.item(0)
-        marc_binary = await marc_file_item.text()
-        marc_reader = pymarc.MARCReader(
-            io.BytesIO(bytes(marc_binary, encoding="utf-8"))
-        )
-        marc_record = next(marc_reader)
-        return str(marc_record)
+    await require("pymarc")
+    from marc import load_first_record
+
+    return await load_first_record(marc_file)
+
+
+def _batch_progress(checkpoint):
+    progress_div = document.getElementById("batch-progress")
+    progress_div.classList.remove("d-none")
+    progress_div.innerHTML = f"""<small>Loaded: {checkpoint.loaded}
+      Previously loaded: {checkpoint.skipped} Failed: {len(checkpoint.errors)}
+      Throughput: {checkpoint.throughput():.1f} records/minute</small>"""
+
+
+async def run_batch(workflow, chat_gpt_instance, marc_file, concurrency=4):
+    if not isinstance(workflow, MARC21toFOLIO):
+        alert("Batch loading needs the MARC21 to FOLIO workflow")
+        return
+    if chat_gpt_instance is None or marc_file.element.files.length < 1:
+        alert("Batch loading needs a ChatGPT key and a MARC file")
+        return
+    await require("pymarc")
+    from marc import read_records
+
+    marc_file_item = marc_file.element.files.item(0)
+    checkpoint = BatchCheckpoint(
+        f"{marc_file_item.name}:{marc_file_item.size}:{marc_file_item.lastModified}",
+        on_progress=_batch_progress,
+    )
+    chat_gpt_instance.workflow_name = workflow.name
+    add_history(f"Batch loading {marc_file_item.name}", "prompt")
+    await workflow.run_batch(
+        chat_gpt_instance,
+        read_records(marc_file_item),
+        checkpoint,
+        concurrency=concurrency,
+    )
+    _batch_progress(checkpoint)
+    for offset, error in checkpoint.errors.items():
+        add_history({"error": f"Record at {offset}", "message": error}, "error")
 
 
 def new_example():
@@ -190,10 +244,14 @@ async def run_prompt(workflow, chat_gpt_instance):
         workflow.zero_shot = False
         workflow.examples = examples
   
+    chat_gpt_instance.workflow_name = workflow.name
     system = await workflow.system()
     await chat_gpt_instance.set_system(system)
     current = main_chat_textarea.value
     if len(current) > 0:
+        vector_stores = checked_stores()
+        if len(vector_stores) > 0:
+            current = await with_context(chat_gpt_instance, current, vector_stores)
         run_result = await workflow.run(chat_gpt_instance, current)
         loading_spinner.classList.add("d-none")
 
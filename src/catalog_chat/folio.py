@@ -2,17 +2,21 @@ import asyncio
 import datetime
 import io
 import json
+import time
 import uuid
 
-import pymarc
 
+from collections import deque
 from typing import Optional
 from pydantic import BaseModel
 from pyodide.http import pyfetch
 
-from js import console, document, JSON, Headers, sessionStorage, alert
+from js import console, document, JSON, Headers, sessionStorage
 
 from chat import add_history
+from history import history_view
+from loader import require
+from vectors import remember
 
 
 class Okapi(BaseModel):
@@ -20,42 +24,162 @@ class Okapi(BaseModel):
     url: str = ""
     tenant: str = ""
     token: str = ""
+    # Set when logged in through /authn/login-with-expiry, tokens are then cookies
+    cookie_auth: bool = False
 
     def headers(self):
-        return {
+        headers = {
             "Content-type": "application/json",
-            "x-okapi-token": self.token,
             "x-okapi-tenant": self.tenant,
         }
+        if self.token:
+            headers["x-okapi-token"] = self.token
+        return headers
+
+
+class OkapiClient(object):
+    """Holds parsed Okapi credentials, caps in-flight requests, refreshes the
+    token on 401, and records request timings"""
+
+    def __init__(self, okapi: Okapi, max_in_flight=6):
+        self.okapi = okapi
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        # Username and password are only kept in memory, to log in again on 401
+        self.credentials = None
+        self.refreshing = None
+        self.timings = deque(maxlen=500)
+
+    def _fetch_kwargs(self, kwargs: dict) -> dict:
+        kwargs.setdefault("mode", "cors")
+        if self.okapi.cookie_auth:
+            kwargs["credentials"] = "include"
+        return kwargs
+
+    async def login(self, username, password) -> bool:
+        self.credentials = {"username": username, "password": password}
+        kwargs = self._fetch_kwargs(
+            {
+                "method": "POST",
+                "headers": {
+                    "Content-type": "application/json",
+                    "x-okapi-tenant": self.okapi.tenant,
+                },
+                "body": json.dumps(self.credentials),
+                "credentials": "include",
+            }
+        )
+        login_response = await pyfetch(
+            f"{self.okapi.url}/authn/login-with-expiry", **kwargs
+        )
+        if login_response.status != 404:
+            self.okapi.cookie_auth = login_response.ok
+            self.okapi.token = ""
+        else:
+            # Older FOLIO releases only have the non-expiring token endpoint
+            kwargs.pop("credentials")
+            login_response = await pyfetch(f"{self.okapi.url}/authn/login", **kwargs)
+            if login_response.ok:
+                login_json = await login_response.json()
+                self.okapi.cookie_auth = False
+                self.okapi.token = login_json.get(
+                    "okapiToken", login_response.js_response.headers.get("x-okapi-token")
+                )
+        if login_response.ok:
+            sessionStorage.setItem("okapi", self.okapi.json())
+        return login_response.ok
+
+    async def _refresh(self) -> bool:
+        if self.okapi.cookie_auth:
+            response = await pyfetch(
+                f"{self.okapi.url}/authn/refresh",
+                **self._fetch_kwargs(
+                    {"method": "POST", "headers": {"x-okapi-tenant": self.okapi.tenant}}
+                ),
+            )
+            if response.ok:
+                return True
+        if self.credentials is None:
+            return False
+        return await self.login(**self.credentials)
+
+    async def refresh(self) -> bool:
+        # Requests failing at the same time share one refresh
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self._refresh())
+        try:
+            return await asyncio.shield(self.refreshing)
+        finally:
+            self.refreshing = None
+
+    async def request(self, path, method="GET", body=None, headers=None):
+        """Sends a request to Okapi, retrying once after refreshing an expired token"""
+        for attempt in range(2):
+            request_headers = self.okapi.headers()
+            if headers is not None:
+                request_headers.update(headers)
+            kwargs = self._fetch_kwargs({"method": method, "headers": request_headers})
+            if body is not None:
+                kwargs["body"] = body
+            queued_at = time.monotonic()
+            async with self.semaphore:
+                started = time.monotonic()
+                response = await pyfetch(f"{self.okapi.url}{path}", **kwargs)
+                self.timings.append(
+                    {
+                        "method": method,
+                        "path": path.split("?")[0],
+                        "status": response.status,
+                        "queued": started - queued_at,
+                        "seconds": time.monotonic() - started,
+                    }
+                )
+            if response.status != 401 or attempt > 0 or not await self.refresh():
+                return response
+
+    def stats(self) -> dict:
+        durations = sorted(row["seconds"] for row in self.timings)
+        if len(durations) < 1:
+            return {"requests": 0}
+        return {
+            "requests": len(durations),
+            "mean": sum(durations) / len(durations),
+            "p95": durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+            "queued": sum(row["queued"] for row in self.timings),
+        }
+
+
+class FOLIOLoginError(Exception):
+    """No Okapi credentials, the user has not logged into FOLIO"""
+
+
+_client = None
+
+
+def get_client() -> OkapiClient:
+    """Returns the shared Okapi client, parsing the stored credentials only once"""
+    global _client
+    if _client is None:
+        existing_okapi = sessionStorage.getItem("okapi")
+        if existing_okapi is None:
+            raise FOLIOLoginError("Missing Okapi, log into FOLIO first")
+        _client = OkapiClient(Okapi.parse_obj(json.loads(existing_okapi)))
+    return _client
 
 
 async def error_card(errors, okapi):
-    prompt_history = document.getElementById("chat-history")
+    ident = uuid.uuid4()
     created_at = datetime.datetime.utcnow()
-    card_html = f"""<div id="{uuid.uuid4()}" class="card mb-3">
+    card_html = f"""<div id="{ident}" class="card mb-3">
       <div class="card-header text-bg-danger">
         FOLIO Errors Response  at {created_at.isoformat()} 
       </div>
       <div class="card-body">"""
     for error in errors:
-        card_html += f"\n<pre>{JSON.stringify(error, None, 4)}</pre>"
-    card_html += """</div>
-      <div class="card-footer">FOLIO server {okapi.folio} Okapi API {okapi.urll}</div>
+        card_html += f"\n<pre>{json.dumps(error, indent=4)}</pre>"
+    card_html += f"""</div>
+      <div class="card-footer">FOLIO server {okapi.folio} Okapi API {okapi.url}</div>
     </div>"""
-    row_div = document.createElement("div")
-    if prompt_history.hasChildNodes():
-        prompt_history.insertBefore(row_div, prompt_history.firstChild)
-    else:
-        prompt_history.appendChild(row_div)
-
-
-def _get_okapi():
-    existing_okapi = sessionStorage.getItem("okapi")
-    if existing_okapi is None:
-        alert("Missing Okapi")
-        return None
-
-    return Okapi.parse_obj(json.loads(existing_okapi))
+    history_view.add(ident, card_html)
 
 
 def services():
@@ -83,6 +207,7 @@ def services():
 
 
 async def login(okapi: Okapi):
+    global _client
     okapi_url = document.getElementById("okapiURI")
     tenant = document.getElementById("folioTenant")
 
@@ -94,93 +219,241 @@ async def login(okapi: Okapi):
     okapi.tenant = tenant.value
     okapi.folio = folio_url.value
 
-    headers = {"Content-type": "application/json", "x-okapi-tenant": okapi.tenant}
-
-    payload = {"username": user.value, "password": password.value}
-
-    kwargs = {
-        "method": "POST",
-        "headers": headers,
-        "mode": "cors",
-        "body": json.dumps(payload),
-    }
-
-    login_response = await pyfetch(f"{okapi.url}/authn/login", **kwargs)
-
-    login_json = await login_response.json()
-
-    okapi.token = login_json["okapiToken"]
+    client = OkapiClient(okapi)
+    logged_in = await client.login(user.value, password.value)
 
-    if login_response.ok:
+    if logged_in:
+        _client = client
         folio_button = document.getElementById("folioButton")
         folio_button.classList.remove("btn-outline-danger")
         folio_button.classList.add("btn-outline-success")
         default_folio = document.getElementById("folio-default")
         if not "d-none" in default_folio.classList:
             default_folio.classList.add("d-none")
-        sessionStorage.setItem("okapi", okapi.json())
         services()
     else:
-        console.log(f"Failed to log into Okapi {login_response}")
+        console.log(f"Failed to log into Okapi {okapi.url}")
+    return logged_in
 
 
 async def load_marc_record(marc_file):
-    if marc_file.element.files.length > 0:
-        marc_file_item = marc_file.element.files.item(0)
-        marc_binary = await marc_file_item.text()
-        marc_reader = pymarc.MARCReader(
-            io.BytesIO(bytes(marc_binary, encoding="utf-8"))
-        )
-        marc_record = next(marc_reader)
-        return str(marc_record)
+    await require("pymarc")
+    from marc import load_first_record
 
+    return await load_first_record(marc_file)
 
-async def get_instance(okapi, uuid):
-    kwargs = {"headers": okapi.headers()}
 
-    instance_response = await pyfetch(
-        f"{okapi.url}/instance-storage/instances/{uuid}", **kwargs
+def _remember_instance(instance: dict):
+    """Title, contributors and subjects of an Instance for the FOLIO vector store"""
+    contributors = "; ".join(row.get("name", "") for row in instance.get("contributors", []))
+    subjects = "; ".join(
+        row.get("value", "") if isinstance(row, dict) else row
+        for row in instance.get("subjects", [])
+    )
+    remember(
+        "folio",
+        instance["id"],
+        f"{instance.get('title', '')} | {contributors} | {subjects} | id {instance['id']}",
     )
 
+
+async def get_instance(uuid):
+    client = get_client()
+    instance_response = await client.request(f"/instance-storage/instances/{uuid}")
+
     if instance_response.ok:
         instance = await instance_response.json()
+        _remember_instance(instance)
         return instance
     else:
         print(f"ERROR retrieving {uuid} {instance_response}")
 
 
 async def add_instance(record):
-    okapi = _get_okapi()
-    kwargs = {
-        "method": "POST",
-        "headers": okapi.headers(),
-        "mode": "cors",
-        "body": record,
-    }
+    client = get_client()
     # console.log(f"Add Instance kwargs {kwargs}")
-    instance_response = await pyfetch(
-        f"{okapi.url}/instance-storage/instances", **kwargs
+    instance_response = await client.request(
+        "/instance-storage/instances", method="POST", body=record
     )
     if instance_response.ok:
         instance = await instance_response.json()
         console.log(f"Added record with uuid of {instance['id']}")
-        return f"""{okapi.folio}/inventory/view/{instance["id"]}"""
+        _remember_instance(instance)
+        return f"""{client.okapi.folio}/inventory/view/{instance["id"]}"""
     else:
         console.log(f"Error adding {instance_response}")
-        await error_card(instance_response.json()["errors"], okapi)
+        error_json = await instance_response.json()
+        await error_card(error_json.get("errors", []), client.okapi)
         return instance_response
 
 
+async def _add_single(client, record: dict, upsert: bool) -> dict:
+    try:
+        if upsert:
+            # PUT creates or replaces the Instance with the record's id
+            response = await client.request(
+                f"/instance-storage/instances/{record['id']}", method="PUT", body=json.dumps(record)
+            )
+        else:
+            response = await client.request(
+                "/instance-storage/instances", method="POST", body=json.dumps(record)
+            )
+    except OSError as error:
+        return {"id": record.get("id"), "ok": False, "error": str(error)}
+    if response.ok:
+        return {"id": record["id"], "ok": True, "error": None}
+    # The body can only be read once, error pages are not always JSON
+    try:
+        body = await response.string()
+    except OSError as error:
+        body = f"{response.status} {error}"
+    try:
+        error = json.loads(body)
+    except ValueError:
+        error = body
+    return {"id": record.get("id"), "ok": False, "error": error}
+
+
+async def _add_chunk(client, chunk: list, upsert: bool) -> list:
+    """A result for every record in the chunk, a failed record never fails the others"""
+    try:
+        response = await client.request(
+            f"/instance-storage/batch/synchronous?upsert={str(upsert).lower()}",
+            method="POST",
+            body=json.dumps({"instances": chunk}),
+        )
+    except OSError as error:
+        response = None
+        console.log(f"Batch of {len(chunk)} failed with {error}, posting singly")
+    if response is not None and response.ok:
+        return [{"id": record["id"], "ok": True, "error": None} for record in chunk]
+    # The batch endpoint is all-or-nothing, retry record by record to find failures
+    if response is not None:
+        console.log(f"Batch of {len(chunk)} failed with {response.status}, posting singly")
+    return await asyncio.gather(*[_add_single(client, record, upsert) for record in chunk])
+
+
+async def add_instances(records: list, chunk_size=500, upsert=True) -> list:
+    """Creates Instances in chunks through the synchronous batch endpoint, returns
+    a result for each record in order"""
+    client = get_client()
+    for record in records:
+        # Ids are assigned up front so results can be reported per record
+        record.setdefault("id", str(uuid.uuid4()))
+    chunks = [
+        records[start : start + chunk_size]
+        for start in range(0, len(records), chunk_size)
+    ]
+    chunk_results = await asyncio.gather(
+        *[_add_chunk(client, chunk, upsert) for chunk in chunks]
+    )
+    results = []
+    for chunk_result in chunk_results:
+        for result in chunk_result:
+            if result["ok"]:
+                result["url"] = f"{client.okapi.folio}/inventory/view/{result['id']}"
+            results.append(result)
+    failed = [result for result in results if not result["ok"]]
+    console.log(f"Added {len(results) - len(failed)} of {len(results)} instances")
+    if len(failed) > 0:
+        try:
+            await error_card([result["error"] for result in failed], client.okapi)
+        except Exception as error:
+            # The per-record results still have to reach the caller's checkpoint
+            console.log(f"Error card failed {error}")
+    return results
+
+
+def _latest_update(rows: list) -> str:
+    return max([row.get("metadata", {}).get("updatedDate", "") for row in rows] + [""])
+
+
+class ReferenceDataCache(object):
+    """FOLIO reference data shared by all workflow instances, scoped per tenant
+    and revalidated by ETag or metadata.updatedDate once the TTL expires"""
+
+    storage_key = "folio_reference_data"
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.entries = json.loads(sessionStorage.getItem(self.storage_key) or "{}")
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def _save(self):
+        sessionStorage.setItem(self.storage_key, json.dumps(self.entries))
+
+    async def _unchanged_since(self, client, endpoint, type_key, updated) -> bool:
+        path = endpoint.split("?")[0]
+        query = "cql.allRecords%3D1%20sortBy%20metadata.updatedDate%2Fsort.descending"
+        response = await client.request(f"{path}?limit=1&query={query}")
+        if not response.ok:
+            return False
+        latest = await response.json()
+        return _latest_update(latest.get(type_key, [])) <= updated
+
+    async def _fetch(self, client, endpoint, type_key, key) -> dict:
+        entry = self.entries.get(key)
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            elif await self._unchanged_since(client, endpoint, type_key, entry["updated"]):
+                headers = None
+        response = None
+        if headers is not None:
+            response = await client.request(endpoint, headers=headers)
+        if response is None or response.status == 304:
+            self.revalidated += 1
+            entry["fetched"] = time.time()
+            self._save()
+            return entry["data"]
+        self.misses += 1
+        if not response.ok:
+            return {}
+        data = await response.json()
+        self.entries[key] = {
+            "fetched": time.time(),
+            "etag": response.js_response.headers.get("etag"),
+            "updated": _latest_update(data.get(type_key, [])),
+            "data": data,
+        }
+        self._save()
+        return data
+
+    async def get(self, client, endpoint, type_key) -> dict:
+        key = f"{client.okapi.url}|{client.okapi.tenant}|{endpoint}"
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry["fetched"] < self.ttl:
+            self.hits += 1
+            return entry["data"]
+        # Concurrent requests for the same reference data share one fetch
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(
+                self._fetch(client, endpoint, type_key, key)
+            )
+        try:
+            return await asyncio.shield(self.inflight[key])
+        finally:
+            self.inflight.pop(key, None)
+
+    def clear(self):
+        self.entries = {}
+        self._save()
+
+
+reference_data = ReferenceDataCache()
+
+
 async def get_types(endpoint, selected_types, type_key, name_key="name"):
-    okapi = _get_okapi()
-    kwargs = {"headers": okapi.headers()}
+    client = get_client()
     output = {}
-    type_response = await pyfetch(f"{okapi.url}{endpoint}", **kwargs)
-    if type_response.ok:
-        types = await type_response.json()
-        for row in types.get(type_key, []):
-            if row[name_key] in selected_types:
-                output[row[name_key]] = row["id"]
+    types = await reference_data.get(client, endpoint, type_key)
+    for row in types.get(type_key, []):
+        if row[name_key] in selected_types:
+            output[row[name_key]] = row["id"]
     return output
 
 
@@ -199,6 +472,14 @@ async def get_contributor_types() -> dict:
     return output
 
 
+async def get_classification_types() -> dict:
+    selected_types = ["Dewey", "LC", "NLM", "SUDOC", "UDC"]
+    output = await get_types(
+        "/classification-types?limit=500", selected_types, "classificationTypes"
+    )
+    return output
+
+
 async def get_contributor_name_types() -> dict:
     selected_types = ["Personal name", "Corporate name"]
     output = await get_types(
@@ -240,6 +521,8 @@ def load_instance(url):
 
 
 def logout_folio():
+    global _client
+    _client = None
     modal_body = document.getElementById("folioModalBody")
     modal_label = document.getElementById("folioModalLabel")
     modal_label.innerHTML = "Login to FOLIO"
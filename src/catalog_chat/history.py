@@ -0,0 +1,189 @@
+"""
+Virtualized chat history panel that keeps cards as data and only renders a window
+"""
+import re
+
+from js import document, window
+
+from pyodide.ffi import create_proxy
+
+pre_re = re.compile(r"<pre>(.*?)</pre>", re.DOTALL)
+
+
+class HistoryView(object):
+    def __init__(
+        self, element_id="chat-history", window_size=40, preview_lines=15, card_height=180
+    ):
+        self.element_id = element_id
+        self.window_size = window_size
+        # Larger <pre> payloads (MARC, JSON, Turtle) are collapsed to this many lines
+        self.preview_lines = preview_lines
+        # Running estimate of a card's height in pixels, used to size the spacers
+        self.card_height = card_height
+        self.scroll_threshold = 200
+        self.cards = []
+        self.by_id = {}
+        self.start = 0
+        self.prepended = 0
+        self.updated = set()
+        self.dirty = False
+        self.frame_requested = False
+        self.container = None
+
+    def _bind(self):
+        container = document.getElementById(self.element_id)
+        if container != self.container:
+            self.container = container
+            container.addEventListener("scroll", create_proxy(self._on_scroll))
+            container.addEventListener("click", create_proxy(self._on_click))
+            self.frame_proxy = create_proxy(self._flush)
+            self._reset()
+        return container
+
+    def _reset(self):
+        self.top_spacer = document.createElement("div")
+        self.bottom_spacer = document.createElement("div")
+        self.container.innerHTML = ""
+        self.container.appendChild(self.top_spacer)
+        self.container.appendChild(self.bottom_spacer)
+        self.dirty = True
+
+    def _request_frame(self):
+        self._bind()
+        if not self.frame_requested:
+            self.frame_requested = True
+            window.requestAnimationFrame(self.frame_proxy)
+
+    def _collapse(self, card: dict) -> str:
+        payloads = []
+
+        def collapse_pre(match):
+            content = match.group(1)
+            index = len(payloads)
+            payloads.append(content)
+            lines = content.splitlines()
+            if len(lines) <= self.preview_lines or index in card["expanded"]:
+                return match.group(0)
+            preview = "\n".join(lines[: self.preview_lines])
+            return f"""<pre>{preview}</pre><button class="btn btn-sm btn-link"
+              data-expand="{card['id']}:{index}">Show all {len(lines)} lines</button>"""
+
+        html = pre_re.sub(collapse_pre, card["html"])
+        card["payloads"] = payloads
+        return html
+
+    def _node(self, card: dict):
+        row_div = document.createElement("div")
+        row_div.setAttribute("data-card-id", card["id"])
+        row_div.innerHTML = self._collapse(card)
+        return row_div
+
+    def _visible(self) -> int:
+        return min(self.window_size, len(self.cards) - self.start)
+
+    def has(self, ident) -> bool:
+        return str(ident) in self.by_id
+
+    def add(self, ident, html: str):
+        """Adds a card to the top of the history"""
+        card = {"id": str(ident), "html": html, "expanded": set(), "payloads": []}
+        self.cards.insert(0, card)
+        self.by_id[card["id"]] = card
+        if self.start > 0:
+            # Reader is scrolled into older cards, keep their window in place
+            self.start += 1
+        else:
+            self.prepended += 1
+        self._request_frame()
+
+    def update(self, ident, html: str):
+        card = self.by_id[str(ident)]
+        card["html"] = html
+        self.updated.add(card["id"])
+        self._request_frame()
+
+    def clear(self):
+        self.cards = []
+        self.by_id = {}
+        self.start = 0
+        self.prepended = 0
+        self.updated = set()
+        self._bind()
+        self._reset()
+
+    def _card_nodes(self) -> list:
+        nodes = []
+        node = self.top_spacer.nextSibling
+        while node is not None and node != self.bottom_spacer:
+            nodes.append(node)
+            node = node.nextSibling
+        return nodes
+
+    def _flush(self, *args):
+        self.frame_requested = False
+        container = self._bind()
+        if self.dirty:
+            for node in self._card_nodes():
+                container.removeChild(node)
+            fragment = document.createDocumentFragment()
+            for card in self.cards[self.start : self.start + self.window_size]:
+                fragment.appendChild(self._node(card))
+            container.insertBefore(fragment, self.bottom_spacer)
+            self.dirty = False
+        elif self.prepended > 0:
+            fragment = document.createDocumentFragment()
+            for card in self.cards[: self.prepended]:
+                fragment.appendChild(self._node(card))
+            container.insertBefore(fragment, self.top_spacer.nextSibling)
+            for node in self._card_nodes()[self.window_size :]:
+                container.removeChild(node)
+        self.prepended = 0
+        for ident in self.updated:
+            node = container.querySelector(f'[data-card-id="{ident}"]')
+            if node is not None:
+                node.innerHTML = self._collapse(self.by_id[ident])
+        self.updated = set()
+        self._resize_spacers()
+
+    def _resize_spacers(self):
+        nodes = self._card_nodes()
+        if len(nodes) > 0:
+            rendered_height = sum(node.offsetHeight for node in nodes)
+            if rendered_height > 0:
+                self.card_height = rendered_height / len(nodes)
+        below = len(self.cards) - self.start - self._visible()
+        self.top_spacer.style.height = f"{int(self.start * self.card_height)}px"
+        self.bottom_spacer.style.height = f"{int(max(below, 0) * self.card_height)}px"
+
+    def _on_scroll(self, event):
+        container = self.container
+        step = max(self.window_size // 2, 1)
+        top = container.scrollTop
+        window_top = self.start * self.card_height
+        window_bottom = window_top + self._visible() * self.card_height
+        if (
+            top + container.clientHeight > window_bottom - self.scroll_threshold
+            and self.start + self.window_size < len(self.cards)
+        ):
+            self.start = min(self.start + step, len(self.cards) - self.window_size)
+            self.dirty = True
+        elif top < window_top + self.scroll_threshold and self.start > 0:
+            self.start = max(self.start - step, 0)
+            self.dirty = True
+        if self.dirty:
+            self._request_frame()
+
+    def _on_click(self, event):
+        key = event.target.getAttribute("data-expand")
+        if key is None:
+            return
+        ident, index = key.rsplit(":", 1)
+        card = self.by_id.get(ident)
+        if card is None:
+            return
+        card["expanded"].add(int(index))
+        event.target.previousElementSibling.innerHTML = card["payloads"][int(index)]
+        event.target.remove()
+
+
+history_view = HistoryView()
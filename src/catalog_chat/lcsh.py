@@ -0,0 +1,339 @@
+"""
+Library of Congress Subject Heading lookups, through the id.loc.gov suggest
+service and a local index of the id.loc.gov bulk export
+"""
+import asyncio
+import bisect
+import codecs
+import difflib
+import json
+import re
+import time
+import unicodedata
+import zlib
+
+from array import array
+from urllib.parse import quote
+
+from js import console
+
+from pyodide.http import pyfetch
+
+from vectors import remember
+
+SUGGEST_URL = "https://id.loc.gov/authorities/subjects/suggest2"
+SUBJECTS_URI = "http://id.loc.gov/authorities/subjects/"
+# Line-delimited MADS/RDF or SKOS JSON-LD export from id.loc.gov/download/,
+# gzipped exports are decompressed as they stream in
+EXPORT_URL = "lcsh/subjects.madsrdf.jsonld.gz"
+
+AUTHORIZED_PROPERTIES = ["authoritativeLabel", "prefLabel"]
+VARIANT_PROPERTIES = ["variantLabel", "altLabel"]
+
+punctuation_re = re.compile(r"[^\w\s-]")
+# An unspaced en dash is a hyphen, e.g. 1914–1918
+subdivision_re = re.compile(r"\s*(?:--|—)\s*|\s+–\s+")
+space_re = re.compile(r"\s+")
+# Numbering, bullets, and URIs around headings in model output
+heading_line_re = re.compile(r"^\s*(?:[-*•]|\d+[.)])?\s*(.+?)\s*(?:[(<]?https?://\S+)?\s*$")
+
+
+def normalize(heading: str) -> str:
+    """Case, diacritic, and punctuation folded heading with -- subdivisions"""
+    folded = unicodedata.normalize("NFKD", heading)
+    folded = "".join(char for char in folded if not unicodedata.combining(char))
+    parts = [
+        space_re.sub(" ", punctuation_re.sub(" ", part.replace("–", "-"))).strip()
+        for part in subdivision_re.split(folded.casefold())
+    ]
+    return "--".join(part for part in parts if part)
+
+
+def _values(node: dict, properties: list) -> list:
+    output = []
+    for key, value in node.items():
+        if key.rsplit(":", 1)[-1].rsplit("#", 1)[-1].rsplit("/", 1)[-1] not in properties:
+            continue
+        for row in value if isinstance(value, list) else [value]:
+            if isinstance(row, dict):
+                if row.get("@language", "en") != "en":
+                    continue
+                row = row.get("@value")
+            if isinstance(row, str):
+                output.append(row)
+    return output
+
+
+class LCSHIndex(object):
+    """Sorted normalized authorized and variant labels, each pointing to its
+    authorized heading, searched with bisect"""
+
+    def __init__(self):
+        self.labels = []
+        # Record ids, e.g. sh85021262, the URI is SUBJECTS_URI + id
+        self.ids = []
+        self.keys = []
+        # Heading position for each key, negative for a variant label
+        self.targets = array("i")
+        # (key, -target) rows added since the last build, sorting them puts
+        # authorized labels before variants of the same key
+        self._pending = []
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add_records(self, lines):
+        """Adds the authorities in export lines, call build() when done"""
+        for line in lines:
+            line = line.strip()
+            if len(line) < 1:
+                continue
+            record = json.loads(line)
+            nodes = record.get("@graph", [record])
+            authority, variants = None, []
+            for node in nodes:
+                node_id = node.get("@id", "")
+                labels = _values(node, AUTHORIZED_PROPERTIES)
+                if node_id.startswith(SUBJECTS_URI) and len(labels) > 0 and authority is None:
+                    authority = (node_id[len(SUBJECTS_URI) :], labels[0])
+                variants.extend(_values(node, VARIANT_PROPERTIES))
+            if authority is None:
+                continue
+            position = len(self.labels)
+            self.ids.append(authority[0])
+            self.labels.append(authority[1])
+            self._pending.append((normalize(authority[1]), -(position + 1)))
+            for variant in variants:
+                self._pending.append((normalize(variant), position + 1))
+
+    def build(self):
+        """Sorts the keys, authorized labels before variants of the same key"""
+        self._pending.sort()
+        self.keys = [row[0] for row in self._pending]
+        self.targets = array("i", (-row[1] for row in self._pending))
+        self._pending = []
+
+    def _heading(self, row: int) -> dict:
+        target = self.targets[row]
+        position = abs(target) - 1
+        return {
+            "label": self.labels[position],
+            "uri": f"{SUBJECTS_URI}{self.ids[position]}",
+            "variant": target < 0,
+        }
+
+    def exact(self, heading: str):
+        key = normalize(heading)
+        row = bisect.bisect_left(self.keys, key)
+        if row < len(self.keys) and self.keys[row] == key:
+            return self._heading(row)
+        return None
+
+    def prefix(self, text: str, limit=10) -> list:
+        """Authorized headings whose label or variant starts with the text"""
+        key = normalize(text)
+        row = bisect.bisect_left(self.keys, key)
+        output, seen = [], set()
+        while row < len(self.keys) and self.keys[row].startswith(key) and len(output) < limit:
+            heading = self._heading(row)
+            if heading["uri"] not in seen:
+                seen.add(heading["uri"])
+                output.append(heading)
+            row += 1
+        return output
+
+    def fuzzy(self, text: str, limit=5, cutoff=0.8, window=100) -> list:
+        """Closest headings among the keys sorted around the text, as
+        (score, heading) pairs"""
+        key = normalize(text)
+        row = bisect.bisect_left(self.keys, key)
+        matcher = difflib.SequenceMatcher(b=key, autojunk=False)
+        scored = {}
+        for candidate in range(max(row - window, 0), min(row + window, len(self.keys))):
+            matcher.set_seq1(self.keys[candidate])
+            if matcher.real_quick_ratio() < cutoff or matcher.quick_ratio() < cutoff:
+                continue
+            score = matcher.ratio()
+            if score < cutoff:
+                continue
+            heading = self._heading(candidate)
+            if score > scored.get(heading["uri"], (0.0, None))[0]:
+                scored[heading["uri"]] = (score, heading)
+        return sorted(scored.values(), key=lambda row: row[0], reverse=True)[:limit]
+
+    def check(self, heading: str) -> dict:
+        """Status of a heading: authorized, variant, subdivided (authorized main
+        heading), fuzzy, or unknown, with its authorized form and a score"""
+        output = {"heading": heading, "status": "unknown", "authorized": None, "uri": None, "score": 0.0}
+        match = self.exact(heading)
+        if match is not None:
+            output.update(
+                status="variant" if match["variant"] else "authorized",
+                authorized=match["label"],
+                uri=match["uri"],
+                score=0.9 if match["variant"] else 1.0,
+            )
+            return output
+        parts = normalize(heading).split("--")
+        if len(parts) > 1:
+            main = self.exact(parts[0])
+            if main is not None:
+                subdivisions = subdivision_re.split(heading.strip())[1:]
+                output.update(
+                    status="subdivided",
+                    authorized="--".join([main["label"]] + subdivisions),
+                    uri=main["uri"],
+                    score=0.8,
+                )
+                return output
+        closest = self.fuzzy(heading, limit=1)
+        if len(closest) > 0:
+            score, match = closest[0]
+            output.update(
+                status="fuzzy", authorized=match["label"], uri=match["uri"], score=0.7 * score
+            )
+        return output
+
+    def validate(self, headings: list) -> list:
+        """Checked headings ranked by score, best first"""
+        return sorted(
+            [self.check(heading) for heading in headings],
+            key=lambda row: row["score"],
+            reverse=True,
+        )
+
+
+_index_task = None
+
+
+async def _export_lines(response):
+    """Lines of the export as it downloads, gunzipped when it starts with the
+    gzip magic number, without holding the whole file in memory"""
+    reader = response.js_response.body.getReader()
+    decompressor = None
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    while True:
+        chunk = await reader.read()
+        if chunk.done:
+            break
+        data = chunk.value.to_bytes()
+        if decompressor is None:
+            # wbits 31 is a gzip stream, servers that send Content-Encoding gzip
+            # arrive already decompressed
+            decompressor = zlib.decompressobj(31) if data[:2] == b"\x1f\x8b" else False
+        if decompressor:
+            data = decompressor.decompress(data)
+        lines = (tail + decoder.decode(data)).split("\n")
+        tail = lines.pop()
+        yield lines
+    if decompressor:
+        tail += decoder.decode(decompressor.flush())
+    yield [tail + decoder.decode(b"", final=True)]
+
+
+async def _load_index(url: str):
+    start = time.monotonic()
+    response = await pyfetch(url)
+    if not response.ok:
+        console.log(f"No LCSH export at {url}, using id.loc.gov suggest only")
+        return None
+    index = LCSHIndex()
+    async for lines in _export_lines(response):
+        index.add_records(lines)
+        # Let the page render and other tasks run between downloaded chunks
+        await asyncio.sleep(0)
+    indexed = time.monotonic()
+    index.build()
+    console.log(
+        f"LCSH index {len(index)} headings {len(index.keys)} labels, download and parse {indexed - start:.1f}s sort {time.monotonic() - indexed:.1f}s"
+    )
+    return index
+
+
+def load_index(url=EXPORT_URL):
+    """Starts loading the local index, again after a failed or cancelled load,
+    and returns the task, its result is None when there is no export"""
+    global _index_task
+    if _index_task is None or (
+        _index_task.done() and (_index_task.cancelled() or _index_task.exception() is not None)
+    ):
+        _index_task = asyncio.ensure_future(_load_index(url))
+    return _index_task
+
+
+def loaded_index():
+    """The LCSHIndex if it has finished loading, without waiting"""
+    task = load_index()
+    if not task.done():
+        return None
+    return task.result()
+
+
+async def get_index():
+    """Waits for the LCSHIndex, None without an export or when loading failed.
+    A caller timing out does not cancel the shared load"""
+    task = load_index()
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return None
+        raise
+    except Exception as error:
+        console.log(f"LCSH index failed to load: {error}")
+        return None
+
+
+def candidate_headings(text: str) -> list:
+    """Heading strings from the model's answer, one per line or ; separated"""
+    output = []
+    for line in text.replace(";", "\n").splitlines():
+        heading = heading_line_re.match(line)
+        if heading is not None and len(heading.group(1)) > 1:
+            output.append(heading.group(1).strip(" .:"))
+    return output
+
+
+async def suggest(text: str, count=5) -> list:
+    """Headings from the id.loc.gov suggest service as label and uri dicts"""
+    response = await pyfetch(f"{SUGGEST_URL}?q={quote(text.strip())}&count={count}")
+    if not response.ok:
+        return []
+    result = await response.json()
+    headings = [{"label": hit["aLabel"], "uri": hit["uri"]} for hit in result.get("hits", [])]
+    for heading in headings:
+        remember("lcsh", heading["uri"], heading["label"])
+    return headings
+
+
+async def search(text: str, count=5) -> list:
+    """Local prefix and fuzzy matches when the index is loaded, otherwise the
+    suggest service"""
+    index = loaded_index()
+    if index is None:
+        return await suggest(text, count)
+    headings = [
+        {"label": row["label"], "uri": row["uri"]} for row in index.prefix(text, limit=count)
+    ]
+    for score, row in index.fuzzy(text, limit=count):
+        if len(headings) < count and all(row["uri"] != heading["uri"] for heading in headings):
+            headings.append({"label": row["label"], "uri": row["uri"]})
+    if len(headings) < 1:
+        return await suggest(text, count)
+    for heading in headings:
+        remember("lcsh", heading["uri"], heading["label"])
+    return headings
+
+
+async def validate(text: str, timeout=None) -> list:
+    """Checks the headings in text against the local index, waiting at most
+    timeout seconds for it to load, or until it loads when None"""
+    try:
+        index = await asyncio.wait_for(get_index(), timeout)
+    except asyncio.TimeoutError:
+        console.log("LCSH index still loading, headings not validated")
+        return []
+    if index is None:
+        return []
+    return index.validate(candidate_headings(text))
@@ -0,0 +1,196 @@
+"""
+Module bundle loading, on-demand installs of the heavier packages and a
+startup timing report
+"""
+import asyncio
+import hashlib
+import importlib
+import json
+import statistics
+import sys
+import time
+
+from js import caches, console, document, fetch, localStorage, performance
+
+from pyodide.http import pyfetch
+
+BUNDLE_DIR = "bundles"
+BUNDLE_CACHE = "catalog-chat-bundles"
+SOURCE_DIR = "src/catalog_chat"
+
+# Fetched one by one when no bundle has been built
+MODULES = [
+    "agent.py", "backends.py", "cache.py", "chat.py", "context.py", "controls.py",
+    "folio.py", "github.py", "history.py", "lcsh.py", "marc.py", "metrics.py",
+    "scheduler.py", "sinopia.py", "vectors.py", "workflows.py",
+]
+
+# Wheels installed with micropip the first time a workflow needs them
+WHEELS = {
+    "pymarc": "./wheels/pymarc-4.2.2-py3-none-any.whl",
+    "rdflib": "./wheels/rdflib-7.0.0-py3-none-any.whl",
+}
+
+WORKFLOW_PACKAGES = {
+    "bf-to-marc": ["rdflib"],
+    "marc-to-folio": ["pymarc"],
+    "transform-bf-folio": ["rdflib"],
+}
+
+
+class StartupTimer(object):
+    """Phases in milliseconds, the first phase is everything before Python runs"""
+
+    runs_key = "startup_runs"
+
+    def __init__(self):
+        self.phases = []
+        self.last = performance.now()
+        self.phases.append(("Pyodide, packages and fetch", self.last))
+        # cold, warm (bundle from the browser cache), or source (no bundle)
+        self.mode = "source"
+        self.saved = False
+
+    def mark(self, name: str):
+        now = performance.now()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def fetched(self) -> list:
+        """Network time for the fetched modules and wheels from the resource timings"""
+        output = []
+        for entry in performance.getEntriesByType("resource"):
+            if entry.name.endswith((".py", ".whl", ".zip")):
+                output.append((entry.name.rsplit("/", 1)[-1], entry.duration))
+        return output
+
+    def _save_run(self) -> dict:
+        """Keeps the last 20 time to interactive values per mode for the benchmark"""
+        runs = json.loads(localStorage.getItem(self.runs_key) or "{}")
+        if not self.saved:
+            runs.setdefault(self.mode, []).append(performance.now())
+            runs[self.mode] = runs[self.mode][-20:]
+            localStorage.setItem(self.runs_key, json.dumps(runs))
+            self.saved = True
+        return runs
+
+    def benchmark(self) -> str:
+        runs = self._save_run()
+        return ", ".join(
+            f"{mode} median {statistics.median(values):.0f} ms ({len(values)} loads)"
+            for mode, values in sorted(runs.items())
+        )
+
+    def report(self):
+        benchmark = self.benchmark()
+        rows = "".join(
+            f"<tr><td>{name}</td><td>{duration:.0f} ms</td></tr>"
+            for name, duration in self.phases
+        )
+        fetch_rows = "".join(
+            f"<tr><td>fetch {name}</td><td>{duration:.0f} ms</td></tr>"
+            for name, duration in self.fetched()
+        )
+        console.log(f"Startup {dict(self.phases)}")
+        timing_div = document.getElementById("startup-timing")
+        if timing_div is None:
+            return
+        timing_div.innerHTML = f"""<table class="table table-sm">
+          <tbody>{rows}{fetch_rows}</tbody>
+          <tfoot><tr><th>Interactive ({self.mode})</th><th>{performance.now():.0f} ms</th></tr></tfoot>
+        </table>
+        <small>{benchmark}</small>"""
+
+
+startup = StartupTimer()
+
+installed = set()
+
+
+async def _cached_bundle(url: str, refresh=False):
+    """Bundle bytes from the Cache API, the content hash in the name means a
+    cached bundle never goes stale, older bundles are removed. refresh drops
+    the cached copy and downloads it again past the HTTP cache"""
+    cache = await caches.open(BUNDLE_CACHE)
+    response = None
+    if refresh:
+        await cache.delete(url)
+    else:
+        response = await cache.match(url)
+    startup.mode = "warm"
+    if response is None:
+        startup.mode = "cold"
+        response = await fetch(url, cache="reload" if refresh else "default")
+        if not response.ok:
+            return None
+        await cache.put(url, response.clone())
+        for request in await cache.keys():
+            if not request.url.endswith(url.rsplit("/", 1)[-1]):
+                await cache.delete(request)
+    return (await response.arrayBuffer()).to_py().tobytes()
+
+
+async def _load_sources():
+    async def fetch_module(name):
+        response = await pyfetch(f"{SOURCE_DIR}/{name}")
+        if not response.ok:
+            # An error page written as name would fail later with a SyntaxError
+            raise OSError(f"Fetching {name} failed with {response.status}")
+        with open(name, "wb") as module_file:
+            module_file.write(await response.bytes())
+
+    await asyncio.gather(*[fetch_module(name) for name in MODULES])
+
+
+async def load_bundle():
+    """Adds the built module bundle to sys.path, or fetches the modules one by
+    one when no bundle was built or it can't be verified"""
+    manifest_response = await pyfetch(f"{BUNDLE_DIR}/manifest.json", cache="no-cache")
+    if manifest_response.ok:
+        manifest = await manifest_response.json()
+        url = f"{BUNDLE_DIR}/{manifest['bundle']}"
+        # A corrupt cached or partially downloaded bundle is fetched once more
+        for refresh in [False, True]:
+            data = await _cached_bundle(url, refresh)
+            if data is None:
+                break
+            if hashlib.sha256(data).hexdigest() == manifest["sha256"]:
+                with open(manifest["bundle"], "wb") as bundle_file:
+                    bundle_file.write(data)
+                sys.path.insert(0, manifest["bundle"])
+                importlib.invalidate_caches()
+                startup.mark(f"load bundle {manifest['version']}")
+                return
+            console.log(f"Bundle {manifest['bundle']} failed its checksum")
+        if data is not None:
+            # Don't keep serving the corrupt copy on the next load
+            await (await caches.open(BUNDLE_CACHE)).delete(url)
+        console.log(f"Bundle {manifest['bundle']} missing or corrupt, loading sources")
+    startup.mode = "source"
+    await _load_sources()
+    startup.mark("fetch modules")
+
+
+async def require(*packages):
+    """Installs and imports the packages not loaded yet"""
+    missing = [name for name in packages if name not in installed]
+    if len(missing) < 1:
+        return
+    import micropip
+
+    for name in missing:
+        start = time.monotonic()
+        await micropip.install(WHEELS.get(name, name))
+        installed_at = time.monotonic()
+        importlib.import_module(name)
+        installed.add(name)
+        console.log(
+            f"Loaded {name}, install {installed_at - start:.2f}s import {time.monotonic() - installed_at:.2f}s"
+        )
+        startup.phases.append((f"install {name}", (installed_at - start) * 1000))
+        startup.phases.append((f"import {name}", (time.monotonic() - installed_at) * 1000))
+    startup.report()
+
+
+async def require_workflow(workflow_slug: str):
+    await require(*WORKFLOW_PACKAGES.get(workflow_slug, []))
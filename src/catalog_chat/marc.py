@@ -0,0 +1,570 @@
+"""
+Streaming MARC readers for files uploaded in the browser
+"""
+import codecs
+import json
+import re
+
+from typing import NamedTuple, Optional
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+import pymarc
+
+from context import estimate_tokens
+
+RECORD_TERMINATOR = 0x1D
+
+# Start of a MARC-in-JSON record object, where parsing resumes after a bad record
+record_start_re = re.compile(r'\{\s*"(?:leader|fields)"')
+
+
+class MARCResult(NamedTuple):
+    # Byte offset of the record, the record number for MARCXML
+    offset: int
+    record: Optional[pymarc.Record]
+    error: Optional[str]
+
+
+class ISO2709Parser(object):
+    """Incremental ISO 2709 parser, only keeps the bytes of a partial record between chunks"""
+
+    def __init__(self, utf8_handling="replace"):
+        self.utf8_handling = utf8_handling
+        self.buffer = b""
+        # File offset of the first byte in the buffer
+        self.offset = 0
+
+    def _record(self, offset: int, data) -> MARCResult:
+        try:
+            record = pymarc.Record(
+                data=bytes(data), to_unicode=True, utf8_handling=self.utf8_handling
+            )
+        except Exception as error:
+            return MARCResult(offset, None, f"{type(error).__name__}: {error}")
+        return MARCResult(offset, record, None)
+
+    def _resync(self, view, position: int):
+        """Returns the position after the next record terminator, None if more data is needed"""
+        index = bytes(view[position:]).find(bytes([RECORD_TERMINATOR]))
+        if index < 0:
+            return None
+        return position + index + 1
+
+    def feed(self, chunk):
+        """Yields MARCResults for every complete record in the buffered data"""
+        view = memoryview(self.buffer + bytes(chunk)) if self.buffer else memoryview(chunk)
+        position = 0
+        while len(view) - position >= 5:
+            if view[position] in b"\r\n \t":
+                position += 1
+                continue
+            length = bytes(view[position : position + 5])
+            if not length.isdigit() or int(length) < 24:
+                next_position = self._resync(view, position)
+                if next_position is None:
+                    break
+                yield MARCResult(
+                    self.offset + position, None, f"Invalid record length {length!r}"
+                )
+                position = next_position
+                continue
+            length = int(length)
+            if len(view) - position < length:
+                break
+            data = view[position : position + length]
+            if data[-1] != RECORD_TERMINATOR:
+                next_position = self._resync(view, position)
+                if next_position is None:
+                    break
+                yield MARCResult(
+                    self.offset + position, None, "Record length does not match terminator"
+                )
+                position = next_position
+                continue
+            yield self._record(self.offset + position, data)
+            position += length
+        self.buffer = bytes(view[position:])
+        self.offset += position
+
+    def close(self):
+        if len(self.buffer.strip()) > 0:
+            yield MARCResult(self.offset, None, "Truncated record at end of file")
+        self.buffer = b""
+
+
+async def file_chunks(file, chunk_size=1 << 20):
+    """Reads a browser File in slices of its arrayBuffer, never the whole file at once"""
+    offset = 0
+    while offset < file.size:
+        array_buffer = await file.slice(offset, offset + chunk_size).arrayBuffer()
+        yield array_buffer.to_py()
+        offset += chunk_size
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+class MARCXMLParser(object):
+    """Incremental MARCXML parser, each record element is removed from the tree
+    once it has been converted"""
+
+    def __init__(self):
+        self.parser = XMLPullParser(events=("start", "end"))
+        self.elements = []
+        self.count = 0
+        self.failed = False
+
+    def _record(self, element) -> MARCResult:
+        offset = self.count
+        self.count += 1
+        record = pymarc.Record()
+        try:
+            for child in element:
+                tag = child.get("tag", "")
+                match _local_name(child.tag):
+                    case "leader":
+                        record.leader = child.text or ""
+                    case "controlfield":
+                        record.add_field(pymarc.Field(tag=tag, data=child.text or ""))
+                    case "datafield":
+                        subfields = []
+                        for subfield in child:
+                            subfields.extend([subfield.get("code", ""), subfield.text or ""])
+                        record.add_field(
+                            pymarc.Field(
+                                tag=tag,
+                                indicators=[child.get("ind1", " "), child.get("ind2", " ")],
+                                subfields=subfields,
+                            )
+                        )
+        except Exception as error:
+            return MARCResult(offset, None, f"{type(error).__name__}: {error}")
+        return MARCResult(offset, record, None)
+
+    def _events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                self.elements.append(element)
+                continue
+            self.elements.pop()
+            if _local_name(element.tag) == "record":
+                yield self._record(element)
+                if len(self.elements) > 0:
+                    self.elements[-1].remove(element)
+                else:
+                    element.clear()
+
+    def feed(self, chunk):
+        if self.failed:
+            return
+        try:
+            self.parser.feed(bytes(chunk))
+            yield from self._events()
+        except ParseError as error:
+            self.failed = True
+            yield MARCResult(self.count, None, f"Invalid MARCXML: {error}")
+
+    def close(self):
+        if self.failed:
+            return
+        try:
+            self.parser.close()
+            yield from self._events()
+        except ParseError as error:
+            yield MARCResult(self.count, None, f"Truncated MARCXML: {error}")
+
+
+def from_marc_json(data: dict) -> pymarc.Record:
+    """Builds a record from a MARC-in-JSON object"""
+    record = pymarc.Record()
+    record.leader = data.get("leader", record.leader)
+    for row in data.get("fields", []):
+        for tag, value in row.items():
+            if isinstance(value, str):
+                record.add_field(pymarc.Field(tag=tag, data=value))
+                continue
+            subfields = []
+            for subfield in value.get("subfields", []):
+                for code, subfield_value in subfield.items():
+                    subfields.extend([code, subfield_value])
+            record.add_field(
+                pymarc.Field(
+                    tag=tag,
+                    indicators=[value.get("ind1", " "), value.get("ind2", " ")],
+                    subfields=subfields,
+                )
+            )
+    return record
+
+
+class MARCJSONParser(object):
+    """Incremental MARC-in-JSON parser for one record object per line or a JSON
+    array of records, including pymarc's single-line arrays, only the text of
+    a partial record is kept between chunks"""
+
+    separators = " \t\r\n,[]"
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        # File offset of the first byte in the buffer
+        self.offset = 0
+
+    def _records(self, final=False):
+        position = 0
+        # Bytes before position, advanced by each consumed slice only
+        consumed = 0
+        while True:
+            start = position
+            while position < len(self.buffer) and self.buffer[position] in self.separators:
+                position += 1
+            consumed += len(self.buffer[start:position].encode("utf-8"))
+            if position >= len(self.buffer):
+                break
+            offset = self.offset + consumed
+            try:
+                data, end = self.decoder.raw_decode(self.buffer, position)
+            except json.JSONDecodeError as error:
+                next_record = record_start_re.search(self.buffer, position + 1)
+                if next_record is None and not final:
+                    # Most likely a record split across chunks
+                    break
+                yield MARCResult(offset, None, f"JSONDecodeError: {error}")
+                end = len(self.buffer) if next_record is None else next_record.start()
+            else:
+                try:
+                    yield MARCResult(offset, from_marc_json(data), None)
+                except Exception as error:
+                    yield MARCResult(offset, None, f"{type(error).__name__}: {error}")
+            consumed += len(self.buffer[position:end].encode("utf-8"))
+            position = end
+        self.offset += consumed
+        self.buffer = self.buffer[position:]
+
+    def feed(self, chunk):
+        self.buffer += self.text_decoder.decode(bytes(chunk))
+        yield from self._records()
+
+    def close(self):
+        self.buffer += self.text_decoder.decode(b"", final=True)
+        yield from self._records(final=True)
+        self.buffer = ""
+
+
+def sniff_format(chunk) -> str:
+    """iso2709, marcxml, or marcjson from the first bytes of a file"""
+    start = bytes(chunk[:64]).lstrip(b"\xef\xbb\xbf \t\r\n")
+    if start.startswith(b"<"):
+        return "marcxml"
+    if start.startswith(b"{") or start.startswith(b"["):
+        return "marcjson"
+    return "iso2709"
+
+
+PARSERS = {
+    "iso2709": ISO2709Parser,
+    "marcxml": MARCXMLParser,
+    "marcjson": MARCJSONParser,
+}
+
+
+async def read_records(file, chunk_size=1 << 20):
+    """Async generator of MARCResults, one per record in the uploaded file"""
+    parser = None
+    async for chunk in file_chunks(file, chunk_size):
+        if parser is None:
+            parser = PARSERS[sniff_format(chunk)]()
+        for result in parser.feed(chunk):
+            yield result
+    if parser is not None:
+        for result in parser.close():
+            yield result
+
+
+async def load_first_record(marc_file) -> Optional[str]:
+    """Returns the first readable record in the file input as mnemonic MARC"""
+    if marc_file.element.files.length > 0:
+        marc_file_item = marc_file.element.files.item(0)
+        async for result in read_records(marc_file_item):
+            if result.record is not None:
+                return str(result.record)
+
+
+def _subfields(field) -> list:
+    """(code, value) pairs for a pymarc Field"""
+    return list(zip(field.subfields[0::2], field.subfields[1::2]))
+
+
+def _clean(value: str, punctuation=" /:;,.") -> str:
+    return " ".join(value.split()).rstrip(punctuation)
+
+
+def _join(field, skip="0126458") -> str:
+    return " ".join(value for code, value in _subfields(field) if code not in skip)
+
+
+def from_mnemonic(text: str) -> Optional[pymarc.Record]:
+    """Parses the =TAG  IND$aValue form produced by str(pymarc.Record)"""
+    record = pymarc.Record()
+    found = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("=") or len(line) < 6:
+            continue
+        tag, body = line[1:4], line[4:].lstrip()
+        found = True
+        if tag == "LDR":
+            record.leader = body.replace("\\", " ")
+        elif tag < "010":
+            record.add_field(pymarc.Field(tag=tag, data=body.replace("\\", " ")))
+        else:
+            indicators = [char.replace("\\", " ") for char in body[:2]]
+            subfields = []
+            for part in body[2:].split("$")[1:]:
+                if len(part) > 0:
+                    subfields.extend([part[0], part[1:]])
+            record.add_field(
+                pymarc.Field(tag=tag, indicators=indicators, subfields=subfields)
+            )
+    if not found:
+        return None
+    return record
+
+
+# Tags the rule-based mapper converts to FOLIO Instance properties
+MAPPED_TAGS = [
+    "001", "008", "010", "020", "022", "024", "035", "050", "082", "090",
+    "100", "110", "111", "245", "250", "260", "264", "300", "310", "362",
+    "490", "500", "504", "505", "520", "600", "610", "611", "630", "650",
+    "651", "700", "710", "711", "830", "856",
+]
+
+# Administrative and local tags that are not part of a FOLIO Instance
+IGNORED_TAGS = ["003", "005", "006", "007", "015", "016", "040", "042", "043", "049"]
+
+RELATORS = {
+    "act": "Actor",
+    "aut": "Author",
+    "ctb": "Contributor",
+    "edt": "Editor",
+    "nrt": "Narrator",
+    "pbl": "Publisher",
+}
+
+
+def _contributor(field, primary: bool) -> dict:
+    type_text = "Contributor"
+    for code, value in _subfields(field):
+        if code == "4" and value in RELATORS:
+            type_text = RELATORS[value]
+        elif code == "e" and _clean(value).capitalize() in RELATORS.values():
+            type_text = _clean(value).capitalize()
+    name_type = "Personal name" if field.tag.endswith("00") else "Corporate name"
+    return {
+        "name": _clean(_join(field, skip="01234568e")),
+        "contributorTypeText": type_text,
+        "contributorNameTypeName": name_type,
+        "primary": primary,
+    }
+
+
+def _identifier(field):
+    value = field["a"]
+    match field.tag:
+        case "010":
+            return ("LCCN", value)
+        case "020":
+            return ("ISBN", value.split(" ")[0] if value else None)
+        case "022":
+            return ("ISSN", value)
+        case "024":
+            if field.indicator1 == "7" and (field["2"] or "").lower() == "doi":
+                return ("DOI", value)
+        case "035":
+            if value and value.startswith("(OCoLC"):
+                return ("OCLC", value)
+    return (None, None)
+
+
+def to_folio_instance(record: pymarc.Record):
+    """Maps the mechanical parts of a MARC record to a FOLIO Instance, returns
+    (instance, residue) where residue are fields the rules did not handle"""
+    instance = {
+        "source": "MARC",
+        "identifiers": [],
+        "contributors": [],
+        "publication": [],
+        "physicalDescriptions": [],
+        "subjects": [],
+        "series": [],
+        "notes": [],
+        "classifications": [],
+        "electronicAccess": [],
+        "editions": [],
+        "languages": [],
+        "publicationFrequency": [],
+        "publicationRange": [],
+    }
+    residue = []
+    if record.leader[6:7] in ["a", "t"]:
+        instance["instanceTypeName"] = "text"
+    for field in record.get_fields():
+        tag = field.tag
+        # 9XX and X9X are locally defined, apart from the mapped 090 and 490
+        if tag in IGNORED_TAGS or tag not in MAPPED_TAGS and (tag[0] == "9" or tag[1] == "9"):
+            continue
+        if tag not in MAPPED_TAGS:
+            residue.append(field)
+            continue
+        match tag:
+            case "001":
+                instance["hrid"] = field.data
+            case "008":
+                language = field.data[35:38]
+                if language.isalpha():
+                    instance["languages"].append(language)
+            case "010" | "020" | "022" | "024" | "035":
+                type_name, value = _identifier(field)
+                if type_name is None:
+                    if tag != "035":
+                        residue.append(field)
+                    continue
+                # e.g. an 020 with only a cancelled $z, FOLIO rejects empty values
+                if not value:
+                    continue
+                instance["identifiers"].append(
+                    {"identifierTypeName": type_name, "value": value}
+                )
+            case "050" | "090" | "082":
+                type_name = "Dewey" if tag == "082" else "LC"
+                instance["classifications"].append(
+                    {
+                        "classificationNumber": _join(field, skip="0123456789"),
+                        "classificationTypeName": type_name,
+                    }
+                )
+            case "100" | "110" | "111":
+                instance["contributors"].append(_contributor(field, True))
+            case "700" | "710" | "711":
+                instance["contributors"].append(_contributor(field, False))
+            case "245":
+                if field["a"] is None:
+                    residue.append(field)
+                    continue
+                instance["title"] = _join(field, skip="0123456789h")
+                index_title = _clean(" ".join(field.get_subfields("a", "b")))
+                nonfiling = field.indicator2
+                if nonfiling.isdigit():
+                    index_title = index_title[int(nonfiling):]
+                instance["indexTitle"] = index_title[:1].upper() + index_title[1:]
+            case "250":
+                instance["editions"].append(_clean(_join(field)))
+            case "260" | "264":
+                if tag == "264" and field.indicator2 != "1":
+                    residue.append(field)
+                    continue
+                instance["publication"].append(
+                    {
+                        "publisher": _clean(" ".join(field.get_subfields("b"))),
+                        "place": _clean(
+                            " ".join(_clean(row) for row in field.get_subfields("a"))
+                        ),
+                        "dateOfPublication": _clean(" ".join(field.get_subfields("c"))),
+                    }
+                )
+            case "300":
+                instance["physicalDescriptions"].append(_join(field, skip="0123568"))
+            case "310":
+                instance["publicationFrequency"].append(_clean(_join(field)))
+            case "362":
+                instance["publicationRange"].append(_clean(_join(field)))
+            case "490" | "830":
+                series = _clean(field["a"] or "")
+                if series and series not in instance["series"]:
+                    instance["series"].append(series)
+            case "500" | "504" | "505" | "520":
+                instance["notes"].append({"note": _clean(_join(field)), "staffOnly": False})
+            case "600" | "610" | "611" | "630" | "650" | "651":
+                instance["subjects"].append(_clean(_join(field)))
+            case "856":
+                instance["electronicAccess"].append(
+                    {
+                        "uri": field["u"],
+                        "linkText": field["y"] or "",
+                        "materialsSpecification": field["3"] or "",
+                        "publicNote": field["z"] or "",
+                    }
+                )
+    if "title" not in instance:
+        # A 245 without $a is already in the residue
+        residue = [
+            field for field in record.get_fields("245") if field not in residue
+        ] + residue
+    return instance, residue
+
+
+def _allowed(tag: str, allowlist) -> bool:
+    if allowlist is None:
+        return True
+    for pattern in allowlist:
+        if all(char == "X" or char == tag_char for char, tag_char in zip(pattern, tag)):
+            return True
+    return False
+
+
+def _encode_field(field, drop_subfields: str) -> Optional[str]:
+    tag = field.tag
+    if field.is_control_field():
+        if tag == "008":
+            language = field.data[35:38]
+            line = f"008 date={field.data[7:11].strip()}"
+            return f"{line} lang={language}" if language.isalpha() else line
+        return f"{tag} {field.data.strip()}"
+    subfields = "".join(
+        f"${code}{value.strip()}"
+        for code, value in _subfields(field)
+        if code not in drop_subfields
+    )
+    if len(subfields) < 1:
+        return None
+    indicators = f"{field.indicator1}{field.indicator2}".replace(" ", "_")
+    if indicators == "__":
+        return f"{tag} {subfields}"
+    return f"{tag} {indicators}{subfields}"
+
+
+def encode_fields(fields: list, allowlist=None, drop_subfields="01569") -> str:
+    """Compact prompt form of loose fields, e.g. the mapper residue"""
+    lines = []
+    for field in fields:
+        if _allowed(field.tag, allowlist):
+            line = _encode_field(field, drop_subfields)
+            if line is not None:
+                lines.append(line)
+    return "\n".join(lines)
+
+
+def encode_for_prompt(record: pymarc.Record, allowlist=None, drop_subfields="01569") -> str:
+    """Compact, line-per-field MARC for prompts: only allowlisted tags (X is a
+    wildcard), no authority links or local subfields, and no fixed-field padding"""
+    lines = []
+    if _allowed("LDR", allowlist):
+        lines.append(f"LDR type={record.leader[6]} level={record.leader[7]}")
+    fields = encode_fields(record.get_fields(), allowlist, drop_subfields)
+    if len(fields) > 0:
+        lines.append(fields)
+    return "\n".join(lines)
+
+
+def prompt_savings(record: pymarc.Record, encoded: str) -> dict:
+    """Estimated token reduction of the encoded form over mnemonic MARC"""
+    original = estimate_tokens(str(record))
+    compact = estimate_tokens(encoded)
+    return {
+        "original_tokens": original,
+        "compact_tokens": compact,
+        "saved_tokens": original - compact,
+        "saved_percent": round((original - compact) / original * 100, 1),
+    }
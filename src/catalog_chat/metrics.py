@@ -0,0 +1,86 @@
+"""
+Per-call latency and token metrics for the LLM client
+"""
+import datetime
+
+from collections import deque
+
+from pydantic import BaseModel
+
+from js import document
+
+
+class CallMetric(BaseModel):
+    started_at: str = ""
+    workflow: str = ""
+    model: str = ""
+    backend: str = ""
+    # hit, miss, or off when no cache is configured
+    cache: str = "off"
+    stream: bool = False
+    status: str = "ok"
+    attempts: int = 1
+    queued: float = 0.0
+    ttfb: float = 0.0
+    latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def _percentile(values: list, percent: float) -> float:
+    if len(values) < 1:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+class Metrics(object):
+    def __init__(self, limit=5000):
+        self.calls = deque(maxlen=limit)
+
+    def record(self, metric: CallMetric):
+        if not metric.started_at:
+            metric.started_at = datetime.datetime.utcnow().isoformat()
+        self.calls.append(metric)
+        render_stats(self)
+
+    def export(self) -> list:
+        return [metric.dict() for metric in self.calls]
+
+    def summary(self) -> dict:
+        """Aggregates calls by workflow name"""
+        grouped = {}
+        for metric in self.calls:
+            grouped.setdefault(metric.workflow or "None", []).append(metric)
+        output = {}
+        for workflow, calls in grouped.items():
+            latencies = [row.latency for row in calls]
+            output[workflow] = {
+                "calls": len(calls),
+                "cache_hits": len([row for row in calls if row.cache == "hit"]),
+                "errors": len([row for row in calls if row.status != "ok"]),
+                "latency_p50": _percentile(latencies, 50),
+                "latency_p95": _percentile(latencies, 95),
+                "ttfb_p50": _percentile([row.ttfb for row in calls], 50),
+                "queued_total": sum(row.queued for row in calls),
+                "prompt_tokens": sum(row.prompt_tokens for row in calls),
+                "completion_tokens": sum(row.completion_tokens for row in calls),
+            }
+        return output
+
+
+def render_stats(metrics: Metrics):
+    stats_div = document.getElementById("chat-stats")
+    if stats_div is None:
+        return
+    rows = ""
+    for workflow, row in metrics.summary().items():
+        rows += f"""<tr><td>{workflow}</td><td>{row['calls']}</td><td>{row['cache_hits']}</td>
+          <td>{row['errors']}</td><td>{row['ttfb_p50']:.2f}s</td>
+          <td>{row['latency_p50']:.2f}s / {row['latency_p95']:.2f}s</td>
+          <td>{row['prompt_tokens']} / {row['completion_tokens']}</td></tr>"""
+    stats_div.innerHTML = f"""<table class="table table-sm">
+      <thead><tr><th>Workflow</th><th>Calls</th><th>Cache Hits</th><th>Errors</th>
+        <th>TTFB p50</th><th>Latency p50 / p95</th><th>Tokens prompt / completion</th></tr></thead>
+      <tbody>{rows}</tbody>
+    </table>"""
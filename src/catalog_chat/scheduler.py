@@ -0,0 +1,168 @@
+"""
+Rate-limit aware request scheduler with retry and backoff for OpenAI-compatible APIs
+"""
+import asyncio
+import email.utils
+import random
+import re
+import time
+
+from typing import Optional
+
+from js import console
+
+RETRY_STATUSES = [408, 409, 429, 500, 502, 503, 504]
+
+duration_re = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_duration(value) -> float:
+    """Parses OpenAI reset headers like 1s, 6m0s, or 20ms into seconds"""
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for amount, unit in duration_re.findall(value):
+        match unit:
+            case "ms":
+                seconds += float(amount) / 1000
+            case "s":
+                seconds += float(amount)
+            case "m":
+                seconds += float(amount) * 60
+            case "h":
+                seconds += float(amount) * 3600
+    return seconds
+
+
+def _header(response, name) -> Optional[str]:
+    return response.js_response.headers.get(name)
+
+
+def retry_after(response) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After or retry-after-ms"""
+    retry_ms = _header(response, "retry-after-ms")
+    if retry_ms is not None:
+        try:
+            return float(retry_ms) / 1000
+        except ValueError:
+            pass
+    value = _header(response, "retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # Malformed dates return None so the caller uses its own backoff
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_date.timestamp() - time.time(), 0.0)
+
+
+class Budget(object):
+    """Requests or tokens left in the current rate-limit window"""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, limit, remaining, reset):
+        if limit is not None:
+            self.limit = int(limit)
+        if remaining is not None:
+            self.remaining = int(remaining)
+            self.reset_at = time.monotonic() + parse_duration(reset)
+
+    def wait_time(self, amount) -> float:
+        if self.remaining is None:
+            return 0.0
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            return 0.0
+        if self.remaining >= amount:
+            return 0.0
+        return self.reset_at - now
+
+    def reserve(self, amount):
+        if self.remaining is not None:
+            self.remaining -= amount
+
+
+class RequestScheduler(object):
+    def __init__(self, max_concurrency=2, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = Budget()
+        self.tokens = Budget()
+        self.queued = 0
+        self.retries = 0
+
+    def _update_limits(self, response):
+        self.requests.update(
+            _header(response, "x-ratelimit-limit-requests"),
+            _header(response, "x-ratelimit-remaining-requests"),
+            _header(response, "x-ratelimit-reset-requests"),
+        )
+        self.tokens.update(
+            _header(response, "x-ratelimit-limit-tokens"),
+            _header(response, "x-ratelimit-remaining-tokens"),
+            _header(response, "x-ratelimit-reset-tokens"),
+        )
+
+    def _backoff(self, attempt) -> float:
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def submit(self, send, tokens=0, timing=None):
+        """Runs the send coroutine function within the rate limits, retrying 429
+        and 5xx responses, and returns the last response"""
+        if timing is None:
+            timing = {}
+        queued_at = time.monotonic()
+        self.queued += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+        try:
+            for attempt in range(self.max_retries + 1):
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait > 0:
+                    console.log(f"Rate limit reached, waiting {wait:.1f}s")
+                    await asyncio.sleep(wait)
+                self.requests.reserve(1)
+                self.tokens.reserve(tokens)
+                timing["queued"] = time.monotonic() - queued_at
+                timing["attempts"] = attempt + 1
+                try:
+                    response = await send()
+                except OSError as error:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self._backoff(attempt)
+                    console.log(f"Network error {error}, retrying in {delay:.1f}s")
+                else:
+                    self._update_limits(response)
+                    if (
+                        response.status not in RETRY_STATUSES
+                        or attempt == self.max_retries
+                    ):
+                        return response
+                    delay = retry_after(response)
+                    if delay is None:
+                        delay = self._backoff(attempt)
+                    console.log(f"Status {response.status}, retrying in {delay:.1f}s")
+                self.retries += 1
+                await asyncio.sleep(min(delay, self.max_delay))
+        finally:
+            self.semaphore.release()
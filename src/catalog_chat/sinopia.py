@@ -1,11 +1,21 @@
+import asyncio
 import json
+import time
+
+from collections import OrderedDict
+from urllib.parse import urlparse
 
 import rdflib
 
+from rdflib.plugins.sparql import prepareQuery
+
 from js import document, console
 
 from pyodide.http import pyfetch
 
+from context import estimate_tokens
+from vectors import remember
+
 BF = rdflib.Namespace("http://id.loc.gov/ontologies/bibframe/")
 BFLC = rdflib.Namespace("http://id.loc.gov/ontologies/bflc/")
 SHACL = rdflib.Namespace("http://www.w3.org/ns/shacl#")
@@ -17,17 +27,510 @@ def _bind_namespaces(graph: rdflib.Graph):
     graph.namespace_manager.bind("sinopia",SINOPIA)
     graph.namespace_manager.bind("sh", SHACL)
 
+# BIBFRAME properties that map to FOLIO Instance fields, everything else
+# (admin metadata, Sinopia template properties) is pruned before prompting
+KEEP_PROPERTIES = set(
+    [BF[name] for name in [
+        "agent", "classification", "classificationPortion", "contribution", "copyrightDate",
+        "date", "dimensions", "editionStatement", "extent", "genreForm", "hasInstance",
+        "identifiedBy", "instanceOf", "language", "mainTitle", "note", "originDate",
+        "partName", "partNumber", "place", "provisionActivity", "qualifier",
+        "responsibilityStatement", "role", "seriesStatement", "subject", "subtitle",
+        "title",
+    ]]
+    + [BFLC[name] for name in ["simpleAgent", "simpleDate", "simplePlace"]]
+    + [rdflib.RDF.value, rdflib.RDFS.label]
+)
+
+# Blank node classes implied by their property, other classes are kept in the path
+IMPLIED_TYPES = [
+    "Agent", "Contribution", "Identifier", "Note", "Place", "ProvisionActivity", "Role", "Title",
+]
+
+LABEL_PROPERTIES = [
+    rdflib.RDFS.label,
+    rdflib.URIRef("http://www.w3.org/2004/02/skos/core#prefLabel"),
+    rdflib.URIRef("http://www.loc.gov/mads/rdf/v1#authoritativeLabel"),
+]
+
+
+def _local_name(uri) -> str:
+    return str(uri).rstrip("/").rsplit("/", 1)[-1].rsplit("#", 1)[-1]
+
+
+def _label(graph: rdflib.Graph, node):
+    for predicate in LABEL_PROPERTIES:
+        label = graph.value(node, predicate)
+        if label is not None:
+            return str(label)
+
+
+def _roots(graph: rdflib.Graph, resource_url: str) -> list:
+    root = rdflib.URIRef(resource_url)
+    if (root, None, None) in graph:
+        return [root]
+    return [
+        subject
+        for subject in graph.subjects(rdflib.RDF.type, None)
+        if isinstance(subject, rdflib.URIRef)
+        and _local_name(graph.value(subject, rdflib.RDF.type)) in ["Work", "Instance"]
+    ]
+
+
+def prune(graph: rdflib.Graph, resource_url: str, max_hops=2) -> str:
+    """Compact "path: value" lines of the FOLIO-relevant BIBFRAME properties,
+    blank nodes are inlined and linked resources are followed up to max_hops"""
+    lines = []
+    seen = set()
+
+    def walk(node, path, hops):
+        seen.add(node)
+        for predicate, value in sorted(graph.predicate_objects(node)):
+            if predicate not in KEEP_PROPERTIES:
+                continue
+            key = _local_name(predicate)
+            if path:
+                key = f"{path}.{key}"
+            if isinstance(value, rdflib.Literal):
+                lines.append(f"{key}: {value}")
+            elif isinstance(value, rdflib.BNode):
+                types = [
+                    _local_name(row)
+                    for row in graph.objects(value, rdflib.RDF.type)
+                    if _local_name(row) not in IMPLIED_TYPES
+                ]
+                if len(types) > 0:
+                    key = f"{key}({','.join(sorted(types))})"
+                if value not in seen:
+                    walk(value, key, hops)
+            else:
+                label = _label(graph, value)
+                if label is not None:
+                    lines.append(f"{key}: {label} <{value}>")
+                elif hops > 0 and value not in seen and (value, None, None) in graph:
+                    walk(value, key, hops - 1)
+                else:
+                    lines.append(f"{key}: <{value}>")
+
+    for root in _roots(graph, resource_url):
+        types = ",".join(sorted(_local_name(row) for row in graph.objects(root, rdflib.RDF.type)))
+        lines.append(f"{types} <{root}>")
+        walk(root, "", max_hops)
+    return "\n".join(lines)
+
+
+QUERY_NAMESPACES = {"bf": BF, "bflc": BFLC, "rdf": rdflib.RDF, "rdfs": rdflib.RDFS}
+
+# Work and Instance properties are both read, whichever one the resource is
+NODES = "?resource (bf:hasInstance|bf:instanceOf|^bf:hasInstance|^bf:instanceOf)? ?node ."
+
+TITLE_QUERY = prepareQuery(
+    f"""SELECT ?mainTitle ?subtitle WHERE {{
+      {NODES}
+      ?node bf:title ?title .
+      ?title bf:mainTitle ?mainTitle .
+      OPTIONAL {{ ?title bf:subtitle ?subtitle }}
+      FILTER NOT EXISTS {{ ?title a bf:VariantTitle }}
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+CONTRIBUTOR_QUERY = prepareQuery(
+    f"""SELECT ?agent ?name ?role ?primary ?person WHERE {{
+      {NODES}
+      ?node bf:contribution ?contribution .
+      ?contribution bf:agent ?agent .
+      OPTIONAL {{ ?agent rdfs:label ?name }}
+      OPTIONAL {{ ?contribution bf:role/rdfs:label ?role }}
+      BIND(EXISTS {{ ?contribution a bflc:PrimaryContribution }} AS ?primary)
+      BIND(EXISTS {{ ?agent a bf:Person }} AS ?person)
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+NOTE_QUERY = prepareQuery(
+    f"""SELECT DISTINCT ?note WHERE {{
+      {NODES}
+      ?node bf:note/rdfs:label ?note .
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+LANGUAGE_QUERY = prepareQuery(
+    f"""SELECT DISTINCT ?language WHERE {{
+      {NODES}
+      ?node bf:language ?language .
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+IDENTIFIER_QUERY = prepareQuery(
+    f"""SELECT DISTINCT ?type ?value WHERE {{
+      {NODES}
+      ?node bf:identifiedBy ?identifier .
+      ?identifier a ?type ;
+        rdf:value ?value .
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+PUBLICATION_QUERY = prepareQuery(
+    f"""SELECT ?place ?publisher ?date WHERE {{
+      {NODES}
+      ?node bf:provisionActivity ?activity .
+      ?activity a bf:Publication .
+      OPTIONAL {{ ?activity bf:place/rdfs:label|bflc:simplePlace ?place }}
+      OPTIONAL {{ ?activity bf:agent/rdfs:label|bflc:simpleAgent ?publisher }}
+      OPTIONAL {{ ?activity bf:date|bflc:simpleDate ?date }}
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+SUBJECT_QUERY = prepareQuery(
+    f"""SELECT DISTINCT ?subject WHERE {{
+      {NODES}
+      ?node bf:subject/rdfs:label ?subject .
+    }}""",
+    initNs=QUERY_NAMESPACES,
+)
+
+IDENTIFIER_TYPES = {"Doi": "DOI", "Isbn": "ISBN", "Issn": "ISSN", "Lccn": "LCCN"}
+
+# FOLIO Instance fields and the BIBFRAME property they are mapped from
+SOURCE_PROPERTIES = {
+    "title": BF.title,
+    "contributors": BF.contribution,
+    "notes": BF.note,
+    "languages": BF.language,
+    "identifiers": BF.identifiedBy,
+    "publication": BF.provisionActivity,
+    "subjects": BF.subject,
+}
+
+
+def _rows(graph: rdflib.Graph, query, resource) -> list:
+    return list(graph.query(query, initBindings={"resource": resource}))
+
+
+def to_folio_instance(graph: rdflib.Graph, resource_url: str):
+    """Maps a BIBFRAME graph to a FOLIO Instance with the prepared queries,
+    returns (instance, gaps) where gaps are fields present in the graph
+    that the queries could not map"""
+    instance = {
+        "source": "Sinopia",
+        "contributors": [],
+        "notes": [],
+        "languages": [],
+        "identifiers": [],
+        "publication": [],
+        "subjects": [],
+    }
+    roots = _roots(graph, resource_url)
+    if len(roots) < 1:
+        return instance, ["title"]
+    resource = roots[0]
+    for row in _rows(graph, TITLE_QUERY, resource)[:1]:
+        instance["title"] = str(row.mainTitle)
+        if row.subtitle is not None:
+            instance["title"] += f" : {row.subtitle}"
+    seen = set()
+    for row in _rows(graph, CONTRIBUTOR_QUERY, resource):
+        if row.name is None or row.agent in seen:
+            continue
+        seen.add(row.agent)
+        instance["contributors"].append(
+            {
+                "name": str(row.name),
+                "contributorTypeText": str(row.role or "Contributor"),
+                "contributorNameTypeName": "Personal name" if row.person else "Corporate name",
+                "primary": bool(row.primary),
+            }
+        )
+    for row in _rows(graph, NOTE_QUERY, resource):
+        instance["notes"].append({"note": str(row.note), "staffOnly": False})
+    for row in _rows(graph, LANGUAGE_QUERY, resource):
+        if "/vocabulary/languages/" in str(row.language):
+            instance["languages"].append(_local_name(row.language))
+    for row in _rows(graph, IDENTIFIER_QUERY, resource):
+        type_name = IDENTIFIER_TYPES.get(_local_name(row.type))
+        if type_name is not None:
+            instance["identifiers"].append(
+                {"identifierTypeName": type_name, "value": str(row.value)}
+            )
+    for row in _rows(graph, PUBLICATION_QUERY, resource):
+        instance["publication"].append(
+            {
+                "place": str(row.place or ""),
+                "publisher": str(row.publisher or ""),
+                "dateOfPublication": str(row.date or ""),
+            }
+        )
+    for row in _rows(graph, SUBJECT_QUERY, resource):
+        instance["subjects"].append(str(row.subject))
+    nodes = [resource]
+    for predicate in [BF.hasInstance, BF.instanceOf]:
+        nodes.extend(graph.objects(resource, predicate))
+        nodes.extend(graph.subjects(predicate, resource))
+    gaps = [
+        field
+        for field, predicate in SOURCE_PROPERTIES.items()
+        if not instance.get(field)
+        and any((node, predicate, None) in graph for node in nodes)
+    ]
+    if "title" not in instance and "title" not in gaps:
+        gaps.insert(0, "title")
+    return instance, gaps
+
+
 async def add(*args):
     return "Add sinopia resource"
 
 
-async def load(resource_url):
-    sinopia_result = await pyfetch(resource_url)
-    if sinopia_result.ok:
+class ResourceCache(object):
+    """Sinopia resources keyed by URL, holding the JSON-LD, parsed graph and
+    Turtle, revalidated by ETag or Last-Modified once the TTL expires and
+    evicted least recently used when over max_triples"""
+
+    def __init__(self, ttl=300, max_triples=200_000):
+        self.ttl = ttl
+        self.max_triples = max_triples
+        self.entries = OrderedDict()
+        self.triples = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def _evict(self):
+        while self.triples > self.max_triples and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.triples -= entry["triples"]
+
+    def _add(self, resource_url, entry):
+        previous = self.entries.pop(resource_url, None)
+        if previous is not None:
+            self.triples -= previous["triples"]
+        self.entries[resource_url] = entry
+        self.triples += entry["triples"]
+        self._evict()
+
+    async def _fetch(self, resource_url):
+        entry = self.entries.get(resource_url)
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        sinopia_result = await pyfetch(resource_url, headers=headers)
+        if entry is not None and sinopia_result.status == 304:
+            self.revalidated += 1
+            entry["fetched"] = time.time()
+            return entry
+        self.misses += 1
+        if not sinopia_result.ok:
+            console.log(f"Sinopia {resource_url} returned {sinopia_result.status}")
+            return None
         sinopia_resource = await sinopia_result.json()
         rdf_graph = rdflib.Graph()
         _bind_namespaces(rdf_graph)
         rdf_graph.parse(data=json.dumps(sinopia_resource.get("data")), format="json-ld")
         turtle_rdf = rdf_graph.serialize(format='turtle')
-        turtle_rdf = turtle_rdf.replace(">", "&gt;").replace("<", "&lt;")
-        return turtle_rdf
+        entry = {
+            "data": sinopia_resource,
+            "graph": rdf_graph,
+            "turtle": turtle_rdf.replace(">", "&gt;").replace("<", "&lt;"),
+            "triples": len(rdf_graph),
+            "etag": sinopia_result.js_response.headers.get("etag"),
+            "last_modified": sinopia_result.js_response.headers.get("last-modified"),
+            "fetched": time.time(),
+        }
+        self._add(resource_url, entry)
+        return entry
+
+    async def get(self, resource_url):
+        entry = self.entries.get(resource_url)
+        if entry is not None and time.time() - entry["fetched"] < self.ttl:
+            self.hits += 1
+            self.entries.move_to_end(resource_url)
+            return entry
+        if resource_url not in self.inflight:
+            self.inflight[resource_url] = asyncio.ensure_future(self._fetch(resource_url))
+        try:
+            return await asyncio.shield(self.inflight[resource_url])
+        finally:
+            self.inflight.pop(resource_url, None)
+
+    def resized(self, resource_url):
+        """Updates the triple count after labels were merged into a cached graph"""
+        entry = self.entries.get(resource_url)
+        if entry is not None:
+            self.triples += len(entry["graph"]) - entry["triples"]
+            entry["triples"] = len(entry["graph"])
+            self._evict()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.revalidated
+        return {
+            "resources": len(self.entries),
+            "triples": self.triples,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.triples = 0
+
+
+resource_cache = ResourceCache()
+
+
+def _is_sinopia(uri) -> bool:
+    parsed = urlparse(str(uri))
+    return parsed.netloc.endswith("sinopia.io") and "/resource/" in parsed.path
+
+
+def _label_from_jsonld(data, uri):
+    """Label of uri in expanded JSON-LD, as returned by id.loc.gov .json"""
+    if isinstance(data, dict):
+        data = data.get("@graph", [data])
+    address = str(uri).split("://", 1)[-1]
+    for node in data:
+        if not isinstance(node, dict) or node.get("@id", "").split("://", 1)[-1] != address:
+            continue
+        for predicate in LABEL_PROPERTIES:
+            values = node.get(str(predicate), [])
+            if isinstance(values, dict):
+                values = [values]
+            for value in values:
+                if isinstance(value, dict) and "@value" in value:
+                    return value["@value"]
+
+
+class LabelResolver(object):
+    """Fetches labels for resources linked from a Sinopia graph, concurrently
+    with at most per_host requests to a host, and caches them across resources"""
+
+    def __init__(self, max_depth=2, per_host=4):
+        self.max_depth = max_depth
+        self.per_host = per_host
+        self.semaphores = {}
+        self.labels = {}
+        self.inflight = {}
+
+    def _semaphore(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self.semaphores[host]
+
+    async def _fetch_label(self, uri):
+        url = str(uri)
+        parsed = urlparse(url)
+        if parsed.netloc == "id.loc.gov":
+            url = f"https://id.loc.gov{parsed.path}.json"
+        async with self._semaphore(parsed.netloc):
+            try:
+                response = await pyfetch(url, headers={"Accept": "application/ld+json"})
+                if not response.ok:
+                    return None
+                return _label_from_jsonld(await response.json(), uri)
+            except Exception as error:
+                console.log(f"Could not resolve {uri}: {error}")
+                return None
+
+    async def label(self, uri):
+        key = str(uri)
+        if key in self.labels:
+            return self.labels[key]
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(self._fetch_label(uri))
+        try:
+            self.labels[key] = await asyncio.shield(self.inflight[key])
+        finally:
+            self.inflight.pop(key, None)
+        return self.labels[key]
+
+    async def _linked_graph(self, uri):
+        async with self._semaphore(urlparse(str(uri)).netloc):
+            return await load_graph(str(uri))
+
+    def _references(self, graph: rdflib.Graph, nodes) -> set:
+        """Unlabeled resources reached from nodes through kept properties"""
+        references = set()
+        stack = list(nodes)
+        seen = set(stack)
+        while len(stack) > 0:
+            node = stack.pop()
+            for predicate, value in graph.predicate_objects(node):
+                if predicate not in KEEP_PROPERTIES or value in seen:
+                    continue
+                seen.add(value)
+                if isinstance(value, rdflib.BNode):
+                    stack.append(value)
+                elif isinstance(value, rdflib.URIRef) and _label(graph, value) is None:
+                    references.add(value)
+        return references
+
+    async def resolve(self, graph: rdflib.Graph, resource_url: str) -> int:
+        """Merges labels, and linked Sinopia resources, into the graph up to
+        max_depth links from the root, returns the number of resources resolved"""
+        frontier = _roots(graph, resource_url)
+        visited = set(frontier)
+        resolved = 0
+        for depth in range(self.max_depth):
+            references = [
+                row for row in self._references(graph, frontier) if row not in visited
+            ]
+            visited.update(references)
+            linked = [row for row in references if _is_sinopia(row)]
+            labeled = [row for row in references if not _is_sinopia(row)]
+            graphs, labels = await asyncio.gather(
+                asyncio.gather(*[self._linked_graph(row) for row in linked]),
+                asyncio.gather(*[self.label(row) for row in labeled]),
+            )
+            frontier = []
+            for uri, linked_graph in zip(linked, graphs):
+                if linked_graph is not None:
+                    graph += linked_graph
+                    frontier.append(uri)
+                    resolved += 1
+            for uri, label in zip(labeled, labels):
+                if label is not None:
+                    graph.add((uri, rdflib.RDFS.label, rdflib.Literal(label)))
+                    resolved += 1
+            if len(frontier) < 1:
+                break
+        return resolved
+
+
+label_resolver = LabelResolver()
+
+
+async def load_graph(resource_url):
+    entry = await resource_cache.get(resource_url)
+    if entry is not None:
+        return entry["graph"]
+
+
+async def load(resource_url, pruned=True):
+    """Pruned BIBFRAME lines for the resource, or the full Turtle"""
+    entry = await resource_cache.get(resource_url)
+    if entry is None:
+        return
+    console.log(f"Sinopia cache {resource_cache.stats()}")
+    if not pruned:
+        return entry["turtle"]
+    if "compact" not in entry:
+        resolved = await label_resolver.resolve(entry["graph"], resource_url)
+        resource_cache.resized(resource_url)
+        console.log(f"Resolved {resolved} linked resources for {resource_url}")
+        compact = prune(entry["graph"], resource_url)
+        entry["compact"] = compact.replace(">", "&gt;").replace("<", "&lt;")
+        remember("sinopia", resource_url, compact)
+        console.log(
+            f"Pruned Sinopia resource ~{estimate_tokens(compact)} tokens, Turtle ~{estimate_tokens(entry['turtle'])} tokens"
+        )
+    return entry["compact"]
@@ -0,0 +1,314 @@
+"""
+In-browser vector stores behind the FOLIO, Sinopia and LCSH vector toggles
+"""
+import json
+import struct
+import time
+
+from js import Uint8Array, Response, caches, console, document
+
+from pyodide.http import pyfetch
+
+from context import estimate_tokens
+from loader import require
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Entries queued per store before the oldest are dropped
+MAX_PENDING = 1000
+SNAPSHOT_DIR = "vectors"
+SNAPSHOT_CACHE = "catalog-chat-vectors"
+# magic, rows, dimensions, metadata bytes, followed by the JSON metadata padded
+# to 16 bytes and the little-endian float32 matrix
+SNAPSHOT_HEADER = struct.Struct("<8sIII")
+SNAPSHOT_MAGIC = b"CCVEC\x00\x00\x01"
+
+STORES = {
+    "folio": "folio-vector-db",
+    "sinopia": "sinopia-vector-db",
+    "lcsh": "lcsh-vector-db",
+}
+
+
+class VectorStore(object):
+    """Unit length float32 rows, cosine similarity is a matrix product"""
+
+    def __init__(self, name: str, dimensions=0, model=EMBEDDING_MODEL):
+        import numpy as np
+
+        self.name = name
+        self.model = model
+        # Set by the first add when 0, the size depends on the embedding model
+        self.dimensions = dimensions
+        self.ids = []
+        self.texts = []
+        self.positions = {}
+        # Rows past count are spare capacity, a loaded snapshot is read-only
+        # until the first add copies it
+        self._rows = np.zeros((0, dimensions), dtype=np.float32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def matrix(self):
+        return self._rows[: self.count]
+
+    def _reserve(self, rows: int):
+        import numpy as np
+
+        if self.count + rows <= self._rows.shape[0] and self._rows.flags.writeable:
+            return
+        capacity = max(self.count + rows, self._rows.shape[0] * 2, 256)
+        grown = np.empty((capacity, self.dimensions), dtype=np.float32)
+        grown[: self.count] = self.matrix
+        self._rows = grown
+
+    def add(self, ids: list, texts: list, vectors):
+        """Normalizes and adds the vectors, replacing the rows of known ids"""
+        import numpy as np
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.count < 1 and vectors.shape[-1] != self.dimensions:
+            self.dimensions = vectors.shape[-1]
+            self._rows = np.zeros((0, self.dimensions), dtype=np.float32)
+        if vectors.shape[-1] != self.dimensions:
+            raise ValueError(
+                f"{self.name} has {self.dimensions} dimensions, the embeddings {vectors.shape[-1]}"
+            )
+        vectors = vectors.reshape(-1, self.dimensions)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+        self._reserve(len(ids))
+        for id, text, vector in zip(ids, texts, vectors):
+            row = self.positions.get(id)
+            if row is None:
+                row = self.count
+                self.positions[id] = row
+                self.ids.append(id)
+                self.texts.append(text)
+                self.count += 1
+            self.texts[row] = text
+            self._rows[row] = vector
+
+    def search(self, queries, k=5, min_score=0.0) -> list:
+        """Top k (score, id, text) for each query, one matrix product for the batch"""
+        import numpy as np
+
+        if self.count < 1:
+            return [[] for _ in range(len(queries))]
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.shape[-1] != self.dimensions:
+            raise ValueError(
+                f"{self.name} has {self.dimensions} dimensions, the query {queries.shape[-1]}"
+            )
+        queries = queries.reshape(-1, self.dimensions)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ self.matrix.T
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        output = []
+        for row, columns in zip(scores, top):
+            ranked = columns[np.argsort(-row[columns])]
+            output.append(
+                [
+                    (float(row[column]), self.ids[column], self.texts[column])
+                    for column in ranked
+                    if row[column] >= min_score
+                ]
+            )
+        return output
+
+    def to_bytes(self) -> bytes:
+        metadata = json.dumps(
+            {"name": self.name, "model": self.model, "ids": self.ids, "texts": self.texts}
+        ).encode("utf-8")
+        metadata += b" " * (-(SNAPSHOT_HEADER.size + len(metadata)) % 16)
+        return (
+            SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.count, self.dimensions, len(metadata))
+            + metadata
+            + self.matrix.astype("<f4").tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Store over the snapshot's buffer, the matrix is not copied"""
+        import numpy as np
+
+        magic, count, dimensions, size = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a vector store snapshot")
+        metadata = json.loads(bytes(data[SNAPSHOT_HEADER.size : SNAPSHOT_HEADER.size + size]))
+        store = cls(metadata["name"], dimensions, metadata["model"])
+        store.ids = metadata["ids"]
+        store.texts = metadata["texts"]
+        store.positions = {id: row for row, id in enumerate(store.ids)}
+        store.count = count
+        store._rows = np.frombuffer(
+            data, dtype="<f4", count=count * dimensions, offset=SNAPSHOT_HEADER.size + size
+        ).reshape(count, dimensions)
+        return store
+
+
+stores = {}
+
+# (id, text) waiting to be embedded, added to the store on the next retrieval
+pending = {name: {} for name in STORES}
+
+
+def remember(name: str, id: str, text: str, max_chars=4000):
+    """Queues text for the named store, the embedding request is batched with
+    the next retrieval so loading records never waits on it"""
+    text = text.strip()[:max_chars]
+    if len(text) < 1:
+        return
+    store = stores.get(name)
+    # Nothing is kept for a store that is neither loaded nor toggled on
+    if store is None and name not in checked_stores():
+        return
+    if store is not None and id in store.positions and store.texts[store.positions[id]] == text:
+        return
+    queue = pending[name]
+    queue.pop(id, None)
+    queue[id] = text
+    if len(queue) > MAX_PENDING:
+        queue.pop(next(iter(queue)))
+
+
+def checked_stores() -> list:
+    names = []
+    for name, checkbox_id in STORES.items():
+        checkbox = document.getElementById(checkbox_id)
+        if checkbox is not None and checkbox.checked:
+            names.append(name)
+    return names
+
+
+def embedding_model(chat_instance) -> str:
+    backend = chat_instance.router.backends[0]
+    # backend.model is a chat model, which embeddings endpoints reject
+    return backend.embedding_model or EMBEDDING_MODEL
+
+
+async def embed(chat_instance, texts: list, batch_size=512):
+    """Embeddings from the primary backend's OpenAI-compatible endpoint"""
+    import numpy as np
+
+    backend = chat_instance.router.backends[0]
+    url = backend.url.replace("chat/completions", "embeddings")
+    model = embedding_model(chat_instance)
+    rows = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start : start + batch_size]
+        body = json.dumps({"model": model, "input": batch})
+
+        async def send():
+            return await pyfetch(url, method="POST", headers=backend.headers(), body=body)
+
+        response = await backend.embedding_scheduler.submit(
+            send, tokens=sum(estimate_tokens(text) for text in batch)
+        )
+        if not response.ok:
+            raise ValueError(f"Embeddings {response.status}: {await response.string()}")
+        result = await response.json()
+        rows.extend(row["embedding"] for row in sorted(result["data"], key=lambda row: row["index"]))
+    return np.asarray(rows, dtype=np.float32)
+
+
+async def _snapshot(name: str):
+    """Snapshot bytes saved in the browser, or one shipped in vectors/"""
+    url = f"{SNAPSHOT_DIR}/{name}.vec"
+    try:
+        cache = await caches.open(SNAPSHOT_CACHE)
+        response = await cache.match(url)
+    except Exception as error:
+        # No Cache API outside a secure context
+        console.log(f"Vector store cache unavailable: {error}")
+        response = None
+    if response is None:
+        response = await pyfetch(url)
+        if not response.ok:
+            return None
+        return (await response.buffer()).to_py()
+    return (await response.arrayBuffer()).to_py()
+
+
+async def load_store(name: str, model=EMBEDDING_MODEL) -> VectorStore:
+    """The named store for embeddings from model, a store or snapshot for
+    another model is replaced with an empty one"""
+    if name in stores and stores[name].model == model:
+        return stores[name]
+    await require("numpy")
+    start = time.monotonic()
+    data = await _snapshot(name)
+    store = None
+    if data is not None:
+        try:
+            store = VectorStore.from_bytes(data)
+        except ValueError as error:
+            console.log(f"Vector store {name}: {error}")
+    if store is None or store.model != model:
+        store = VectorStore(name, model=model)
+    console.log(f"Loaded vector store {name} with {len(store)} rows in {time.monotonic() - start:.3f}s")
+    stores[name] = store
+    return store
+
+
+async def save_store(store: VectorStore):
+    data = store.to_bytes()
+    buffer = Uint8Array.new(len(data))
+    buffer.assign(data)
+    cache = await caches.open(SNAPSHOT_CACHE)
+    await cache.put(f"{SNAPSHOT_DIR}/{store.name}.vec", Response.new(buffer))
+
+
+async def _add_pending(chat_instance, names: list):
+    queued = [(name, id, text) for name in names for id, text in pending[name].items()]
+    if len(queued) < 1:
+        return
+    vectors = await embed(chat_instance, [row[2] for row in queued])
+    for name in names:
+        rows = [i for i, row in enumerate(queued) if row[0] == name]
+        if len(rows) < 1:
+            continue
+        store = stores[name]
+        store.add([queued[i][1] for i in rows], [queued[i][2] for i in rows], vectors[rows])
+        pending[name].clear()
+        try:
+            await save_store(store)
+        except Exception as error:
+            console.log(f"Vector store {name} not saved: {error}")
+
+
+async def retrieve(chat_instance, prompt: str, names: list, k=5, min_score=0.75) -> list:
+    """(score, store name, text) for the closest entries across the stores"""
+    model = embedding_model(chat_instance)
+    for name in names:
+        await load_store(name, model)
+    await _add_pending(chat_instance, names)
+    if all(len(stores[name]) < 1 for name in names):
+        return []
+    query = await embed(chat_instance, [prompt])
+    start = time.monotonic()
+    hits = []
+    for name in names:
+        for score, id, text in stores[name].search(query, k=k, min_score=min_score)[0]:
+            hits.append((score, name, text))
+    hits.sort(key=lambda row: row[0], reverse=True)
+    console.log(f"Vector search over {sum(len(stores[name]) for name in names)} rows in {(time.monotonic() - start) * 1000:.1f} ms")
+    return hits[:k]
+
+
+async def with_context(chat_instance, prompt: str, names: list) -> str:
+    """The prompt followed by the retrieved entries"""
+    try:
+        hits = await retrieve(chat_instance, prompt, names)
+    except Exception as error:
+        # Network, embeddings, or Cache API failures (e.g. outside a secure
+        # context) only cost the context, the prompt still runs
+        console.log(f"Vector retrieval failed: {error}")
+        return prompt
+    if len(hits) < 1:
+        return prompt
+    context = "\n".join(f"{name}: {text}" for score, name, text in hits)
+    return f"{prompt}\n\nContext:\n{context}"
@@ -1,23 +1,32 @@
 import asyncio
 import json
+import re
 import sys
 import time
 
-from js import console, document
+from typing import Optional
 
+from js import console, document, sessionStorage
 
-from chat import add_history, prompt_base, ChatGPT
+
+from agent import AgentLoop
+from chat import add_history, function_calls, prompt_base, ChatGPT
 
 from folio import (
+    FOLIOLoginError,
     add_instance,
+    add_instances,
+    get_classification_types,
     get_contributor_types,
     get_contributor_name_types,
     get_identifier_types,
+    get_instance,
     get_instance_types,
     load_instance,
 )
 
-from sinopia import add as add_sinopia, load as load_sinopia
+from lcsh import search as search_lcsh, validate as validate_lcsh
+
 
 
 add_instance_sig = {
@@ -44,7 +53,7 @@ load_instance_sig = {
 
 load_sinopia_sig = {
     "name": "load_sinopia",
-    "description": "Loads a Sinopia URL and returns the RDF as JSON-LD",
+    "description": "Loads a Sinopia URL and returns its BIBFRAME properties",
     "parameters": {
         "type": "object",
         "properties": {
@@ -54,49 +63,220 @@ load_sinopia_sig = {
     }
 }
 
+class BatchCheckpoint(object):
+    """Offsets of records already loaded in a batch run, persisted in sessionStorage
+    so a run can resume after a tab reload or failure"""
+
+    def __init__(self, key, on_progress=None):
+        self.key = f"batch_checkpoint:{key}"
+        existing = json.loads(sessionStorage.getItem(self.key) or "{}")
+        self.completed = set(existing.get("done", []))
+        self.errors = {}
+        self.skipped = 0
+        self.loaded = 0
+        self.started = time.monotonic()
+        self.on_progress = on_progress
+
+    def is_done(self, offset) -> bool:
+        return offset in self.completed
+
+    def _save(self):
+        sessionStorage.setItem(self.key, json.dumps({"done": sorted(self.completed)}))
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def done(self, offsets: list):
+        self.completed.update(offsets)
+        self.loaded += len(offsets)
+        self._save()
+
+    def failed(self, offset, error):
+        self.errors[offset] = error
+        self._save()
+
+    def throughput(self) -> float:
+        """Records loaded per minute in this run"""
+        elapsed = time.monotonic() - self.started
+        return self.loaded / elapsed * 60 if elapsed > 0 else 0.0
+
+    def reset(self):
+        sessionStorage.removeItem(self.key)
+
+
 class WorkFlow(object):
     name: str = ""
     system: str = ""
     examples: list = []
     max_turns: int = 5
+    # Seconds a single tool call may run before it is answered with a timeout
+    tool_timeout: float = 60.0
+
+    async def handle_calls(self, calls: list) -> list:
+        """Runs all of a turn's function calls concurrently with __handle_func__,
+        each limited to tool_timeout, and returns their outputs in order"""
+
+        async def run_call(call):
+            try:
+                output = await asyncio.wait_for(
+                    self.__handle_func__(call), self.tool_timeout
+                )
+                return output if isinstance(output, str) else json.dumps(output)
+            except asyncio.TimeoutError:
+                return f"{call['name']} timed out after {self.tool_timeout}s"
+            except Exception as error:
+                return f"{call['name']} failed: {error}"
+
+        return await asyncio.gather(*[run_call(call) for call in calls])
+
+    def skip_calls(self, chat_instance: ChatGPT, calls: list):
+        """Answers calls the workflow stops before running, the next request
+        is rejected while a tool call has no answer"""
+        chat_instance.add_tool_results(
+            calls, [f"{call['name']} was not run, the workflow stopped" for call in calls]
+        )
 
 
 class FOLIOWorkFlow(WorkFlow):
     def __init__(self):
+        self.classification_types = None
         self.contributor_types = None
         self.contributor_name_types = None
         self.identifier_types = None
         self.instance_types = None
 
     async def get_types(self):
-        if self.contributor_types is None:
-            self.contributor_types = await get_contributor_types()
-
-        if self.contributor_name_types is None:
-            self.contributor_name_types = await get_contributor_name_types()
-
-        if self.identifier_types is None:
-            self.identifier_types = await get_identifier_types()
-
-        if self.instance_types is None:
-            self.instance_types = await get_instance_types()
+        # Reference data is cached per tenant in folio.reference_data
+        try:
+            (
+                self.classification_types,
+                self.contributor_types,
+                self.contributor_name_types,
+                self.identifier_types,
+                self.instance_types,
+            ) = await asyncio.gather(
+                get_classification_types(),
+                get_contributor_types(),
+                get_contributor_name_types(),
+                get_identifier_types(),
+                get_instance_types(),
+            )
+        except FOLIOLoginError as error:
+            # The types stay None and are loaded again after logging in
+            add_history({"error": "FOLIO", "message": str(error)}, "error")
 
     def __update_record__(self, record):
-        record["instanceTypeId"] = self.instance_types.get("unspecified")
+        if self.instance_types is None:
+            raise FOLIOLoginError("No FOLIO reference data, log into FOLIO first")
+        record["instanceTypeId"] = self.instance_types.get(
+            record.pop("instanceTypeName", "unspecified")
+        )
         for identifier in record.get("identifiers", []):
             if "identifierTypeName" in identifier:
                 ident_name = identifier.pop("identifierTypeName")
                 if ident_name.upper().startswith("OCLC"):
                     ident_name = "OCLC"
                 identifier["identifierTypeId"] = self.identifier_types.get(ident_name)
-        
+
+        classifications = []
+        for classification in record.get("classifications", []):
+            if "classificationTypeName" in classification:
+                classification["classificationTypeId"] = self.classification_types.get(
+                    classification.pop("classificationTypeName")
+                )
+            # FOLIO rejects a classification without a type
+            if classification.get("classificationTypeId") is not None:
+                classifications.append(classification)
+        if "classifications" in record:
+            record["classifications"] = classifications
+
+        # Roles from BIBFRAME labels and the model vary in case, e.g. "author."
+        contributor_types = {
+            name.casefold(): type_id for name, type_id in self.contributor_types.items()
+        }
         for contributor in record.get("contributors", []):
-            contributor["contributorTypeId"] = self.contributor_types.get(
-                contributor.get("contributorTypeText", "Contributor")
+            role = contributor.get("contributorTypeText") or "Contributor"
+            contributor["contributorTypeId"] = contributor_types.get(
+                role.strip(" .,").casefold(), contributor_types.get("contributor")
             )
             contributor[
                 "contributorNameTypeId"
-            ] = self.contributor_name_types.get("Personal name")
+            ] = self.contributor_name_types.get(
+                contributor.pop("contributorNameTypeName", "Personal name")
+            )
+
+    async def add_mapped(self, record: dict) -> Optional[str]:
+        """Updates and adds a locally mapped record, reporting a failure in the
+        history, returns the Instance URL or None"""
+        try:
+            self.__update_record__(record)
+            instance_url = await add_instance(json.dumps(record))
+        except FOLIOLoginError as error:
+            add_history({"error": "FOLIO", "message": str(error)}, "error")
+            return None
+        if not isinstance(instance_url, str):
+            add_history({"error": "FOLIO", "message": _add_instance_error(instance_url)}, "error")
+            return None
+        add_history(f"Load FOLIO Instance {instance_url}", "prompt")
+        load_instance(instance_url)
+        return instance_url
+
+    async def add_instances(self, records: list, chunk_size=500) -> list:
+        """Updates and bulk loads a chunk of Instance records into FOLIO"""
+        for record in records:
+            self.__update_record__(record)
+        return await add_instances(records, chunk_size=chunk_size)
+
+
+async def _retrieve_instance(uuid: str):
+    instance = await get_instance(uuid.strip())
+    if instance is None:
+        return f"No FOLIO Instance {uuid}"
+    return {
+        "title": instance.get("title"),
+        "contributors": [row.get("name") for row in instance.get("contributors", [])],
+        "subjects": instance.get("subjects", []),
+        "notes": [row.get("note") for row in instance.get("notes", [])],
+        "series": instance.get("series", []),
+    }
+
+
+async def _validate_headings(text: str):
+    checked = await validate_lcsh(text, timeout=AssignLCSH.validation_timeout)
+    if len(checked) < 1:
+        return "No local LCSH index loaded, use search_lcsh"
+    return checked
+
+
+def _add_validation_to_history(checked: list):
+    rows = ""
+    for row in checked:
+        authorized = ""
+        if row["uri"] is not None:
+            authorized = f"""<a href="{row['uri']}" target="_blank">{row['authorized']}</a>"""
+        rows += f"""<tr><td>{row['heading']}</td><td>{row['status']}</td>
+          <td>{authorized}</td><td>{row['score']:.2f}</td></tr>"""
+    add_history(
+        f"""LCSH validation<table class="table table-sm">
+          <thead><tr><th>Heading</th><th>Status</th><th>Authorized Form</th><th>Score</th></tr></thead>
+          <tbody>{rows}</tbody>
+        </table>""",
+        "prompt",
+    )
+
+
+def _add_instance_error(response) -> str:
+    """Function output for the FetchResponse add_instance returns on an error,
+    the errors themselves are shown in the FOLIO error card"""
+    return f"add_instance failed with status {response.status}, see the FOLIO errors"
+
+
+def _add_step_to_history(step):
+    html = f"<pre>{step.content}</pre>"
+    for call in step.calls:
+        html += f"""Observation from {call.tool} ({call.seconds:.1f}s)<pre>{call.observation}</pre>"""
+    html += f"""<small>Turn {step.turn} model {step.model_seconds:.1f}s
+      action {step.tool_seconds:.1f}s tokens {step.tokens}</small>"""
+    add_history(html, "prompt")
 
 
 class AssignLCSH(WorkFlow):
@@ -104,30 +284,74 @@ class AssignLCSH(WorkFlow):
     system_prompt = "As an expert cataloger, you will use the context to assign Library of Congress Subject Headings to terms"
 
     examples = []
+    # Seconds the answer waits for the LCSH index, which can still be downloading
+    validation_timeout: float = 2.0
 
-    def __init__(self, zero_shot=False):
-        self.system = system
+    def __init__(self, zero_shot=False, react=True):
+        self.zero_shot = zero_shot
         self.react = react
+        self.agent = AgentLoop(max_turns=AssignLCSH.max_turns, on_step=_add_step_to_history)
+        self.agent.tool(
+            "retrieve_instance",
+            _retrieve_instance,
+            "Returns the title, contributors, subjects, and notes of a FOLIO Instance",
+            "529056f1-d1a2-5dd6-b074-311847ab362a",
+        )
+        self.agent.tool(
+            "search_lcsh",
+            search_lcsh,
+            "Returns matching Library of Congress Subject Headings and their URIs",
+            "Science fiction",
+        )
+        self.agent.tool(
+            "validate_lcsh",
+            _validate_headings,
+            "Checks ; separated headings, returning whether each is authorized and its authorized form",
+            "Cats--Behavior; Felines",
+        )
 
     async def system(self):
         system_prompt = AssignLCSH.system_prompt
+        if self.react:
+            system_prompt = f"{system_prompt}\n{self.agent.prompt()}"
 
         if self.zero_shot is False:
             system_prompt = f"""{system_prompt}\nExamples:\n"""
-            system_prompt += "\n".join(MARC21toFOLIO.examples)
+            system_prompt += "\n".join(self.examples)
 
 
         return system_prompt
 
     async def run(self, chat_instance: ChatGPT, initial_prompt: str):
         add_history(initial_prompt, "prompt")
+        # The agent's tools are in the system prompt, drop the previous workflow's
+        chat_instance.functions = None
         if not self.react:
             chat_result = await chat_instance(initial_prompt)
+            if "error" in chat_result:
+                add_history(chat_result, "error")
+                return
             add_history(chat_result, "response")
+            checked = await validate_lcsh(
+                chat_result["choices"][0]["message"].get("content") or "",
+                timeout=self.validation_timeout,
+            )
+            if len(checked) > 0:
+                _add_validation_to_history(checked)
+            return
+        result = await self.agent.run(chat_instance, initial_prompt)
+        if result.stop == "error":
+            add_history({"error": "Agent", "message": result.answer}, "error")
             return
-        count = 0
-        while count < AssignLCSH.max_turns:
-            count += 1
+        add_history(
+            f"""Answer after {len(result.steps)} turns ({result.stop}, {result.tokens} tokens,
+            {result.seconds:.1f}s)<pre>{result.answer}</pre>""",
+            "prompt",
+        )
+        checked = await validate_lcsh(result.answer, timeout=self.validation_timeout)
+        if len(checked) > 0:
+            _add_validation_to_history(checked)
+        return result.answer
 
 
 class MARC21toFOLIO(FOLIOWorkFlow):
@@ -137,27 +361,23 @@ to a FOLIO Instance JSON record
 """
 
     examples = [
-        """Q: =LDR  01071cam a2200349 i 4500
-=001  a757722
-=003  SIRSI
-=005  19910715000000.0
-=008  791017s1977\\\\onca\\\\\b\\\\001\0\eng\\
-=015  \\$aC77-001233-7
-=020  \\$a0070824525
-=020  \\$a9780070824522
-=050  0\$aHA29$b.E72
-=082  \\$a519.5
-=100  1\$aErickson, Bonnie H.$0(SIRSI)415236
-=245  10$aUnderstanding data /$cBonnie H. Erickson, T. A. Nosanchuk.
-=260  \\$aToronto ;$aNew York :$bMcGraw-Hill Ryerson,$cc1977.
-=300  \\$axi, 388 p. :$bill. ;$c23 cm.
-=490  1\$aMcGraw-Hill Ryerson series in Canadian sociology
-=500  \\$aIncludes index.
-=504  \\$aBibliography: p. 383-384.
-=596  \\$a1
-=650  \0$aStatistics.$0(SIRSI)1064412
-=700  1\$aNosanchuk, T. A.,$d1935-$0(SIRSI)54329
-=830  \0$aMcGraw-Hill Ryerson series in Canadian sociology.$0(SIRSI)1108560
+        """Q: LDR type=a level=m
+001 a757722
+008 date=1977 lang=eng
+020 $a0070824525
+020 $a9780070824522
+050 0_$aHA29$b.E72
+082 $a519.5
+100 1_$aErickson, Bonnie H.
+245 10$aUnderstanding data /$cBonnie H. Erickson, T. A. Nosanchuk.
+260 $aToronto ;$aNew York :$bMcGraw-Hill Ryerson,$cc1977.
+300 $axi, 388 p. :$bill. ;$c23 cm.
+490 1_$aMcGraw-Hill Ryerson series in Canadian sociology
+500 $aIncludes index.
+504 $aBibliography: p. 383-384.
+650 _0$aStatistics.
+700 1_$aNosanchuk, T. A.,$d1935-
+830 _0$aMcGraw-Hill Ryerson series in Canadian sociology.
 
            A: {
 "source": "MARC",
@@ -188,10 +408,69 @@ to a FOLIO Instance JSON record
         add_instance_sig,
     ]
 
+    # Fields sent to the model, X is a wildcard, local X9X fields are never sent
+    prompt_fields = [
+        "LDR", "001", "008", "010", "020", "022", "024", "035", "050", "082",
+        "1X0", "1X1", "130", "240", "245", "246", "250", "260", "264", "300",
+        "310", "362", "490", "50X", "51X", "52X", "53X", "54X", "55X", "56X",
+        "58X", "6X0", "6X1", "6X5", "7X0", "7X1", "730", "740", "8X0", "856",
+    ]
+
+    residue_prompt = """Return only a JSON object with the FOLIO Instance properties for
+these MARC21 fields, they are not yet in the record:
+"""
+
 
     def __init__(self, zero_shot=False):
         super().__init__()
         self.zero_shot = zero_shot
+        # Map mechanical fields locally and only send the residue to the model
+        self.use_rules = True
+
+    def encode(self, marc_record) -> tuple:
+        """Compact prompt form of the record and its estimated token reduction"""
+        from marc import encode_for_prompt, prompt_savings
+
+        encoded = encode_for_prompt(marc_record, MARC21toFOLIO.prompt_fields)
+        savings = prompt_savings(marc_record, encoded)
+        console.log(
+            f"Compact MARC {savings['compact_tokens']} tokens, saved ~{savings['saved_tokens']} ({savings['saved_percent']}%)"
+        )
+        return encoded, savings
+
+    async def _convert_residue(self, chat_instance: ChatGPT, residue: list) -> dict:
+        conversation = chat_instance.fork()
+        conversation.functions = None
+        await conversation.set_system(MARC21toFOLIO.system_prompt)
+        from marc import encode_fields
+
+        fields = encode_fields(residue, MARC21toFOLIO.prompt_fields)
+        if len(fields) < 1:
+            return {}
+        chat_result = await conversation(f"{MARC21toFOLIO.residue_prompt}{fields}")
+        if "error" in chat_result:
+            raise ValueError(f"{chat_result['error']} {chat_result['message']}")
+        content = chat_result["choices"][0]["message"].get("content") or ""
+        start, end = content.find("{"), content.rfind("}")
+        if start < 0 or end < start:
+            return {}
+        return json.loads(content[start : end + 1], strict=False)
+
+    async def map_record(self, chat_instance: ChatGPT, marc_record) -> Optional[dict]:
+        """Maps a record with the local rules, asking the model only for the fields
+        the rules don't cover, returns None if the rules can't map the title"""
+        from marc import to_folio_instance
+
+        instance, residue = to_folio_instance(marc_record)
+        if "title" not in instance:
+            return None
+        if len(residue) > 0:
+            for key, value in (await self._convert_residue(chat_instance, residue)).items():
+                if isinstance(value, list) and isinstance(instance.get(key), list):
+                    instance[key].extend(value)
+                elif key not in instance:
+                    instance[key] = value
+        return instance
 
 
 
@@ -211,30 +490,146 @@ to a FOLIO Instance JSON record
         return system_prompt
 
 
+    async def convert(self, chat_instance: ChatGPT, marc_record) -> dict:
+        """Converts one MARC record to a FOLIO Instance in its own conversation"""
+        if self.use_rules:
+            record = await self.map_record(chat_instance, marc_record)
+            if record is not None:
+                return record
+        conversation = chat_instance.fork()
+        await conversation.set_system(await self.system())
+        conversation.functions = MARC21toFOLIO.functions
+        encoded = self.encode(marc_record)[0]
+        chat_result = await conversation(encoded)
+        if "error" in chat_result:
+            raise ValueError(f"{chat_result['error']} {chat_result['message']}")
+        calls = [
+            call
+            for call in function_calls(chat_result["choices"][0]["message"])
+            if call["name"].startswith("add_instance")
+        ]
+        if len(calls) < 1:
+            raise ValueError("Model did not call add_instance")
+        args = json.loads(calls[0]["arguments"], strict=False)
+        record = args.get("record")
+        if isinstance(record, str):
+            record = json.loads(record, strict=False)
+        return record
+
+    async def run_batch(
+        self, chat_instance: ChatGPT, marc_results, checkpoint, concurrency=4, chunk_size=25
+    ):
+        """Converts and loads a stream of MARCResults with at most concurrency records
+        in flight, checkpointing the offsets of loaded records"""
+        await self.system()
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        converted = []
+        flush_lock = asyncio.Lock()
+
+        async def flush():
+            async with flush_lock:
+                if len(converted) < 1:
+                    return
+                chunk = converted[:]
+                converted.clear()
+                try:
+                    results = await self.add_instances([row[1] for row in chunk])
+                except Exception as error:
+                    # add_instances reports each record, an exception means nothing
+                    # was sent, e.g. no FOLIO login, and the records keep their ids
+                    # so a resume updates rather than duplicates them
+                    results = [{"ok": False, "error": str(error)} for row in chunk]
+                loaded = []
+                for (offset, record), result in zip(chunk, results):
+                    if result["ok"]:
+                        loaded.append(offset)
+                    else:
+                        checkpoint.failed(offset, json.dumps(result["error"]))
+                checkpoint.done(loaded)
+
+        async def worker():
+            while True:
+                result = await queue.get()
+                if result is None:
+                    break
+                try:
+                    record = await self.convert(chat_instance, result.record)
+                except Exception as error:
+                    checkpoint.failed(result.offset, str(error))
+                    continue
+                converted.append((result.offset, record))
+                if len(converted) >= chunk_size:
+                    await flush()
+
+        workers = [asyncio.ensure_future(worker()) for i in range(concurrency)]
+        async for result in marc_results:
+            if result.error is not None:
+                checkpoint.failed(result.offset, result.error)
+            elif checkpoint.is_done(result.offset):
+                checkpoint.skipped += 1
+            else:
+                await queue.put(result)
+        for i in range(concurrency):
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        await flush()
+        return checkpoint
+
     async def run(self, chat_instance, initial_prompt: str):
+        from marc import from_mnemonic
+
         add_history(f"<pre>{initial_prompt}</pre>", "prompt")
+        marc_record = from_mnemonic(initial_prompt)
+        if marc_record is not None and self.use_rules:
+            try:
+                record = await self.map_record(chat_instance, marc_record)
+            except ValueError as error:
+                add_history({"error": "Residue conversion", "message": str(error)}, "error")
+                return
+            if record is not None:
+                add_history(f"Mapped locally<pre>{json.dumps(record, indent=2)}</pre>", "prompt")
+                return await self.add_mapped(record)
         chat_instance.functions = MARC21toFOLIO.functions
-        chat_result = await chat_instance(initial_prompt)
-        function_call = chat_result["choices"][0]["message"].get("function_call")
-        if not function_call:
-            return
-        add_history(chat_result, "response")
+        prompt = initial_prompt
+        if marc_record is not None:
+            prompt, savings = self.encode(marc_record)
+            add_history(
+                f"Compact MARC, saved ~{savings['saved_tokens']} tokens ({savings['saved_percent']}%)<pre>{prompt}</pre>",
+                "prompt",
+            )
+        chat_result = await chat_instance(prompt)
+        # The model can call again after an add_instance error, e.g. with a fix
+        for turn in range(MARC21toFOLIO.max_turns + 1):
+            if "error" in chat_result:
+                add_history(chat_result, "error")
+                return
+            add_history(chat_result, "response")
+            calls = function_calls(chat_result["choices"][0]["message"])
+            if len(calls) < 1:
+                return
+            if turn == MARC21toFOLIO.max_turns:
+                self.skip_calls(chat_instance, calls)
+                return
+            outputs = await self.handle_calls(calls)
+            chat_result = await chat_instance.send_tool_results(calls, outputs)
+
+    async def __handle_func__(self, function_call) -> str:
         function_name = function_call.get("name")
         args = json.loads(function_call.get("arguments"), strict=False)
         #console.log(f"Function name {function_name} args: {args}")
-        if function_name.startswith("add_instance"):
-            record = args.get("record")
-            if isinstance(record, str):
-                record = json.loads(record, strict=False)
-            self.__update_record__(record)
-            instance_url = await add_instance(json.dumps(record))
-            msg = f"Load FOLIO Instance {instance_url}"
-            add_history(msg, "prompt")
-        load_chat_result = await chat_instance(msg)
-        function_call = load_chat_result["choices"][0]["message"].get("function_call")
-            
-                    
-        
+        if not function_name.startswith("add_instance"):
+            return f"Unknown function {function_name}"
+        record = args.get("record")
+        if isinstance(record, str):
+            record = json.loads(record, strict=False)
+        self.__update_record__(record)
+        instance_url = await add_instance(json.dumps(record))
+        if not isinstance(instance_url, str):
+            return _add_instance_error(instance_url)
+        add_history(f"Load FOLIO Instance {instance_url}", "prompt")
+        load_instance(instance_url)
+        return f"Load FOLIO Instance {instance_url}"
+
 
 
 class NewResource(FOLIOWorkFlow):
@@ -267,6 +662,8 @@ class NewResource(FOLIOWorkFlow):
                 self.__update_record__(record)
                 instance_url = await add_instance(json.dumps(record))
                 output = instance_url
+                if not isinstance(instance_url, str):
+                    output = _add_instance_error(instance_url)
 
             case "load_instance":
                 instance_url = json.loads(args.get("instance_url"))
@@ -293,45 +690,38 @@ class NewResource(FOLIOWorkFlow):
         add_history(initial_prompt, "prompt")
         chat_instance.functions = NewResource.functions
         chat_result = await chat_instance(initial_prompt)
-        function_call = chat_result["choices"][0]["message"].get("function_call")
-        if function_call:
+        if "error" in chat_result:
+            add_history(chat_result, "error")
+            return
+        calls = function_calls(chat_result["choices"][0]["message"])
+        if len(calls) < 1:
             add_history(chat_result, "response")
-            msg = await self.__handle_func__(function_call)
-            if not msg.startswith("Unknown"):
-                instance_url = msg
-                msg = f"Load FOLIO Instance {instance_url}"
-                add_history(msg, "prompt")
-                load_instance(instance_url)
-        return f"Finished {instance_url}"
+            return "Workflow finished without a record"
+        add_history(chat_result, "response")
+        outputs = await self.handle_calls(calls)
+        # Answered without another request, the workflow ends here
+        chat_instance.add_tool_results(calls, outputs)
+        instance_urls = []
+        for msg in outputs:
+            if msg.startswith("http"):
+                instance_urls.append(msg)
+                add_history(f"Load FOLIO Instance {msg}", "prompt")
+                load_instance(msg)
+        return f"Finished {', '.join(instance_urls)}"
 
 
 class SinopiaToFOLIO(FOLIOWorkFlow):
     name = "Sinopia BIBFRAME to FOLIO Inventory Instance"
-    system_prompt = """You are an expert cataloger, given a Sinopia URL you will retrieve the JSON Linked Data
-and convert it to a FOLIO Instance JSON record"""
+    system_prompt = """You are an expert cataloger, given a Sinopia URL you will retrieve the BIBFRAME
+properties as "path: value" lines and convert them to a FOLIO Instance JSON record"""
 
     examples = [
-        """Q: @prefix bf: <http://id.loc.gov/ontologies/bibframe/> .
-@prefix bflc: <http://id.loc.gov/ontologies/bflc/> .
-@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
-@prefix sinopia: <http://sinopia.io/vocabulary/> .
-
-<https://api.stage.sinopia.io/resource/bd072fe6-f189-4a39-9f0c-0dac4d1ef0bd> a bf:Work ;
-    bf:title [ a bf:Title ;
-    bf:mainTitle "Parable of the Sower"@en ] ;
-    bf:contribution [ a bflc:PrimaryContribution ;
-            bf:agent <http://id.loc.gov/authorities/names/n2020014067> ;
-            bf:role <http://id.loc.gov/vocabulary/relators/aut> ] ;
-    bf:note [ a bf:Note ;
-            rdfs:label "Includes bibliographical references (pages [235]-301) and index"@en ] ;
-    
-
-<http://id.loc.gov/rwo/agents/n79056654> a bf:Agent,
-        bf:Person ;
-    rdfs:label "Butler, Octavia E."@en .
-
-<http://id.loc.gov/vocabulary/relators/aut> a bf:Role ;
-    rdfs:label "Author" .
+        """Q: Work <https://api.stage.sinopia.io/resource/bd072fe6-f189-4a39-9f0c-0dac4d1ef0bd>
+contribution(PrimaryContribution).agent: Butler, Octavia E. <http://id.loc.gov/authorities/names/n2020014067>
+contribution(PrimaryContribution).role: Author <http://id.loc.gov/vocabulary/relators/aut>
+language: English <http://id.loc.gov/vocabulary/languages/eng>
+note.label: Includes bibliographical references (pages [235]-301) and index
+title.mainTitle: Parable of the Sower
 
     A:  {"title": "Parable of the Sower", "source": "Sinopia", 
          "contributors": [{"name": "Octiva Butler", "contributorTypeText": "Author", "primary": true}], 
@@ -346,11 +736,53 @@ and convert it to a FOLIO Instance JSON record"""
         add_instance_sig
     ]
 
+    gap_prompt = """Return only a JSON object with these FOLIO Instance properties
+from the BIBFRAME below: """
+
+    sinopia_url_re = re.compile(r"https?://[\w.-]*sinopia\.io/resource/[\w-]+")
+
     def __init__(self,  zero_shot=False):
         super().__init__()
         self.zero_shot = zero_shot
-
-
+        # Map with the prepared SPARQL queries and only ask the model for gaps
+        self.use_rules = True
+
+    async def _fill_gaps(self, chat_instance: ChatGPT, resource_url: str, gaps: list) -> dict:
+        from sinopia import load as load_sinopia
+
+        conversation = chat_instance.fork()
+        conversation.functions = None
+        await conversation.set_system(SinopiaToFOLIO.system_prompt)
+        bibframe = await load_sinopia(resource_url)
+        chat_result = await conversation(
+            f"{SinopiaToFOLIO.gap_prompt}{', '.join(gaps)}\n{bibframe}"
+        )
+        if "error" in chat_result:
+            raise ValueError(f"{chat_result['error']} {chat_result['message']}")
+        content = chat_result["choices"][0]["message"].get("content") or ""
+        start, end = content.find("{"), content.rfind("}")
+        if start < 0 or end < start:
+            return {}
+        return json.loads(content[start : end + 1], strict=False)
+
+    async def map_resource(self, chat_instance: ChatGPT, resource_url: str) -> Optional[dict]:
+        """Maps a Sinopia resource with the prepared queries, asking the model only
+        for fields the queries missed, returns None if the title can't be mapped
+        and raises OSError if the resource can't be loaded"""
+        from sinopia import load as load_sinopia, load_graph, to_folio_instance
+
+        # Loading the pruned form also resolves the linked resource labels
+        if await load_sinopia(resource_url) is None:
+            raise OSError(f"Could not load Sinopia resource {resource_url}")
+        graph = await load_graph(resource_url)
+        instance, gaps = to_folio_instance(graph, resource_url)
+        if "title" not in instance:
+            return None
+        if len(gaps) > 0:
+            for key, value in (await self._fill_gaps(chat_instance, resource_url, gaps)).items():
+                if key in gaps:
+                    instance[key] = value
+        return instance
 
     async def __handle_func__(self, function_call) -> str:
         function_name = function_call.get("name")
@@ -365,8 +797,12 @@ and convert it to a FOLIO Instance JSON record"""
                 instance_url = await add_instance(json.dumps(record))
                 console.log(f"After SinopiaToFOLIO func call {instance_url}")
                 output = instance_url
+                if not isinstance(instance_url, str):
+                    output = _add_instance_error(instance_url)
 
             case "load_sinopia":
+                from sinopia import load as load_sinopia
+
                 sinopia_rdf = await load_sinopia(args.get("resource_url"))
                 prompt = "Add FOLIO Instance JSON record from" 
                 add_history(f"{prompt}<pre>{sinopia_rdf}</pre>", "prompt")
@@ -394,20 +830,46 @@ and convert it to a FOLIO Instance JSON record"""
 
     async def run(self, chat_instance: ChatGPT, initial_prompt: str):
         add_history(initial_prompt, "prompt")
+        resource_url = SinopiaToFOLIO.sinopia_url_re.search(initial_prompt)
+        if resource_url is not None and self.use_rules:
+            if self.instance_types is None:
+                await self.get_types()
+            try:
+                record = await self.map_resource(chat_instance, resource_url.group(0))
+            except (OSError, ValueError) as error:
+                # Fetch failures, an unreadable resource, or a failed gap conversion
+                add_history({"error": "Sinopia", "message": str(error)}, "error")
+                return "Workflow finished with an error"
+            if record is not None:
+                add_history(f"Mapped locally<pre>{json.dumps(record, indent=2)}</pre>", "prompt")
+                instance_url = await self.add_mapped(record)
+                if instance_url is None:
+                    return "Workflow finished with an error"
+                return instance_url
         chat_instance.functions = SinopiaToFOLIO.functions
         chat_result = await chat_instance(initial_prompt)
-        add_history(chat_result, "response")
-        function_call = chat_result["choices"][0]["message"].get("function_call")
-        if function_call:
-            first_result = await self.__handle_func__(function_call)
-            console.log(f"First result")
-            chat_result_rdf = await chat_instance(first_result)
-            final_func_call = chat_result_rdf["choices"][0]["message"].get("function_call")
-            console.log(f"Final func {final_func_call}")
-            final_result = await self.__handle_func__(final_func_call)
-            # console.log(f"The final result {final_result}")
-            add_history(chat_result_rdf, "response")
-            load_instance(final_result)
-
-            return final_result
+        for turn in range(SinopiaToFOLIO.max_turns + 1):
+            if "error" in chat_result:
+                add_history(chat_result, "error")
+                return "Workflow finished with an error"
+            add_history(chat_result, "response")
+            calls = function_calls(chat_result["choices"][0]["message"])
+            if len(calls) < 1:
+                break
+            if turn == SinopiaToFOLIO.max_turns:
+                self.skip_calls(chat_instance, calls)
+                break
+            # Independent calls, e.g. loading a Work and its Instances, run together
+            outputs = await self.handle_calls(calls)
+            instance_urls = [
+                output
+                for call, output in zip(calls, outputs)
+                if call["name"] == "add_instance" and output.startswith("http")
+            ]
+            if len(instance_urls) > 0:
+                chat_instance.add_tool_results(calls, outputs)
+                for instance_url in instance_urls:
+                    load_instance(instance_url)
+                return instance_urls[-1]
+            chat_result = await chat_instance.send_tool_results(calls, outputs)
         return "Workflow finished without completing"
@@ -0,0 +1,116 @@
+"""
+The modules import each other flat, as they do in Pyodide, and import the
+browser's js and pyodide modules, which are stood in for outside the browser
+"""
+import asyncio
+import pathlib
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "src" / "catalog_chat"))
+
+
+class _Storage(object):
+    def __init__(self):
+        self.items = {}
+
+    def getItem(self, key):
+        return self.items.get(key)
+
+    def setItem(self, key, value):
+        self.items[key] = value
+
+    def removeItem(self, key):
+        self.items.pop(key, None)
+
+
+async def _pyfetch(url, **kwargs):
+    raise OSError(f"No network in tests, fetching {url}")
+
+
+try:
+    import js  # noqa: F401
+except ImportError:
+    js = types.ModuleType("js")
+    js.console = types.SimpleNamespace(log=print)
+    js.document = types.SimpleNamespace(getElementById=lambda element_id: None)
+    js.sessionStorage = _Storage()
+    js.localStorage = _Storage()
+    js.performance = types.SimpleNamespace(
+        now=lambda: time.monotonic() * 1000, getEntriesByType=lambda kind: []
+    )
+    for name in [
+        "AbortController", "Headers", "JSON", "Response", "Uint8Array", "alert",
+        "caches", "fetch", "window",
+    ]:
+        setattr(js, name, types.SimpleNamespace())
+    sys.modules["js"] = js
+
+try:
+    import pyodide.http  # noqa: F401
+except ImportError:
+    pyodide = types.ModuleType("pyodide")
+    pyodide.http = types.ModuleType("pyodide.http")
+    pyodide.http.pyfetch = _pyfetch
+    pyodide.ffi = types.ModuleType("pyodide.ffi")
+    pyodide.ffi.create_proxy = lambda function: function
+    sys.modules.update(
+        {"pyodide": pyodide, "pyodide.http": pyodide.http, "pyodide.ffi": pyodide.ffi}
+    )
+
+
+@pytest.fixture
+def scripted_chat():
+    """Makes a ChatGPT whose completions are the given assistant messages in
+    order, an {"error": ...} dict fails the request and "hang" never returns"""
+    from chat import ChatGPT
+
+    def make(replies: list):
+        chat_instance = ChatGPT(key="test")
+        script = iter(replies)
+
+        async def complete():
+            reply = next(script)
+            if reply == "hang":
+                await asyncio.sleep(60)
+            if "error" in reply:
+                return reply
+            chat_instance.messages.append(reply)
+            return {
+                "id": f"chatcmpl-{len(chat_instance.messages)}",
+                "created": 0,
+                "choices": [{"message": reply}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+            }
+
+        chat_instance._complete = complete
+        return chat_instance
+
+    return make
+
+
+@pytest.fixture
+def check_messages():
+    """Asserts every tool or function call in the messages has its answer and
+    the conversation doesn't end on an unanswered prompt"""
+
+    def check(messages: list):
+        for position, message in enumerate(messages):
+            if message["role"] != "assistant":
+                continue
+            answers = []
+            for row in messages[position + 1 :]:
+                if row["role"] not in ["tool", "function"]:
+                    break
+                answers.append(row.get("tool_call_id", row.get("name")))
+            expected = [row["id"] for row in message.get("tool_calls") or []]
+            if message.get("function_call"):
+                expected.append(message["function_call"]["name"])
+            assert sorted(answers) == sorted(expected), f"Unanswered calls in {message}"
+        if len(messages) > 0:
+            assert messages[-1]["role"] != "user", "Unanswered prompt"
+
+    return check
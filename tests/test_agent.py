@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+from agent import AgentLoop
+
+
+def _tool_call(call_id, text="Cats"):
+    return {
+        "id": call_id,
+        "type": "function",
+        "function": {"name": "lookup", "arguments": json.dumps({"text": text})},
+    }
+
+
+def _calls(*call_ids, content=None):
+    return {
+        "role": "assistant",
+        "content": content,
+        "tool_calls": [_tool_call(call_id) for call_id in call_ids],
+    }
+
+
+def _answer(text):
+    return {"role": "assistant", "content": text}
+
+
+def _agent(**kwargs):
+    agent = AgentLoop(**kwargs)
+
+    async def lookup(text):
+        return f"Found {text}"
+
+    agent.tool("lookup", lookup, "Looks up text", "Cats")
+    return agent
+
+
+def _run(agent, chat_instance, prompt="Assign headings"):
+    return asyncio.run(agent.run(chat_instance, prompt))
+
+
+def test_answer_after_tool_calls(scripted_chat, check_messages):
+    chat_instance = scripted_chat([_calls("a", "b"), _answer("Thought: done\nAnswer: Cats")])
+    result = _run(_agent(), chat_instance)
+    assert (result.stop, result.answer) == ("answer", "Cats")
+    assert [call.observation for call in result.steps[0].calls] == ["Found Cats"] * 2
+    check_messages(chat_instance.messages)
+
+
+def test_max_turns_answers_calls_and_keeps_last_content(scripted_chat, check_messages):
+    chat_instance = scripted_chat([_calls("a"), _calls("b", content="Thought: Cats--Behavior")])
+    result = _run(_agent(max_turns=2), chat_instance)
+    assert (result.stop, result.answer) == ("max_turns", "Thought: Cats--Behavior")
+    assert chat_instance.messages[-1] == {"role": "tool", "tool_call_id": "b", "content": "Found Cats"}
+    check_messages(chat_instance.messages)
+
+
+def test_token_budget_answers_calls(scripted_chat, check_messages):
+    chat_instance = scripted_chat([_calls("a")])
+    result = _run(_agent(max_tokens=1), chat_instance)
+    assert result.stop == "token_budget"
+    check_messages(chat_instance.messages)
+
+
+def test_timeout_on_prompt_drops_it(scripted_chat, check_messages):
+    chat_instance = scripted_chat(["hang"])
+    result = _run(_agent(max_seconds=0.05), chat_instance)
+    assert result.stop == "time_budget"
+    assert chat_instance.messages == []
+    check_messages(chat_instance.messages)
+
+
+def test_timeout_on_tool_results_keeps_them(scripted_chat, check_messages):
+    chat_instance = scripted_chat([_calls("a"), "hang"])
+    result = _run(_agent(max_seconds=0.2), chat_instance)
+    assert result.stop == "time_budget"
+    assert [row["role"] for row in chat_instance.messages] == ["user", "assistant", "tool"]
+    check_messages(chat_instance.messages)
+
+
+def test_error_on_prompt_drops_it(scripted_chat, check_messages):
+    chat_instance = scripted_chat([{"error": 500, "message": "Server error"}])
+    result = _run(_agent(), chat_instance)
+    assert (result.stop, result.answer) == ("error", "500 Server error")
+    check_messages(chat_instance.messages)
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import lcsh
+
+from lcsh import LCSHIndex, candidate_headings, normalize
+
+SUBJECTS = "http://id.loc.gov/authorities/subjects/"
+
+
+def _line(record_id, label, variants=()):
+    node = {
+        "@id": f"{SUBJECTS}{record_id}",
+        "madsrdf:authoritativeLabel": {"@language": "en", "@value": label},
+    }
+    return json.dumps(
+        {
+            "@graph": [node]
+            + [
+                {"@id": f"_:v{i}", "madsrdf:variantLabel": {"@language": "en", "@value": variant}}
+                for i, variant in enumerate(variants)
+            ]
+        }
+    )
+
+
+def _index():
+    index = LCSHIndex()
+    index.add_records(
+        [
+            _line("sh85021262", "Cats", ["Felis catus", "House cats"]),
+            _line("sh85021263", "Cats--Behavior"),
+            _line("sh85148273", "World War, 1914-1918"),
+            "",
+            _line("sh2008001234", "Science fiction"),
+        ]
+    )
+    index.build()
+    return index
+
+
+def test_normalize():
+    assert normalize("Cats -- Behavior.") == "cats--behavior"
+    assert normalize("Cats—Behavior") == "cats--behavior"
+    assert normalize("World War, 1914–1918") == "world war 1914-1918"
+    assert normalize("Église (Paris) – Histoire") == "eglise paris--histoire"
+
+
+def test_exact_and_variant():
+    index = _index()
+    assert len(index) == 4
+    assert index.exact("cats") == {"label": "Cats", "uri": f"{SUBJECTS}sh85021262", "variant": False}
+    assert index.exact("House cats.")["variant"] is True
+    assert index.exact("Dogs") is None
+
+
+def test_prefix_returns_each_heading_once():
+    labels = [row["label"] for row in _index().prefix("cat")]
+    assert labels == ["Cats", "Cats--Behavior"]
+
+
+def test_check_statuses():
+    index = _index()
+    assert index.check("Cats")["status"] == "authorized"
+    assert index.check("Felis catus")["authorized"] == "Cats"
+    subdivided = index.check("Science fiction -- History and criticism")
+    assert subdivided["status"] == "subdivided"
+    assert subdivided["authorized"] == "Science fiction--History and criticism"
+    fuzzy = index.check("Science fictions")
+    assert (fuzzy["status"], fuzzy["authorized"]) == ("fuzzy", "Science fiction")
+    assert index.check("Quantum chromodynamics")["status"] == "unknown"
+    assert [row["heading"] for row in index.validate(["Quantum", "Cats", "House cats"])] == [
+        "Cats",
+        "House cats",
+        "Quantum",
+    ]
+
+
+def test_candidate_headings():
+    text = "1. Cats--Behavior (http://id.loc.gov/authorities/subjects/sh85021263)\n- Felines; Pets."
+    assert candidate_headings(text) == ["Cats--Behavior", "Felines", "Pets"]
+
+
+def test_validate_does_not_wait_past_timeout(monkeypatch):
+    async def check():
+        loading = asyncio.get_running_loop().create_future()
+        monkeypatch.setattr(lcsh, "_index_task", loading)
+        assert await lcsh.validate("Cats", timeout=0.01) == []
+        assert not loading.done()
+        loading.set_result(_index())
+        return await lcsh.validate("Cats", timeout=0.01)
+
+    assert [row["status"] for row in asyncio.run(check())] == ["authorized"]
@@ -0,0 +1,227 @@
+import json
+
+import pytest
+
+pymarc = pytest.importorskip("pymarc")
+
+from marc import (
+    ISO2709Parser,
+    MARCJSONParser,
+    MARCXMLParser,
+    encode_fields,
+    encode_for_prompt,
+    sniff_format,
+    to_folio_instance,
+)
+
+ALLOWLIST = ["LDR", "008", "041", "245", "246", "264", "336"]
+
+
+def _field(tag, indicators, subfields):
+    return pymarc.Field(tag=tag, indicators=indicators, subfields=subfields)
+
+
+def test_encode_fields_single_residue_field():
+    residue = [_field("246", ["1", "3"], ["a", "Other title"])]
+    assert encode_fields(residue, ALLOWLIST) == "246 13$aOther title"
+
+
+def test_encode_fields_keeps_every_residue_field():
+    residue = [
+        _field("041", ["0", " "], ["a", "eng", "h", "fre"]),
+        _field("246", ["1", "3"], ["a", "Other title"]),
+        _field("264", [" ", "4"], ["c", "©2020"]),
+        _field("336", [" ", " "], ["a", "text", "2", "rdacontent"]),
+    ]
+    assert encode_fields(residue, ALLOWLIST).splitlines() == [
+        "041 0_$aeng$hfre",
+        "246 13$aOther title",
+        "264 _4$c©2020",
+        "336 $atext$2rdacontent",
+    ]
+
+
+def test_encode_fields_without_allowlist():
+    residue = [_field("500", [" ", " "], ["a", "A note."])]
+    assert encode_fields(residue) == "500 $aA note."
+
+
+def test_encode_for_prompt_starts_with_leader():
+    record = pymarc.Record()
+    record.leader = "00000nam a2200000 i 4500"
+    record.add_field(_field("245", ["1", "0"], ["a", "Title"]))
+    assert encode_for_prompt(record, ALLOWLIST).splitlines() == [
+        "LDR type=a level=m",
+        "245 10$aTitle",
+    ]
+
+
+def _record(title, control="a1"):
+    record = pymarc.Record()
+    record.leader = "00000nam a2200000 i 4500"
+    record.add_field(pymarc.Field(tag="001", data=control))
+    record.add_field(_field("245", ["1", "0"], ["a", title]))
+    return record
+
+
+def _chunks(data, size):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+def _parse(parser, chunks):
+    results = []
+    for chunk in chunks:
+        results.extend(parser.feed(chunk))
+    results.extend(parser.close())
+    return results
+
+
+def test_iso2709_records_split_across_chunks():
+    first, second = _record("Première", "a1").as_marc(), _record("Second", "a2").as_marc()
+    results = _parse(ISO2709Parser(), _chunks(first + second, 7))
+    assert [result.offset for result in results] == [0, len(first)]
+    assert [result.error for result in results] == [None, None]
+    assert [result.record["245"]["a"] for result in results] == ["Première", "Second"]
+
+
+def test_iso2709_resyncs_after_bad_length():
+    good = _record("Good").as_marc()
+    results = _parse(ISO2709Parser(), _chunks(b"xxxxxbad\x1d" + good, 4))
+    assert results[0].record is None
+    assert results[0].error.startswith("Invalid record length")
+    assert results[1].offset == 9
+    assert results[1].record["245"]["a"] == "Good"
+
+
+def test_iso2709_truncated_record():
+    data = _record("Cut").as_marc()
+    results = _parse(ISO2709Parser(), [data[:-10]])
+    assert [result.error for result in results] == ["Truncated record at end of file"]
+
+
+def test_to_folio_instance_maps_mechanical_fields():
+    record = _record("The operations in Egypt /", "a3044621")
+    record["245"].indicators = ["1", "4"]
+    record["245"].add_subfield("c", "by A. Kearsey.")
+    for field in [
+        pymarc.Field(tag="008", data="850513q19401949enkab         000 0 eng d"),
+        _field("020", [" ", " "], ["z", "0000000000"]),
+        _field("035", [" ", " "], ["a", "(OCoLC)12030243"]),
+        _field("040", [" ", " "], ["a", "CSJ"]),
+        _field("050", ["0", "0"], ["a", "D568.7", "b", ".K4"]),
+        _field("082", ["0", "4"], ["a", "940.415", "2", "22"]),
+        _field("100", ["1", " "], ["a", "Kearsey, A.,", "d", "1877-", "e", "author."]),
+        _field("246", ["3", " "], ["a", "Egypt and Palestine"]),
+        _field("264", [" ", "1"], ["a", "Aldershot :", "b", "Gale & Polden,", "c", "[194-?]"]),
+        _field("264", [" ", "4"], ["c", "©1940"]),
+        _field("590", [" ", " "], ["a", "Local note"]),
+        _field("650", [" ", "0"], ["a", "World War, 1914-1918", "x", "Campaigns."]),
+    ]:
+        record.add_field(field)
+    instance, residue = to_folio_instance(record)
+    assert instance["hrid"] == "a3044621"
+    assert instance["instanceTypeName"] == "text"
+    assert instance["languages"] == ["eng"]
+    assert instance["title"] == "The operations in Egypt / by A. Kearsey."
+    assert instance["indexTitle"] == "Operations in Egypt"
+    assert instance["identifiers"] == [
+        {"identifierTypeName": "OCLC", "value": "(OCoLC)12030243"}
+    ]
+    assert instance["classifications"] == [
+        {"classificationNumber": "D568.7 .K4", "classificationTypeName": "LC"},
+        {"classificationNumber": "940.415", "classificationTypeName": "Dewey"},
+    ]
+    assert instance["contributors"] == [
+        {
+            "name": "Kearsey, A., 1877-",
+            "contributorTypeText": "Author",
+            "contributorNameTypeName": "Personal name",
+            "primary": True,
+        }
+    ]
+    assert instance["publication"] == [
+        {"publisher": "Gale & Polden", "place": "Aldershot", "dateOfPublication": "[194-?]"}
+    ]
+    assert instance["subjects"] == ["World War, 1914-1918 Campaigns"]
+    assert [field.tag for field in residue] == ["246", "264"]
+
+
+def test_to_folio_instance_without_title():
+    record = pymarc.Record()
+    record.add_field(_field("245", ["0", "0"], ["k", "Papers"]))
+    instance, residue = to_folio_instance(record)
+    assert "title" not in instance
+    assert [field.tag for field in residue] == ["245"]
+
+
+MARCXML = """<?xml version="1.0" encoding="UTF-8"?>
+<collection xmlns="http://www.loc.gov/MARC21/slim">
+  <record>
+    <leader>00000nam a2200000 i 4500</leader>
+    <controlfield tag="001">x1</controlfield>
+    <datafield tag="245" ind1="1" ind2="0"><subfield code="a">Première</subfield></datafield>
+  </record>
+  <record>
+    <controlfield tag="001">x2</controlfield>
+    <datafield tag="245" ind1="0" ind2="0"><subfield code="a">Second</subfield></datafield>
+  </record>
+</collection>""".encode("utf-8")
+
+
+def test_marcxml_records_split_across_chunks():
+    results = _parse(MARCXMLParser(), _chunks(MARCXML, 5))
+    assert [result.offset for result in results] == [0, 1]
+    assert [result.record["001"].data for result in results] == ["x1", "x2"]
+    assert results[0].record["245"].indicators == ["1", "0"]
+    assert results[0].record["245"]["a"] == "Première"
+
+
+def test_marcxml_truncated():
+    results = _parse(MARCXMLParser(), [MARCXML[:-40]])
+    assert [result.record is not None for result in results] == [True, False]
+    assert results[1].error.startswith("Truncated MARCXML")
+
+
+def _marc_json(control, title):
+    return {
+        "leader": "00000nam a2200000 i 4500",
+        "fields": [
+            {"001": control},
+            {"245": {"ind1": "1", "ind2": "0", "subfields": [{"a": title}]}},
+        ],
+    }
+
+
+def test_marc_json_array_split_across_chunks():
+    data = json.dumps(
+        [_marc_json("j1", "Première"), _marc_json("j2", "Second")], ensure_ascii=False
+    ).encode("utf-8")
+    results = _parse(MARCJSONParser(), _chunks(data, 3))
+    assert [result.error for result in results] == [None, None]
+    assert [result.record["245"]["a"] for result in results] == ["Première", "Second"]
+    assert [data[result.offset : result.offset + 1] for result in results] == [b"{", b"{"]
+    assert results[1].offset == data.index(b'{"leader"', 2)
+
+
+def test_marc_json_lines_skip_a_bad_record():
+    lines = [
+        json.dumps(_marc_json("j1", "Première"), ensure_ascii=False),
+        '{"leader": "00000nam", "fields": [',
+        json.dumps(_marc_json("j3", "Third")),
+    ]
+    data = "\n".join(lines).encode("utf-8")
+    results = _parse(MARCJSONParser(), _chunks(data, 4))
+    assert [result.record is not None for result in results] == [True, False, True]
+    assert results[1].error.startswith("JSONDecodeError")
+    assert [result.offset for result in results] == [
+        0,
+        len(lines[0].encode("utf-8")) + 1,
+        len("\n".join(lines[:2]).encode("utf-8")) + 1,
+    ]
+
+
+def test_sniff_format():
+    assert sniff_format(b"\xef\xbb\xbf  <?xml version='1.0'?>") == "marcxml"
+    assert sniff_format(b"\n[{\"leader\": ") == "marcjson"
+    assert sniff_format(b'{"leader": ') == "marcjson"
+    assert sniff_format(_record("Title").as_marc()) == "iso2709"
@@ -0,0 +1,71 @@
+import pytest
+
+rdflib = pytest.importorskip("rdflib")
+
+from sinopia import to_folio_instance
+
+INSTANCE = "https://api.stage.sinopia.io/resource/instance-1"
+
+TURTLE = """
+@prefix bf: <http://id.loc.gov/ontologies/bibframe/> .
+@prefix bflc: <http://id.loc.gov/ontologies/bflc/> .
+@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+<https://api.stage.sinopia.io/resource/instance-1> a bf:Instance ;
+    bf:instanceOf <https://api.stage.sinopia.io/resource/work-1> ;
+    bf:title [ a bf:Title ; bf:mainTitle "Parable of the sower" ] ;
+    bf:identifiedBy [ a bf:Isbn ; rdf:value "0941423999" ] ,
+        [ a bf:Local ; rdf:value "local-1" ] ;
+    bf:provisionActivity [ a bf:Publication ;
+        bflc:simplePlace "New York" ;
+        bflc:simpleAgent "Four Walls Eight Windows" ;
+        bflc:simpleDate "1993" ] .
+
+<https://api.stage.sinopia.io/resource/work-1> a bf:Work ;
+    bf:contribution [ a bflc:PrimaryContribution ;
+        bf:agent <http://id.loc.gov/authorities/names/n79056054> ;
+        bf:role <http://id.loc.gov/vocabulary/relators/aut> ] ;
+    bf:language <http://id.loc.gov/vocabulary/languages/eng> ;
+    bf:note [ a bf:Note ; rdfs:label "Includes bibliographical references" ] ;
+    bf:subject [ rdfs:label "Science fiction" ] .
+
+<http://id.loc.gov/authorities/names/n79056054> a bf:Person ;
+    rdfs:label "Butler, Octavia E." .
+
+<http://id.loc.gov/vocabulary/relators/aut> rdfs:label "author" .
+"""
+
+
+def _graph(turtle=TURTLE):
+    return rdflib.Graph().parse(data=turtle, format="turtle")
+
+
+def test_to_folio_instance_maps_instance_and_work():
+    instance, gaps = to_folio_instance(_graph(), INSTANCE)
+    assert gaps == []
+    assert instance["title"] == "Parable of the sower"
+    assert instance["contributors"] == [
+        {
+            "name": "Butler, Octavia E.",
+            "contributorTypeText": "author",
+            "contributorNameTypeName": "Personal name",
+            "primary": True,
+        }
+    ]
+    assert instance["identifiers"] == [{"identifierTypeName": "ISBN", "value": "0941423999"}]
+    assert instance["languages"] == ["eng"]
+    assert instance["notes"] == [{"note": "Includes bibliographical references", "staffOnly": False}]
+    assert instance["subjects"] == ["Science fiction"]
+    assert instance["publication"] == [
+        {"place": "New York", "publisher": "Four Walls Eight Windows", "dateOfPublication": "1993"}
+    ]
+
+
+def test_to_folio_instance_reports_unmapped_properties_as_gaps():
+    turtle = TURTLE.replace('rdfs:label "Butler, Octavia E." .', ".").replace(
+        'bf:mainTitle "Parable of the sower"', 'rdfs:label "Parable"'
+    )
+    instance, gaps = to_folio_instance(_graph(turtle), INSTANCE)
+    assert "title" not in instance
+    assert gaps == ["title", "contributors"]
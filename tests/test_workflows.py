@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+import pytest
+
+import workflows
+
+from workflows import FOLIOWorkFlow, MARC21toFOLIO, NewResource, SinopiaToFOLIO
+
+RECORD = json.dumps({"title": "Parable of the Sower", "contributors": []})
+
+
+def _workflow(workflow=None):
+    workflow = workflow or FOLIOWorkFlow()
+    workflow.classification_types = {"LC": "lc-id", "Dewey": "dewey-id"}
+    workflow.contributor_types = {"Author": "author-id", "Contributor": "contributor-id"}
+    workflow.contributor_name_types = {"Personal name": "personal-id"}
+    workflow.identifier_types = {"ISBN": "isbn-id", "OCLC": "oclc-id"}
+    workflow.instance_types = {"text": "text-id", "unspecified": "unspecified-id"}
+    return workflow
+
+
+def test_update_record_matches_roles_case_insensitively():
+    record = {
+        "contributors": [
+            {"name": "Butler, Octavia E.", "contributorTypeText": "author."},
+            {"name": "Someone", "contributorTypeText": "Illustrator"},
+        ]
+    }
+    _workflow().__update_record__(record)
+    assert [row["contributorTypeId"] for row in record["contributors"]] == [
+        "author-id",
+        "contributor-id",
+    ]
+    assert record["instanceTypeId"] == "unspecified-id"
+
+
+@pytest.fixture
+def folio(monkeypatch):
+    """Stands in for the FOLIO calls and the history panel, collecting the
+    added records"""
+    added = []
+
+    async def add_instance(record):
+        added.append(json.loads(record))
+        return f"https://folio.example.org/inventory/view/{len(added)}"
+
+    monkeypatch.setattr(workflows, "add_instance", add_instance)
+    monkeypatch.setattr(workflows, "load_instance", lambda url: None)
+    monkeypatch.setattr(workflows, "add_history", lambda value, type_of: None)
+    return added
+
+
+def _calls(*names):
+    return {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [
+            {
+                "id": f"call_{i}",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps({"record": RECORD})},
+            }
+            for i, name in enumerate(names)
+        ],
+    }
+
+
+def _answer(text):
+    return {"role": "assistant", "content": text}
+
+
+def test_new_resource_answers_its_calls(folio, scripted_chat, check_messages):
+    chat_instance = scripted_chat([_calls("add_instance", "unknown")])
+    result = asyncio.run(_workflow(NewResource()).run(chat_instance, "Parable of the Sower"))
+    assert result == "Finished https://folio.example.org/inventory/view/1"
+    check_messages(chat_instance.messages)
+
+
+def test_sinopia_to_folio_answers_calls_on_instance_url(folio, scripted_chat, check_messages):
+    chat_instance = scripted_chat([_calls("add_instance")])
+    result = asyncio.run(_workflow(SinopiaToFOLIO()).run(chat_instance, "Convert this"))
+    assert result == "https://folio.example.org/inventory/view/1"
+    check_messages(chat_instance.messages)
+
+
+def test_sinopia_to_folio_answers_calls_at_turn_limit(folio, scripted_chat, check_messages):
+    turns = SinopiaToFOLIO.max_turns + 1
+    chat_instance = scripted_chat([_calls("unknown")] * turns)
+    result = asyncio.run(_workflow(SinopiaToFOLIO()).run(chat_instance, "Convert this"))
+    assert result == "Workflow finished without completing"
+    assert chat_instance.messages[-1]["content"] == "unknown was not run, the workflow stopped"
+    check_messages(chat_instance.messages)
+
+
+def test_marc_to_folio_runs_follow_up_calls(folio, scripted_chat, check_messages):
+    pytest.importorskip("pymarc")
+    chat_instance = scripted_chat(
+        [_calls("add_instance"), _calls("add_instance"), _answer("Added")]
+    )
+    asyncio.run(_workflow(MARC21toFOLIO()).run(chat_instance, "Not a MARC record"))
+    assert len(folio) == 2
+    assert chat_instance.messages[-1] == _answer("Added")
+    check_messages(chat_instance.messages)